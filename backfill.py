@@ -0,0 +1,141 @@
+import fnmatch
+import glob
+import os
+import sqlite3
+import time
+
+# Define constants for backfill
+SNAPSHOT_HEADER = '# backfill snapshot'
+READ_BLOCK_SIZE = 65536
+
+# Schema of the offsets database of the Fluent Bit 1.9 tail input. Files are looked up by
+# inode, and a file found there is read from its offset whatever read_from_head is set to.
+TAIL_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS in_tail_files (
+  id      INTEGER PRIMARY KEY,
+  name    TEXT NOT NULL,
+  offset  INTEGER,
+  inode   INTEGER,
+  created INTEGER,
+  rotated INTEGER DEFAULT 0
+);
+"""
+
+
+def line_aligned_size(path):
+    # Offset just after the last complete line of a file, so a line being written is left
+    # whole to the live input
+    with open(path, 'rb') as file:
+        end = file.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - READ_BLOCK_SIZE)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b'\n')
+            if newline != -1:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def list_log_files(path, exclude_path='', modified_after=None):
+    # Files matched by a tail Path and not by its Exclude_Path, optionally only the ones
+    # modified after a time, as the tail input would pick them
+    excluded = [pattern.strip() for pattern in exclude_path.split(',') if pattern.strip()]
+    files = set()
+    for pattern in path.split(','):
+        for file_path in glob.glob(pattern.strip()):
+            if any(fnmatch.fnmatch(file_path, exclude) for exclude in excluded):
+                continue
+            try:
+                if modified_after is not None and os.stat(file_path).st_mtime < modified_after:
+                    continue
+            except OSError:
+                continue
+            files.add(file_path)
+    return sorted(files)
+
+
+def read_tail_db_offsets(db_path):
+    # Offset of every file in a tail offsets database, by inode
+    if not os.path.exists(db_path):
+        return {}
+    connection = sqlite3.connect(db_path)
+    try:
+        return dict(connection.execute('SELECT inode, offset FROM in_tail_files'))
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        connection.close()
+
+
+def take_snapshot(files, live_offsets):
+    # (inode, cut, path) of the files with history to backfill. Files the live input already
+    # has an offset for were shipped up to there before backfill was turned on.
+    entries = []
+    for path in files:
+        try:
+            inode = os.stat(path).st_ino
+            cut = line_aligned_size(path)
+        except OSError:
+            continue
+        if cut > 0 and inode not in live_offsets:
+            entries.append((inode, cut, path))
+    return entries
+
+
+def write_snapshot(snapshot_path, entries):
+    # Replace the snapshot atomically so a crash never leaves a partial one
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(SNAPSHOT_HEADER + '\n')
+        for inode, cut, path in entries:
+            file.write(f'{inode}\t{cut}\t{path}\n')
+    os.replace(tmp_path, snapshot_path)
+
+
+def read_snapshot(snapshot_path):
+    # Entries of a snapshot, or None when there is no snapshot yet
+    try:
+        with open(snapshot_path) as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return None
+    entries = []
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        inode, cut, path = line.split('\t', 2)
+        entries.append((int(inode), int(cut), path))
+    return entries
+
+
+def seed_tail_db(db_path, entries):
+    # Start the live input at the cut of every snapshot file. Files it already tracks keep
+    # their offset, so seeding again after a crash changes nothing.
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path)
+    try:
+        with connection:
+            connection.executescript(TAIL_DB_SCHEMA)
+            tracked = {inode for (inode,) in connection.execute('SELECT inode FROM in_tail_files')}
+            connection.executemany(
+                'INSERT INTO in_tail_files (name, offset, inode, created, rotated) VALUES (?, ?, ?, ?, 0)',
+                [(path, cut, inode, int(time.time())) for inode, cut, path in entries if inode not in tracked])
+    finally:
+        connection.close()
+
+
+def pending_entries(entries, backfill_offsets):
+    # Snapshot entries the backfill input has not read up to their cut yet. A file that was
+    # removed or replaced by another file at the same path has nothing left to backfill.
+    pending = []
+    for inode, cut, path in entries:
+        try:
+            if os.stat(path).st_ino != inode:
+                continue
+        except OSError:
+            continue
+        if backfill_offsets.get(inode, 0) < cut:
+            pending.append((inode, cut, path))
+    return pending
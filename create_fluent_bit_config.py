@@ -1,15 +1,181 @@
+import copy
+import glob
+import json
+import math
 import os
+import re
+import resource
+import socket
+import time
+from urllib.parse import quote, urlsplit
+
+import backfill
+import docker_api
+import regex_cost
 
 # Define constants for file paths
 PLUGIN_PATH = "/fluent-bit/plugins/out_logzio.so"
 FLUENT_BIT_CONF_PATH = "/fluent-bit/etc/fluent-bit.conf"
 PARSERS_MULTILINE_CONF_PATH = "/fluent-bit/etc/parsers_multiline.conf"
+DEFAULT_TAIL_DB_PATH = "/fluent-bit/db/tail.db"
+DEFAULT_STORAGE_PATH = "/fluent-bit/storage"
+DOCKER_METADATA_SCRIPT_PATH = "/fluent-bit/etc/docker-metadata.lua"
+DOCKER_CONFIG_FILE_NAME = "config.v2.json"
+UPSTREAM_CONF_PATH = "/fluent-bit/etc/upstream.conf"
+
+# Allowed values for CONTAINER_FILTER_MODE and CONTAINER_RESOLVER
+CONTAINER_FILTER_MODES = ('grep', 'path')
+CONTAINER_RESOLVERS = ('disk', 'socket')
+
+# Allowed values for the tail offsets database settings
+TAIL_DB_SYNC_MODES = ('extra', 'full', 'normal', 'off')
+TAIL_DB_JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+BOOLEAN_VALUES = ('true', 'false')
+
+# Allowed values for BUFFERING_MODE and STORAGE_SYNC
+BUFFERING_MODES = ('memory', 'filesystem')
+STORAGE_SYNC_MODES = ('normal', 'full')
+
+# Settings each PERFORMANCE_PROFILE expands to. balanced keeps Fluent Bit's defaults;
+# any setting can be overridden by its own environment variable.
+PERFORMANCE_PROFILES = {
+    'low-latency': {
+        'flush_interval': '0.2',
+        'buffer_chunk_size': '32k',
+        'buffer_max_size': '64k',
+        'refresh_interval': '5',
+        'rotate_wait': '5',
+        'output_workers': '',
+    },
+    'balanced': {
+        'flush_interval': '1',
+        'buffer_chunk_size': '32k',
+        'buffer_max_size': '32k',
+        'refresh_interval': '60',
+        'rotate_wait': '5',
+        'output_workers': '',
+    },
+    'high-throughput': {
+        'flush_interval': '5',
+        'buffer_chunk_size': '256k',
+        'buffer_max_size': '1M',
+        'refresh_interval': '60',
+        'rotate_wait': '15',
+        'output_workers': '2',
+    },
+}
+
+# SCALING_MODE auto sizes the tail inputs to the number of log files found at startup.
+# Each tier applies from its minimum number of files: the refresh interval is raised to
+# rescan the paths less often, and the rotate wait lowered so rotated files are closed sooner.
+SCALING_MODES = ('off', 'auto')
+SCALING_TIERS = (
+    (5000, {'refresh_interval': 60, 'rotate_wait': 5}),
+    (1000, {'refresh_interval': 30, 'rotate_wait': 5}),
+    (200, {'refresh_interval': 10}),
+)
+MAX_TAIL_INPUTS = 16
+INOTIFY_MAX_WATCHES_PATH = "/proc/sys/fs/inotify/max_user_watches"
+# File descriptors Fluent Bit needs besides the log files (sockets, storage chunks, DB)
+OPEN_FILES_HEADROOM = 256
+
+# Parser used by the tail input for each JSON_DECODE_MODE. docker_plain skips decoding
+# the log field as JSON; selective picks one of them per container.
+JSON_DECODE_MODES = ('always', 'never', 'selective')
+JSON_DECODE_PARSER = 'docker'
+PLAIN_TEXT_PARSER = 'docker_plain'
+
+# Defaults of the per-container rules in MULTILINE_RULES
+MULTILINE_RULE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+DEFAULT_MULTILINE_FLUSH_TIMEOUT_MS = 1000
+DEFAULT_MULTILINE_BUFFER_LIMIT = '10M'
+
+# Matches a RATE_LIMIT value: rate:burst:action, where action is drop, tag or sample:N
+RATE_LIMIT_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?):(\d+):(drop|tag|sample:(\d+))\s*$')
+RATE_LIMIT_SELECTORS = ('container', 'image')
+
+# Operations of the FIELD_PROJECTION entries
+FIELD_PROJECTION_OPERATIONS = ('drop', 'rename', 'keep')
+FIELD_NAME_PATTERN = re.compile(r'^[^\s=;,]+$')
+
+# Output shards and process shards split the tag space by the first hex digit of the container ID
+MAX_OUTPUT_SHARDS = 16
+MAX_PROCESS_SHARDS = 16
+CONTAINER_ID_DIGITS = '0123456789abcdef'
+
+# OUTPUT_ENGINE plugin ships with the Logz.io Go plugin, native with Fluent Bit's http output
+OUTPUT_ENGINES = ('plugin', 'native')
+OUTPUT_COMPRESSION_MODES = ('gzip', 'none')
+DEFAULT_USER_AGENT = 'logzio-docker-collector-logs'
+
+# Priority routing: matching records are retagged with this prefix and shipped by their own output
+PRIORITY_TAG_PREFIX = 'priority.'
+PRIORITY_EMITTER_NAME = 'priority_emitter'
+
+# Backfill: history is read by separate tail inputs, tagged with this prefix and shipped by
+# their own output, while the live inputs start where the history ended
+BACKFILL_MODES = ('off', 'on')
+DEFAULT_BACKFILL_SNAPSHOT_PATH = "/fluent-bit/db/backfill.snapshot"
+BACKFILL_TAG_PREFIX = 'docker.backfill.'
+BACKFILL_PATH_KEY = 'backfill_path'
+BACKFILL_OFFSET_KEY = 'backfill_offset'
+DURATION_PATTERN = re.compile(r'^(\d+)([smhd]?)$')
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Roles: a standalone collector ships its records to Logz.io. An agent tails, filters and
+# enriches, then forwards its records to aggregators, which ship the records of every agent.
+ROLES = ('standalone', 'agent', 'aggregator')
+DEFAULT_FORWARD_PORT = '24224'
+UPSTREAM_NAME = 'aggregators'
+# Tag an agent forwards the records of each kind of output with, so the aggregator ships each
+# kind with its own output. Records of all containers share a tag, so they are batched together.
+FORWARD_TAGS = {'live': 'forward.live', 'priority': 'forward.priority', 'backfill': 'forward.backfill'}
+FORWARD_TLS_MODES = ('off', 'on')
+LOOPBACK_ADDRESSES = ('localhost', '::1')
+
+# Partial lines: Docker's json-file driver splits lines longer than 16KB into fragments. A
+# fragment JSON-escaped into a log file line can take twice its size, so the tail buffer has
+# to hold at least this much for every fragment to be read.
+PARTIAL_LINE_BUFFER_MAX_SIZE = '64k'
+# A dummy input sends a record with this tag every second, on which the partial lines whose next
+# fragment never came are shipped. They carry their own tag in PARTIAL_TAG_KEY and are retagged.
+PARTIAL_LINE_HEARTBEAT_TAG = 'docker.partial_lines.heartbeat'
+PARTIAL_TAG_KEY = 'partial_tag'
+PARTIAL_LINE_EMITTER_NAME = 'partial_lines_emitter'
+
+# Regex check: the user patterns run on every record are analyzed and timed before Fluent Bit starts
+REGEX_CHECK_MODES = ('strict', 'warn', 'off')
+# Setting the pattern of a grep or rewrite_tag rule comes from, by rule and field
+PATTERN_SETTINGS = {
+    ('Regex', 'log'): 'INCLUDE_LINE',
+    ('Exclude', 'log'): 'EXCLUDE_LINES',
+    ('Regex', 'docker_container_name'): 'MATCH_CONTAINER_NAME',
+    ('Exclude', 'docker_container_name'): 'SKIP_CONTAINER_NAMES',
+    ('Regex', 'docker_container_image'): 'MATCH_IMAGE_NAME',
+    ('Exclude', 'docker_container_image'): 'SKIP_IMAGE_NAMES',
+    ('Rule', '$message'): 'PRIORITY_PATTERNS',
+    ('Rule', '$docker_container_name'): 'PRIORITY_CONTAINERS',
+}
+
+# Matches Fluent Bit size values such as 512k, 5M or 1G
+SIZE_PATTERN = re.compile(r'^(\d+)\s*([kmg]?)b?$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
 
 
 # Configuration object to store environment variables
 class Config:
     def __init__(self):
         # Environment variables
+        self.role = os.getenv('ROLE', 'standalone')
+        self.aggregator_hosts = os.getenv('AGGREGATOR_HOSTS', '')
+        self.forward_listen = os.getenv('FORWARD_LISTEN', '0.0.0.0')
+        self.forward_port = os.getenv('FORWARD_PORT', DEFAULT_FORWARD_PORT)
+        self.forward_shared_key = os.getenv('FORWARD_SHARED_KEY', '')
+        self.forward_self_hostname = os.getenv('FORWARD_SELF_HOSTNAME', socket.gethostname())
+        self.forward_tls = os.getenv('FORWARD_TLS', 'off')
+        self.forward_tls_ca_file = os.getenv('FORWARD_TLS_CA_FILE', '')
+        self.forward_tls_crt_file = os.getenv('FORWARD_TLS_CRT_FILE', '')
+        self.forward_tls_key_file = os.getenv('FORWARD_TLS_KEY_FILE', '')
         self.log_level = os.getenv('LOG_LEVEL', 'info')
         self.read_from_head = os.getenv('READ_FROM_HEAD', 'true')
         self.ignore_older = os.getenv('IGNORE_OLDER', '')
@@ -28,7 +194,77 @@ class Config:
         self.headers = os.getenv('HEADERS', '')
         self.multiline_start_state_rule = os.getenv('MULTILINE_START_STATE_RULE', '')
         self.multiline_custom_rules = os.getenv('MULTILINE_CUSTOM_RULES', '')
+        self.multiline_rules = os.getenv('MULTILINE_RULES', '')
         self.logs_path = os.getenv('LOGS_PATH', '/var/lib/docker/containers/*/*.log')
+        self.scaling_mode = os.getenv('SCALING_MODE', 'off')
+        self.scaling_files_per_input = os.getenv('SCALING_FILES_PER_INPUT', '1000')
+        self.container_filter_mode = os.getenv('CONTAINER_FILTER_MODE', 'grep')
+        self.container_resolver = os.getenv('CONTAINER_RESOLVER', 'disk')
+        self.docker_containers_dir = os.getenv('DOCKER_CONTAINERS_DIR', '/var/lib/docker/containers')
+        self.docker_socket = os.getenv('DOCKER_SOCKET', docker_api.DEFAULT_DOCKER_SOCKET)
+        self.filter_refresh_interval = os.getenv('FILTER_REFRESH_INTERVAL', '30')
+        self.filter_plan_debug = os.getenv('FILTER_PLAN_DEBUG', 'false')
+        self.tail_db_path = os.getenv('TAIL_DB_PATH', '')
+        self.tail_db_sync = os.getenv('TAIL_DB_SYNC', 'normal')
+        self.tail_db_locking = os.getenv('TAIL_DB_LOCKING', 'false')
+        self.tail_db_journal_mode = os.getenv('TAIL_DB_JOURNAL_MODE', 'wal')
+        # An aggregator holds the records of many agents, so it buffers them on disk by default
+        self.buffering_mode = os.getenv('BUFFERING_MODE', 'filesystem' if self.role == 'aggregator' else 'memory')
+        self.storage_path = os.getenv('STORAGE_PATH', DEFAULT_STORAGE_PATH)
+        self.storage_sync = os.getenv('STORAGE_SYNC', 'normal')
+        self.storage_backlog_mem_limit = os.getenv('STORAGE_BACKLOG_MEM_LIMIT', '5M')
+        self.storage_max_chunks_up = os.getenv('STORAGE_MAX_CHUNKS_UP', '64')
+        self.storage_total_limit_size = os.getenv('STORAGE_TOTAL_LIMIT_SIZE', '1G')
+        self.mem_buf_limit = os.getenv('MEM_BUF_LIMIT', '')
+        self.json_decode_mode = os.getenv('JSON_DECODE_MODE', 'always')
+        self.json_decode_containers = os.getenv('JSON_DECODE_CONTAINERS', '')
+        self.json_decode_images = os.getenv('JSON_DECODE_IMAGES', '')
+        self.rate_limit = os.getenv('RATE_LIMIT', '')
+        self.rate_limit_rules = os.getenv('RATE_LIMIT_RULES', '')
+        self.log_dedup = os.getenv('LOG_DEDUP', 'false')
+        self.log_dedup_window_sec = os.getenv('LOG_DEDUP_WINDOW_SEC', '10')
+        self.log_dedup_max_containers = os.getenv('LOG_DEDUP_MAX_CONTAINERS', '4096')
+        self.field_projection = os.getenv('FIELD_PROJECTION', '')
+        self.metrics_enabled = os.getenv('METRICS_ENABLED', 'false')
+        self.metrics_listen = os.getenv('METRICS_LISTEN', '0.0.0.0')
+        self.metrics_port = os.getenv('METRICS_PORT', '2020')
+        # Counter files docker-metadata.lua writes, read by it from the environment
+        self.docker_metadata_metrics_file = os.getenv('DOCKER_METADATA_METRICS_FILE', '')
+        self.rate_limit_metrics_file = os.getenv('RATE_LIMIT_METRICS_FILE', '')
+        self.health_check_errors_count = os.getenv('HEALTH_CHECK_ERRORS_COUNT', '5')
+        self.health_check_retry_failure_count = os.getenv('HEALTH_CHECK_RETRY_FAILURE_COUNT', '5')
+        self.health_check_period = os.getenv('HEALTH_CHECK_PERIOD', '60')
+        # An aggregator ships the records of many agents in large batches over several connections
+        self.performance_profile = os.getenv('PERFORMANCE_PROFILE',
+                                             'high-throughput' if self.role == 'aggregator' else 'balanced')
+        self.flush_interval = os.getenv('FLUSH_INTERVAL', '')
+        self.buffer_chunk_size = os.getenv('BUFFER_CHUNK_SIZE', '')
+        self.buffer_max_size = os.getenv('BUFFER_MAX_SIZE', '')
+        self.refresh_interval = os.getenv('REFRESH_INTERVAL', '')
+        self.rotate_wait = os.getenv('ROTATE_WAIT', '')
+        self.output_workers = os.getenv('OUTPUT_WORKERS', '')
+        self.output_shards = os.getenv('OUTPUT_SHARDS', '1')
+        self.shards = os.getenv('SHARDS', '1')
+        # First hex digits of the container IDs a shard process owns, all containers when empty
+        self.container_id_prefixes = ''
+        self.output_engine = os.getenv('OUTPUT_ENGINE', 'plugin')
+        self.output_compress = os.getenv('OUTPUT_COMPRESS', 'gzip')
+        self.output_retry_limit = os.getenv('OUTPUT_RETRY_LIMIT', '')
+        self.priority_patterns = os.getenv('PRIORITY_PATTERNS', '')
+        self.priority_containers = os.getenv('PRIORITY_CONTAINERS', '')
+        self.priority_retry_limit = os.getenv('PRIORITY_RETRY_LIMIT', '2')
+        self.priority_mem_buf_limit = os.getenv('PRIORITY_MEM_BUF_LIMIT', '10M')
+        self.backfill_mode = os.getenv('BACKFILL_MODE', 'off')
+        self.backfill_rate = os.getenv('BACKFILL_RATE', '1M')
+        self.backfill_ignore_older = os.getenv('BACKFILL_IGNORE_OLDER', '')
+        self.backfill_snapshot_file = os.getenv('BACKFILL_SNAPSHOT_FILE', DEFAULT_BACKFILL_SNAPSHOT_PATH)
+        # Whether some log file still has history to backfill, set by prepare_backfill
+        self.backfill_active = False
+        self.reassemble_partial_lines = os.getenv('REASSEMBLE_PARTIAL_LINES', 'false')
+        self.max_event_size = os.getenv('MAX_EVENT_SIZE', '1M')
+        self.partial_line_timeout_sec = os.getenv('PARTIAL_LINE_TIMEOUT_SEC', '5')
+        self.regex_check = os.getenv('REGEX_CHECK', 'strict')
+        self.regex_line_budget_ms = os.getenv('REGEX_LINE_BUDGET_MS', '50')
 
 
 def create_fluent_bit_config(config):
@@ -43,151 +279,952 @@ def create_fluent_bit_config(config):
     if config.include_line and config.exclude_lines:
         raise ValueError("Cannot use both INCLUDE_LINE and EXCLUDE_LINES")
 
-    # Generate the Fluent Bit configuration by combining config blocks
+    if config.container_filter_mode not in CONTAINER_FILTER_MODES:
+        raise ValueError(f"CONTAINER_FILTER_MODE must be one of: {', '.join(CONTAINER_FILTER_MODES)}")
+
+    if config.container_resolver not in CONTAINER_RESOLVERS:
+        raise ValueError(f"CONTAINER_RESOLVER must be one of: {', '.join(CONTAINER_RESOLVERS)}")
+
+    if config.json_decode_mode not in JSON_DECODE_MODES:
+        raise ValueError(f"JSON_DECODE_MODE must be one of: {', '.join(JSON_DECODE_MODES)}")
+
+    if config.json_decode_mode == 'selective' and not (config.json_decode_containers or config.json_decode_images):
+        raise ValueError("JSON_DECODE_MODE selective requires JSON_DECODE_CONTAINERS or JSON_DECODE_IMAGES")
+
+    if config.multiline_rules and config.multiline_start_state_rule:
+        raise ValueError("Cannot use both MULTILINE_RULES and MULTILINE_START_STATE_RULE")
+
+    parse_multiline_rules(config)
+
+    if not config.filter_refresh_interval.isdigit() or int(config.filter_refresh_interval) < 1:
+        raise ValueError("FILTER_REFRESH_INTERVAL must be a positive number of seconds")
+
+    _validate_tail_db_config(config)
+    _validate_buffering_config(config)
+    _validate_performance_settings(config)
+    _validate_scaling_config(config)
+    _validate_metrics_config(config)
+    _validate_rate_limit_config(config)
+    _validate_dedup_config(config)
+    _validate_partial_lines_config(config)
+    parse_field_projection(config)
+    _validate_output_config(config)
+    _validate_priority_config(config)
+    _validate_shards_config(config)
+    _validate_backfill_config(config)
+    _validate_role_config(config)
+    _validate_regex_check_config(config)
+    check_regex_costs(config)
+    prepare_backfill(config)
+
+    # Generate the Fluent Bit configuration by combining config blocks. An aggregator receives
+    # records the agents already filtered and enriched.
     fluent_bit_config = _get_service_config(config)
-    fluent_bit_config += _get_input_config(config)
-    fluent_bit_config += _get_lua_filter()
-    fluent_bit_config += generate_filters(config)
-    fluent_bit_config += _get_modify_filters(config)
+    if config.role == 'aggregator':
+        fluent_bit_config += _get_forward_input_config(config)
+    else:
+        fluent_bit_config += _get_input_config(config)
+        fluent_bit_config += generate_filters(config)
     fluent_bit_config += _get_output_config(config)
     return fluent_bit_config
 
 
+def get_performance_settings(config):
+    # Settings of the selected profile, with the ones set in the environment taking precedence
+    settings = dict(PERFORMANCE_PROFILES.get(config.performance_profile, PERFORMANCE_PROFILES['balanced']))
+    for name in settings:
+        if getattr(config, name):
+            settings[name] = getattr(config, name)
+    buffer_max_size = parse_size(settings['buffer_max_size'])
+    if config.reassemble_partial_lines.lower() == 'true' and buffer_max_size is not None and \
+            buffer_max_size < parse_size(PARTIAL_LINE_BUFFER_MAX_SIZE):
+        settings['buffer_max_size'] = PARTIAL_LINE_BUFFER_MAX_SIZE
+    return settings
+
+
+def _is_positive_number(value):
+    try:
+        return float(value) > 0
+    except ValueError:
+        return False
+
+
+def _validate_performance_settings(config):
+    if config.performance_profile not in PERFORMANCE_PROFILES:
+        raise ValueError(f"PERFORMANCE_PROFILE must be one of: {', '.join(PERFORMANCE_PROFILES)}")
+
+    settings = get_performance_settings(config)
+    if not _is_positive_number(settings['flush_interval']):
+        raise ValueError("FLUSH_INTERVAL must be a positive number of seconds")
+    for name in ('refresh_interval', 'rotate_wait'):
+        if not settings[name].isdigit() or int(settings[name]) < 1:
+            raise ValueError(f"{name.upper()} must be a positive number of seconds")
+    for name in ('buffer_chunk_size', 'buffer_max_size'):
+        if not parse_size(settings[name]):
+            raise ValueError(f"{name.upper()} must be a size such as 32k")
+    if parse_size(settings['buffer_max_size']) < parse_size(settings['buffer_chunk_size']):
+        raise ValueError("BUFFER_MAX_SIZE must be at least BUFFER_CHUNK_SIZE")
+
+
 def _get_service_config(config):
-    return f"""
+    settings = get_performance_settings(config)
+    service_config = f"""
 [SERVICE]
     Parsers_File parsers.conf
     Parsers_File parsers_multiline.conf
-    Flush        1
+    Flush        {settings['flush_interval']}
     Daemon       Off
     Log_Level    {config.log_level}
 """
+    if config.metrics_enabled.lower() == 'true':
+        service_config += _get_metrics_service_config(config)
+    if config.buffering_mode == 'filesystem':
+        service_config += f"""    storage.path {config.storage_path}
+    storage.sync {config.storage_sync}
+    storage.checksum off
+    storage.backlog.mem_limit {config.storage_backlog_mem_limit}
+    storage.max_chunks_up {config.storage_max_chunks_up}
+"""
+    return service_config
+
+
+def _validate_metrics_config(config):
+    if config.metrics_enabled.lower() not in BOOLEAN_VALUES:
+        raise ValueError("METRICS_ENABLED must be true or false")
+    if config.metrics_enabled.lower() != 'true':
+        return
+    if not config.metrics_port.isdigit() or not 1 <= int(config.metrics_port) <= 65535:
+        raise ValueError("METRICS_PORT must be a port number")
+    for name, value in (('HEALTH_CHECK_ERRORS_COUNT', config.health_check_errors_count),
+                        ('HEALTH_CHECK_RETRY_FAILURE_COUNT', config.health_check_retry_failure_count),
+                        ('HEALTH_CHECK_PERIOD', config.health_check_period)):
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError(f"{name} must be a positive number")
+
+
+def _get_metrics_service_config(config):
+    # HTTP server exposing Prometheus metrics on /api/v1/metrics/prometheus, storage and
+    # backlog metrics on /api/v1/storage, and /api/v1/health, which fails once more than
+    # HC_Errors_Count output errors or HC_Retry_Failure_Count failed retries happen in HC_Period
+    return f"""    HTTP_Server  On
+    HTTP_Listen  {config.metrics_listen}
+    HTTP_Port    {config.metrics_port}
+    Health_Check On
+    HC_Errors_Count {config.health_check_errors_count}
+    HC_Retry_Failure_Count {config.health_check_retry_failure_count}
+    HC_Period {config.health_check_period}
+    storage.metrics on
+"""
+
+
+def parse_size(value):
+    # Convert a Fluent Bit size value to bytes, or return None if it is not one
+    match = SIZE_PATTERN.match(value.strip())
+    if not match:
+        return None
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
+
+def _validate_buffering_config(config):
+    if config.buffering_mode not in BUFFERING_MODES:
+        raise ValueError(f"BUFFERING_MODE must be one of: {', '.join(BUFFERING_MODES)}")
+    if config.mem_buf_limit and parse_size(config.mem_buf_limit) is None:
+        raise ValueError("MEM_BUF_LIMIT must be a size such as 32M")
+    if config.buffering_mode != 'filesystem':
+        return
+
+    if not os.path.isabs(config.storage_path):
+        raise ValueError("STORAGE_PATH must be an absolute path")
+    if config.storage_sync not in STORAGE_SYNC_MODES:
+        raise ValueError(f"STORAGE_SYNC must be one of: {', '.join(STORAGE_SYNC_MODES)}")
+    for name, value in (('STORAGE_BACKLOG_MEM_LIMIT', config.storage_backlog_mem_limit),
+                        ('STORAGE_TOTAL_LIMIT_SIZE', config.storage_total_limit_size)):
+        if parse_size(value) is None:
+            raise ValueError(f"{name} must be a size such as 5M")
+    if not config.storage_max_chunks_up.isdigit() or int(config.storage_max_chunks_up) < 1:
+        raise ValueError("STORAGE_MAX_CHUNKS_UP must be a positive number")
+
+
+def _validate_scaling_config(config):
+    if config.scaling_mode not in SCALING_MODES:
+        raise ValueError(f"SCALING_MODE must be one of: {', '.join(SCALING_MODES)}")
+    if not config.scaling_files_per_input.isdigit() or int(config.scaling_files_per_input) < 1:
+        raise ValueError("SCALING_FILES_PER_INPUT must be a positive number")
+
+
+def count_log_files(config):
+    return sum(len(glob.glob(path.strip())) for path in config.logs_path.split(',') if path.strip())
+
+
+def _read_inotify_max_watches():
+    try:
+        with open(INOTIFY_MAX_WATCHES_PATH) as file:
+            return int(file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _check_open_file_limit(files):
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit != resource.RLIM_INFINITY and files + OPEN_FILES_HEADROOM > soft_limit:
+        print(f"Warning: Found {files} log files but the open file limit is {soft_limit}. "
+              f"Raise it, for example with docker run --ulimit nofile={files * 2 + OPEN_FILES_HEADROOM}.")
+
+
+def get_scaling_settings(config):
+    # Tail settings fitted to the number of log files LOGS_PATH matches, or None when
+    # SCALING_MODE is off. Settings set in the environment are kept as they are.
+    if config.scaling_mode != 'auto':
+        return None
+    files = count_log_files(config)
+    settings = get_performance_settings(config)
+    scaling = {
+        'files': files,
+        'refresh_interval': settings['refresh_interval'],
+        'rotate_wait': settings['rotate_wait'],
+        'inotify_watcher': True,
+    }
+    for min_files, tier in SCALING_TIERS:
+        if files < min_files:
+            continue
+        if not config.refresh_interval:
+            scaling['refresh_interval'] = str(max(int(settings['refresh_interval']), tier['refresh_interval']))
+        if 'rotate_wait' in tier and not config.rotate_wait:
+            scaling['rotate_wait'] = str(min(int(settings['rotate_wait']), tier['rotate_wait']))
+        break
+
+    # Every tailed file takes an inotify watch; leave half of the host's watches to other processes
+    max_watches = _read_inotify_max_watches()
+    if max_watches is not None and files > max_watches // 2:
+        scaling['inotify_watcher'] = False
+
+    inputs = min(MAX_TAIL_INPUTS, max(1, math.ceil(files / int(config.scaling_files_per_input))))
+    scaling['paths'] = split_logs_path(config, inputs)
+    _check_open_file_limit(files)
+    return scaling
+
+
+def split_logs_path(config, inputs):
+    # Split LOGS_PATH into one glob per group of container ID prefixes. Only paths rooted at
+    # the containers directory can be split; other paths are tailed by a single input.
+    containers_prefix = config.docker_containers_dir.rstrip('/') + '/*/'
+    if inputs == 1 or not config.logs_path.startswith(containers_prefix) or ',' in config.logs_path:
+        return [config.logs_path]
+    file_pattern = config.logs_path[len(containers_prefix):]
+    return [config.docker_containers_dir.rstrip('/') + f"/[{digits}]*/" + file_pattern
+            for digits in split_container_id_prefixes(inputs)]
+
+
+def _get_tail_performance_config(config, scaling=None):
+    settings = get_performance_settings(config)
+    if scaling:
+        settings['refresh_interval'] = scaling['refresh_interval']
+        settings['rotate_wait'] = scaling['rotate_wait']
+    tail_config = f"""    Buffer_Chunk_Size {settings['buffer_chunk_size']}
+    Buffer_Max_Size {settings['buffer_max_size']}
+    Refresh_Interval {settings['refresh_interval']}
+    Rotate_Wait {settings['rotate_wait']}
+"""
+    if scaling and not scaling['inotify_watcher']:
+        tail_config += "    Inotify_Watcher false\n"
+    return tail_config
+
+
+def _get_input_buffering_config(config, multiline_rule=None):
+    input_config = ""
+    if config.buffering_mode == 'filesystem':
+        input_config += "    storage.type filesystem\n"
+    # A multiline rule's input has its own cap on the records it buffers. It does not cap the
+    # group the multiline parser is still joining, which flush_timeout bounds in time only.
+    mem_buf_limit = multiline_rule['buffer_limit'] if multiline_rule else config.mem_buf_limit
+    if mem_buf_limit:
+        input_config += f"    Mem_Buf_Limit {mem_buf_limit}\n"
+    return input_config
 
 
 def _get_input_config(config):
-    if config.multiline_start_state_rule:
-        input_config = f"""
+    scaling = get_scaling_settings(config)
+    tail_inputs = []
+    for path, exclude_path, parser, multiline_rule in get_tail_inputs(config):
+        # Only the input tailing LOGS_PATH is split; the others list their containers' files
+        if scaling and path == config.logs_path:
+            tail_inputs += [(split_path, exclude_path, parser, multiline_rule) for split_path in scaling['paths']]
+        else:
+            tail_inputs.append((path, exclude_path, parser, multiline_rule))
+
+    input_config = ""
+    for path, exclude_path, parser, multiline_rule in tail_inputs:
+        # With backfill, the live inputs start at the offsets seeded in their database, and read
+        # the files created since the snapshot from their start
+        read_from_head = 'true' if config.backfill_mode == 'on' else config.read_from_head
+        if multiline_rule or config.multiline_start_state_rule:
+            multiline_parser = f"multiline-{multiline_rule['name']}" if multiline_rule else "multiline-regex"
+            input_config += f"""
 [INPUT]
     Name         tail
-    Path         {config.logs_path}
-    Parser       docker
+    Path         {path}
+    Parser       {parser}
     Tag          docker.*
-    read_from_head {config.read_from_head}
-    multiline.parser multiline-regex
+    read_from_head {read_from_head}
+    multiline.parser {multiline_parser}
 """
-    else:
+        else:
 
-        input_config = f"""
+            input_config += f"""
 [INPUT]
     Name         tail
-    Path         {config.logs_path}
-    Parser       docker
+    Path         {path}
+    Parser       {parser}
     Tag          docker.*
 """
-    if config.ignore_older:
-        input_config += f"    ignore_older {config.ignore_older}\n"
+            # In path mode and selective JSON decoding, a container's files join an input only when
+            # the config is re-rendered, so they are read from their start. The offsets database
+            # keeps the files it tracks from being read again.
+            if get_tail_db_path(config):
+                input_config += f"    read_from_head {read_from_head}\n"
+        if exclude_path:
+            input_config += f"    Exclude_Path {exclude_path}\n"
+        input_config += _get_tail_performance_config(config, scaling)
+        input_config += _get_tail_db_config(config)
+        input_config += _get_input_buffering_config(config, multiline_rule)
+        if config.ignore_older:
+            input_config += f"    ignore_older {config.ignore_older}\n"
+    input_config += _get_partial_lines_heartbeat_input(config)
+
+    if config.backfill_active:
+        mem_buf_limit = get_backfill_mem_buf_limit(config, len(tail_inputs))
+        for path, exclude_path, parser, multiline_rule in tail_inputs:
+            input_config += _get_backfill_input_config(config, path, exclude_path, parser, multiline_rule,
+                                                       scaling, mem_buf_limit)
     return input_config
 
 
-def _get_lua_filter():
-    return """
-[FILTER]
-    Name         lua
-    Match        docker.*
-    script       /fluent-bit/etc/docker-metadata.lua
-    call         enrich_with_docker_metadata
+def _get_backfill_input_config(config, path, exclude_path, parser, multiline_rule, scaling, mem_buf_limit):
+    # Reads the same files as a live input from their start, with its own offsets database.
+    # The backfill_cutoff filter keeps the lines before the cut recorded in the snapshot.
+    # Its records stay in memory so Mem_Buf_Limit caps how fast it reads.
+    input_config = f"""
+[INPUT]
+    Name         tail
+    Path         {path}
+    Parser       {parser}
+    Tag          {BACKFILL_TAG_PREFIX}*
+    read_from_head true
 """
+    if multiline_rule or config.multiline_start_state_rule:
+        multiline_parser = f"multiline-{multiline_rule['name']}" if multiline_rule else "multiline-regex"
+        input_config += f"    multiline.parser {multiline_parser}\n"
+    input_config += f"    Path_Key     {BACKFILL_PATH_KEY}\n"
+    input_config += f"    Offset_Key   {BACKFILL_OFFSET_KEY}\n"
+    if exclude_path:
+        input_config += f"    Exclude_Path {exclude_path}\n"
+    input_config += _get_tail_performance_config(config, scaling)
+    input_config += _get_tail_db_config(config, get_backfill_db_path(config))
+    input_config += f"    Mem_Buf_Limit {mem_buf_limit}\n"
+    ignore_older = get_backfill_ignore_older(config)
+    if ignore_older:
+        input_config += f"    ignore_older {ignore_older}\n"
+    return input_config
 
 
-def generate_filters(config):
-    filters = ""
-    # Add filters based on container and image names
-    if any([config.match_container_name, config.skip_container_names, config.match_image_name,
-            config.skip_image_names]):
-        filters += """
-[FILTER]
-    Name         nest
-    Match        *
-    Operation    lift
-    Nested_under _source
-"""
-    # Match container names
-    if config.match_container_name:
-        filters += """
-[FILTER]
-    Name    grep
-    Match   *
-"""
-        filters += f"    Regex docker_container_name {config.match_container_name.strip()}\n"
+def _validate_tail_db_config(config):
+    if config.tail_db_path and not os.path.isabs(config.tail_db_path):
+        raise ValueError("TAIL_DB_PATH must be an absolute path")
+    if config.tail_db_sync.lower() not in TAIL_DB_SYNC_MODES:
+        raise ValueError(f"TAIL_DB_SYNC must be one of: {', '.join(TAIL_DB_SYNC_MODES)}")
+    if config.tail_db_locking.lower() not in BOOLEAN_VALUES:
+        raise ValueError("TAIL_DB_LOCKING must be true or false")
+    if config.tail_db_journal_mode.lower() not in TAIL_DB_JOURNAL_MODES:
+        raise ValueError(f"TAIL_DB_JOURNAL_MODE must be one of: {', '.join(TAIL_DB_JOURNAL_MODES)}")
 
-    # Skip container names
-    if config.skip_container_names:
-        names = config.skip_container_names.split(',')
-        filters += """
-[FILTER]
-    Name    grep
-    Match   *
-"""
-        for name in names:
-            filters += f"    Exclude docker_container_name {name.strip()}\n"
 
-    # Match image names
-    if config.match_image_name:
-        filters += """
-[FILTER]
-    Name    grep
-    Match   *
-"""
-        filters += f"    Regex docker_container_image {config.match_image_name.strip()}\n"
+def get_tail_db_path(config):
+    # Offsets must survive the restarts triggered when the set of paths changes in path mode,
+    # and when containers move between inputs in selective JSON decoding or multiline rules
+    if config.tail_db_path:
+        return config.tail_db_path
+    if config.container_filter_mode == 'path' or config.json_decode_mode == 'selective' \
+            or config.multiline_rules or config.backfill_mode == 'on':
+        return DEFAULT_TAIL_DB_PATH
+    return ''
 
-    # Skip image names
-    if config.skip_image_names:
-        images = config.skip_image_names.split(',')
-        filters += """
-[FILTER]
-    Name    grep
-    Match   *
-"""
-        for image in images:
-            filters += f"    Exclude docker_container_image {image.strip()}\n"
 
-    # Include lines based on message content
-    if config.include_line:
-        filters += """
-[FILTER]
-    Name    grep
-    Match   *
+def get_backfill_db_path(config):
+    # Next to the offsets database of the live inputs, or the default one when they have none,
+    # never a path relative to the working directory
+    root, ext = os.path.splitext(get_tail_db_path(config) or DEFAULT_TAIL_DB_PATH)
+    return f"{root}-backfill{ext}"
+
+
+def _get_tail_db_config(config, db_path=None):
+    db_path = db_path or get_tail_db_path(config)
+    if not db_path:
+        return ""
+    return f"""    DB           {db_path}
+    DB.sync      {config.tail_db_sync.lower()}
+    DB.locking   {config.tail_db_locking.lower()}
+    DB.journal_mode {config.tail_db_journal_mode.upper()}
 """
-        filters += f"    Regex message {config.include_line.strip()}\n"
 
-    # Exclude lines based on message content
+
+def parse_duration(value):
+    # Convert a Fluent Bit duration such as 30m or 7d to seconds, or return None if it is not one
+    match = DURATION_PATTERN.match(value.strip())
+    if not match:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def get_backfill_ignore_older(config):
+    return config.backfill_ignore_older or config.ignore_older
+
+
+def _validate_backfill_config(config):
+    if config.backfill_mode not in BACKFILL_MODES:
+        raise ValueError(f"BACKFILL_MODE must be one of: {', '.join(BACKFILL_MODES)}")
+    if config.backfill_mode != 'on':
+        return
+    if not parse_size(config.backfill_rate):
+        raise ValueError("BACKFILL_RATE must be a size per second such as 1M")
+    ignore_older = get_backfill_ignore_older(config)
+    if ignore_older and parse_duration(ignore_older) is None:
+        raise ValueError("BACKFILL_IGNORE_OLDER must be a duration such as 7d")
+    if not os.path.isabs(config.backfill_snapshot_file):
+        raise ValueError("BACKFILL_SNAPSHOT_FILE must be an absolute path")
+    # The snapshot and offsets databases belong to a single process
+    if config.shards != '1':
+        raise ValueError("BACKFILL_MODE cannot be used with SHARDS")
+
+
+def prepare_backfill(config):
+    # Split the history of the log files from their live logs. On the first start, the snapshot
+    # records where the last complete line of each log file ends, and the offsets database of
+    # the live inputs is seeded so they start there; the backfill inputs ship what comes before.
+    # Seeding again on later starts only adds files missing after a crash. Sets
+    # config.backfill_active while some file still has history to backfill.
+    if config.backfill_mode != 'on':
+        return
+    live_db_path = get_tail_db_path(config)
+    entries = backfill.read_snapshot(config.backfill_snapshot_file)
+    if entries is None:
+        path, exclude_path = get_tail_paths(config)
+        ignore_older = get_backfill_ignore_older(config)
+        modified_after = time.time() - parse_duration(ignore_older) if ignore_older else None
+        files = backfill.list_log_files(path, exclude_path, modified_after)
+        entries = backfill.take_snapshot(files, backfill.read_tail_db_offsets(live_db_path))
+        backfill.write_snapshot(config.backfill_snapshot_file, entries)
+        print(f"Backfill: {len(entries)} log files have history to backfill, "
+              f"snapshot written to {config.backfill_snapshot_file}")
+
+    pending = backfill.pending_entries(entries, backfill.read_tail_db_offsets(get_backfill_db_path(config)))
+    backfill.seed_tail_db(live_db_path, pending)
+    config.backfill_active = bool(pending)
+
+
+def get_backfill_mem_buf_limit(config, inputs):
+    # A tail input stops reading while its buffered records reach Mem_Buf_Limit, until they are
+    # flushed, so the backfill inputs read about BACKFILL_RATE bytes per flush interval at most
+    flush_interval = float(get_performance_settings(config)['flush_interval'])
+    limit = int(parse_size(config.backfill_rate) * flush_interval) // inputs
+    return max(limit, parse_size(get_performance_settings(config)['buffer_max_size']))
+
+
+# Container info read from disk, keyed by config file path, with the mtime and size it was read at
+_container_info_cache = {}
+
+
+def _read_container_info(config_path):
+    try:
+        stat = os.stat(config_path)
+    except OSError:
+        return None
+    file_key = (stat.st_mtime_ns, stat.st_size)
+    cached = _container_info_cache.get(config_path)
+    if cached and cached[0] == file_key:
+        return cached[1]
+
+    try:
+        with open(config_path, 'r') as file:
+            data = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Skipping unreadable container config '{config_path}': {e}")
+        return None
+
+    info = {
+        'id': data.get('ID') or os.path.basename(os.path.dirname(config_path)),
+        'name': data.get('Name', '').lstrip('/'),
+        'image': (data.get('Config') or {}).get('Image', ''),
+    }
+    _container_info_cache[config_path] = (file_key, info)
+    return info
+
+
+def discover_containers(config):
+    # List the containers on the host with their ID, name and image, limited to the
+    # containers the shard owns when running sharded
+    containers = _list_containers(config)
+    if config.container_id_prefixes:
+        containers = [container for container in containers
+                      if container['id'][:1] in config.container_id_prefixes]
+    return containers
+
+
+def _list_containers(config):
+    if config.container_resolver == 'socket':
+        return docker_api.list_containers(config.docker_socket)
+
+    config_paths = sorted(glob.glob(os.path.join(config.docker_containers_dir, '*', DOCKER_CONFIG_FILE_NAME)))
+    for stale_path in set(_container_info_cache) - set(config_paths):
+        del _container_info_cache[stale_path]
+
+    containers = []
+    for config_path in config_paths:
+        info = _read_container_info(config_path)
+        if info:
+            containers.append(info)
+    return containers
+
+
+def _container_log_glob(config, container_id):
+    # Reuse the file pattern of LOGS_PATH when it is rooted at the containers directory
+    containers_prefix = config.docker_containers_dir.rstrip('/') + '/*/'
+    if config.logs_path.startswith(containers_prefix):
+        return config.docker_containers_dir.rstrip('/') + f"/{container_id}/" + config.logs_path[len(containers_prefix):]
+    return os.path.join(config.docker_containers_dir, container_id, '*.log')
+
+
+def resolve_container_selectors(config, containers):
+    # Split containers into the ones whose logs are shipped and the ones skipped by the selectors
+    match_name = config.match_container_name.strip()
+    match_image = config.match_image_name.strip()
+    skip_names = [name.strip() for name in config.skip_container_names.split(',') if name.strip()]
+    skip_images = [image.strip() for image in config.skip_image_names.split(',') if image.strip()]
+
+    selected, skipped = [], []
+    for container in containers:
+        keep = True
+        if match_name and not re.search(match_name, container['name']):
+            keep = False
+        if match_image and not re.search(match_image, container['image']):
+            keep = False
+        if any(re.search(name, container['name']) for name in skip_names):
+            keep = False
+        if any(re.search(image, container['image']) for image in skip_images):
+            keep = False
+        (selected if keep else skipped).append(container['id'])
+    return selected, skipped
+
+
+def get_tail_paths(config):
+    # Return the tail Path and Exclude_Path for the configured container selectors
+    has_selectors = any([config.match_container_name, config.skip_container_names, config.match_image_name,
+                         config.skip_image_names])
+    if config.container_filter_mode != 'path' or not has_selectors:
+        return config.logs_path, ''
+
+    try:
+        containers = discover_containers(config)
+        selected, skipped = resolve_container_selectors(config, containers)
+    except (OSError, docker_api.DockerAPIError, re.error) as e:
+        print(f"Warning: Could not resolve container selectors to log paths, tailing '{config.logs_path}': {e}")
+        return config.logs_path, ''
+
+    if config.match_container_name or config.match_image_name:
+        if not selected:
+            print(f"Warning: No container matches the selectors yet, tailing '{config.logs_path}'.")
+            return config.logs_path, ''
+        return ','.join(_container_log_glob(config, container_id) for container_id in selected), ''
+
+    return config.logs_path, ','.join(_container_log_glob(config, container_id) for container_id in skipped)
+
+
+def select_json_containers(config, containers):
+    # IDs of the containers whose log lines are decoded as JSON in selective mode
+    names = _split_patterns(config.json_decode_containers)
+    images = _split_patterns(config.json_decode_images)
+    return [container['id'] for container in containers
+            if any(re.search(name, container['name']) for name in names)
+            or any(re.search(image, container['image']) for image in images)]
+
+
+def parse_multiline_rules(config):
+    # Parse MULTILINE_RULES, a JSON list of multiline rules scoped to container names or images
+    if not config.multiline_rules:
+        return []
+    try:
+        rules = json.loads(config.multiline_rules)
+    except ValueError as e:
+        raise ValueError(f"MULTILINE_RULES must be a JSON list of rules: {e}")
+    if not isinstance(rules, list) or not all(isinstance(rule, dict) for rule in rules):
+        raise ValueError("MULTILINE_RULES must be a JSON list of rules")
+
+    parsed_rules = []
+    for rule in rules:
+        name = str(rule.get('name', ''))
+        if not MULTILINE_RULE_NAME_PATTERN.match(name):
+            raise ValueError("Each multiline rule needs a name made of letters, digits, '-' and '_'")
+        if any(parsed_rule['name'] == name for parsed_rule in parsed_rules):
+            raise ValueError(f"Multiline rule '{name}' is defined more than once")
+
+        containers = _split_patterns(str(rule.get('containers', '')))
+        images = _split_patterns(str(rule.get('images', '')))
+        if not containers and not images:
+            raise ValueError(f"Multiline rule '{name}' needs containers or images")
+        for pattern in containers + images:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f"Multiline rule '{name}' has an invalid pattern '{pattern}': {e}")
+
+        if not rule.get('start_state'):
+            raise ValueError(f"Multiline rule '{name}' needs a start_state pattern")
+        cont = rule.get('cont', [])
+        cont = [cont] if isinstance(cont, str) else cont
+
+        flush_timeout = rule.get('flush_timeout', DEFAULT_MULTILINE_FLUSH_TIMEOUT_MS)
+        if isinstance(flush_timeout, bool) or not isinstance(flush_timeout, int) or flush_timeout < 1:
+            raise ValueError(f"Multiline rule '{name}' flush_timeout must be a positive number of milliseconds")
+        buffer_limit = str(rule.get('buffer_limit', DEFAULT_MULTILINE_BUFFER_LIMIT))
+        if parse_size(buffer_limit) is None:
+            raise ValueError(f"Multiline rule '{name}' buffer_limit must be a size such as 10M")
+
+        parsed_rules.append({
+            'name': name,
+            'containers': containers,
+            'images': images,
+            'start_state': str(rule['start_state']),
+            'cont': [str(pattern) for pattern in cont],
+            'flush_timeout': flush_timeout,
+            'buffer_limit': buffer_limit,
+        })
+    return parsed_rules
+
+
+def match_multiline_rule(rules, container):
+    # The first rule matching the container's name or image, if any
+    for rule in rules:
+        if any(re.search(name, container['name']) for name in rule['containers']) or \
+                any(re.search(image, container['image']) for image in rule['images']):
+            return rule
+    return None
+
+
+def get_tail_inputs(config):
+    # Return the (Path, Exclude_Path, Parser, multiline rule) of each tail input. Containers
+    # that need another parser than the default (selective JSON decoding) or a multiline rule
+    # are grouped into their own inputs, and excluded from the input tailing everything else.
+    path, exclude_path = get_tail_paths(config)
+    default_parser = JSON_DECODE_PARSER if config.json_decode_mode == 'always' else PLAIN_TEXT_PARSER
+    rules = parse_multiline_rules(config)
+    if config.json_decode_mode != 'selective' and not rules:
+        return [(path, exclude_path, default_parser, None)]
+
+    try:
+        containers = discover_containers(config)
+        if config.container_filter_mode == 'path':
+            selected, _ = resolve_container_selectors(config, containers)
+            containers = [container for container in containers if container['id'] in selected]
+        json_ids = select_json_containers(config, containers) if config.json_decode_mode == 'selective' else []
+
+        groups = {}
+        for container in containers:
+            parser = JSON_DECODE_PARSER if container['id'] in json_ids else default_parser
+            rule = match_multiline_rule(rules, container)
+            if parser != default_parser or rule:
+                group = groups.setdefault((parser, rule['name'] if rule else None), (rule, []))
+                group[1].append(container['id'])
+    except (OSError, docker_api.DockerAPIError, re.error) as e:
+        print(f"Warning: Could not resolve the per-container inputs, tailing '{path}' with one input: {e}")
+        # Decode every line as JSON rather than ship the JSON logs of selected containers as text
+        fallback_parser = JSON_DECODE_PARSER if config.json_decode_mode == 'selective' else default_parser
+        return [(path, exclude_path, fallback_parser, None)]
+
+    inputs = []
+    grouped_paths = []
+    for (parser, _), (rule, container_ids) in groups.items():
+        container_paths = ','.join(_container_log_glob(config, container_id) for container_id in container_ids)
+        inputs.append((container_paths, exclude_path, parser, rule))
+        grouped_paths.append(container_paths)
+    default_exclude_path = ','.join(value for value in [exclude_path] + grouped_paths if value)
+    inputs.append((path, default_exclude_path, default_parser, None))
+    return inputs
+
+
+# Matches backreferences, which change meaning when patterns are combined into one alternation
+BACKREFERENCE_PATTERN = re.compile(r'\\[1-9]|\\k<')
+
+
+def merge_patterns(patterns):
+    # Combine patterns into a single alternation, or return None if that would change their meaning
+    if len(patterns) == 1:
+        return patterns[0]
+    if any(BACKREFERENCE_PATTERN.search(pattern) for pattern in patterns):
+        return None
+    return '|'.join(f'(?:{pattern})' for pattern in patterns)
+
+
+def _split_patterns(value):
+    return [pattern.strip() for pattern in value.split(',') if pattern.strip()]
+
+
+def _exclude_rules(key, patterns):
+    # A record is dropped when any Exclude rule matches, so the patterns can share one rule
+    merged = merge_patterns(patterns)
+    if merged is None:
+        return [('Exclude', f'{key} {pattern}') for pattern in patterns]
+    return [('Exclude', f'{key} {merged}')]
+
+
+def _filter_stage(name, match, properties, description):
+    return {'name': name, 'match': match, 'properties': properties, 'description': description}
+
+
+def _get_message_filter_stage(config):
+    # Message filters run on the raw log line before enrichment, while it is still named 'log'
+    if config.include_line:
+        return _filter_stage('grep', '*', [('Regex', f'log {config.include_line.strip()}')],
+                             'keep lines matching INCLUDE_LINE, before enrichment')
     if config.exclude_lines:
-        lines = config.exclude_lines.split(',')
-        filters += """
-[FILTER]
-    Name    grep
-    Match   *
-"""
-        for line in lines:
-            filters += f"    Exclude message {line.strip()}\n"
+        return _filter_stage('grep', '*', _exclude_rules('log', _split_patterns(config.exclude_lines)),
+                             'drop lines matching EXCLUDE_LINES, before enrichment')
+    return None
 
-    return filters
 
+def _validate_rate_limit(name, value):
+    match = RATE_LIMIT_PATTERN.match(value)
+    if not match or float(match.group(1)) <= 0 or int(match.group(2)) < 1 or match.group(4) == '0':
+        raise ValueError(f"{name} must be rate:burst:action with action drop, tag or sample:N, "
+                         f"for example 100:500:drop, not '{value}'")
 
-def _get_modify_filters(config):
-    filters = """
-[FILTER]
-    Name modify
-    Match *
-    Rename log message
+
+def _validate_rate_limit_config(config):
+    if config.rate_limit:
+        _validate_rate_limit('RATE_LIMIT', config.rate_limit)
+    for rule in config.rate_limit_rules.split(';'):
+        if not rule.strip():
+            continue
+        selector, _, rest = rule.strip().partition(':')
+        pattern, _, limit = rest.rpartition('=')
+        if selector not in RATE_LIMIT_SELECTORS or not pattern:
+            raise ValueError(f"RATE_LIMIT_RULES entries must be container:<pattern>=<limit> or "
+                             f"image:<pattern>=<limit>, not '{rule.strip()}'")
+        _validate_rate_limit('RATE_LIMIT_RULES', limit)
+
+
+def _get_rate_limit_filter_stage(config):
+    # Per-container token buckets, ahead of enrichment so records over the limit cost no metadata work
+    if not config.rate_limit and not config.rate_limit_rules.strip():
+        return None
+    return _filter_stage('lua', 'docker.*', [
+        ('script', DOCKER_METADATA_SCRIPT_PATH),
+        ('call', 'rate_limit_records'),
+    ], 'enforce per-container rate limits, before enrichment')
+
+
+def _validate_dedup_config(config):
+    if config.log_dedup.lower() not in BOOLEAN_VALUES:
+        raise ValueError("LOG_DEDUP must be true or false")
+    if config.log_dedup.lower() != 'true':
+        return
+    if not _is_positive_number(config.log_dedup_window_sec):
+        raise ValueError("LOG_DEDUP_WINDOW_SEC must be a positive number of seconds")
+    if not config.log_dedup_max_containers.isdigit() or int(config.log_dedup_max_containers) < 1:
+        raise ValueError("LOG_DEDUP_MAX_CONTAINERS must be a positive number")
+
+
+def _get_dedup_filter_stage(config):
+    # Runs after the rename so it compares the final message of each container
+    if config.log_dedup.lower() != 'true':
+        return None
+    return _filter_stage('lua', 'docker.*', [
+        ('script', DOCKER_METADATA_SCRIPT_PATH),
+        ('call', 'deduplicate_records'),
+    ], 'collapse consecutive identical messages of a container')
+
+
+def _validate_partial_lines_config(config):
+    if config.reassemble_partial_lines.lower() not in BOOLEAN_VALUES:
+        raise ValueError("REASSEMBLE_PARTIAL_LINES must be true or false")
+    if config.reassemble_partial_lines.lower() != 'true':
+        return
+    if not parse_size(config.max_event_size):
+        raise ValueError("MAX_EVENT_SIZE must be a size such as 1M")
+    if not _is_positive_number(config.partial_line_timeout_sec):
+        raise ValueError("PARTIAL_LINE_TIMEOUT_SEC must be a positive number of seconds")
+
+
+def _get_partial_lines_heartbeat_input(config):
+    if config.reassemble_partial_lines.lower() != 'true':
+        return ""
+    return f"""
+[INPUT]
+    Name  dummy
+    Tag   {PARTIAL_LINE_HEARTBEAT_TAG}
+    Dummy {{"heartbeat":true}}
+    Rate  1
 """
+
+
+def _get_partial_lines_filter_stages(config):
+    # Before the message filters, so they see whole lines, and before enrichment, so a line
+    # is enriched once instead of once per fragment. The timed out lines shipped on a heartbeat
+    # re-enter the pipeline with their own tag, and go through every filter of their container.
+    if config.reassemble_partial_lines.lower() != 'true':
+        return []
+    return [
+        _filter_stage('lua', '*', [
+            ('script', DOCKER_METADATA_SCRIPT_PATH),
+            ('call', 'reassemble_partial_lines'),
+        ], 'reassemble lines Docker split into partial lines, and cut events to MAX_EVENT_SIZE'),
+        _filter_stage('rewrite_tag', PARTIAL_LINE_HEARTBEAT_TAG, [
+            ('Rule', f'${PARTIAL_TAG_KEY} ^(.+)$ $1 false'),
+            ('Emitter_Name', PARTIAL_LINE_EMITTER_NAME),
+        ], 'retag partial lines timed out on a heartbeat to their own container'),
+    ]
+
+
+def parse_field_projection(config):
+    # FIELD_PROJECTION holds entries separated by semicolons, applied in order:
+    #  drop:<field>,...          removes fields, a trailing * removes every field with that prefix
+    #  rename:<field>=<new>,...  renames fields
+    #  keep:<field>,...          removes every field not listed
+    # Returns the modify filter rules implementing them.
+    rules = []
+    for entry in config.field_projection.split(';'):
+        if not entry.strip():
+            continue
+        operation, _, fields = entry.strip().partition(':')
+        items = [item.strip() for item in fields.split(',') if item.strip()]
+        if operation not in FIELD_PROJECTION_OPERATIONS or not items:
+            raise ValueError(f"FIELD_PROJECTION entries must be drop:<fields>, rename:<field>=<new name> or "
+                             f"keep:<fields>, not '{entry.strip()}'")
+        for item in items:
+            if operation == 'rename':
+                field, _, new_name = item.partition('=')
+                if not FIELD_NAME_PATTERN.match(field.strip()) or not FIELD_NAME_PATTERN.match(new_name.strip()):
+                    raise ValueError(f"FIELD_PROJECTION renames must be <field>=<new name>, not '{item}'")
+                rules.append(('Rename', f'{field.strip()} {new_name.strip()}'))
+            elif not FIELD_NAME_PATTERN.match(item):
+                raise ValueError(f"FIELD_PROJECTION field names cannot contain spaces or '=', not '{item}'")
+            elif operation == 'drop' and item.endswith('*'):
+                rules.append(('Remove_wildcard', item[:-1]))
+            elif operation == 'drop':
+                rules.append(('Remove', item))
+        if operation == 'keep':
+            # One rule removing every other field; separate Allowlist_key rules would each
+            # remove the fields the others keep
+            kept = '|'.join(re.escape(item) for item in items)
+            rules.append(('Remove_regex', f'^(?!({kept})$)'))
+    return rules
+
+
+def _get_projection_filter_stage(config):
+    # Last, so the fields added by every earlier filter can be projected
+    rules = parse_field_projection(config)
+    if not rules:
+        return None
+    return _filter_stage('modify', '*', rules, 'drop, rename and keep fields as set in FIELD_PROJECTION')
+
+
+def get_priority_rules(config):
+    # rewrite_tag rules retagging the records to ship through the priority output: messages
+    # matching PRIORITY_PATTERNS and records of containers whose name matches PRIORITY_CONTAINERS.
+    # The first matching rule retags a record, so each list can share one rule.
+    rules = []
+    for key, value in (('message', config.priority_patterns), ('docker_container_name', config.priority_containers)):
+        patterns = _split_patterns(value)
+        if not patterns:
+            continue
+        merged = merge_patterns(patterns)
+        for pattern in [merged] if merged is not None else patterns:
+            rules.append(('Rule', f'${key} {pattern} {PRIORITY_TAG_PREFIX}$TAG false'))
+    return rules
+
+
+def priority_routing_enabled(config):
+    return bool(config.priority_patterns.strip() or config.priority_containers.strip())
+
+
+def _validate_priority_config(config):
+    for name, value in (('PRIORITY_PATTERNS', config.priority_patterns),
+                        ('PRIORITY_CONTAINERS', config.priority_containers)):
+        # rewrite_tag splits its rules on spaces
+        if any(re.search(r'\s', pattern) for pattern in _split_patterns(value)):
+            raise ValueError(f"{name} cannot contain spaces, use \\s to match whitespace")
+    if not priority_routing_enabled(config):
+        return
+    retry_limit = config.priority_retry_limit
+    if retry_limit != 'no_limits' and (not retry_limit.isdigit() or int(retry_limit) < 1):
+        raise ValueError("PRIORITY_RETRY_LIMIT must be a positive number or no_limits")
+    if parse_size(config.priority_mem_buf_limit) is None:
+        raise ValueError("PRIORITY_MEM_BUF_LIMIT must be a size such as 10M")
+
+
+def _get_priority_filter_stage(config):
+    # Last, so the records are retagged once every other filter processed them. The retagged
+    # records re-enter the pipeline through the emitter input, with a tag no other filter matches.
+    rules = get_priority_rules(config)
+    if not rules:
+        return None
+    properties = rules + [('Emitter_Name', PRIORITY_EMITTER_NAME),
+                          ('Emitter_Mem_Buf_Limit', config.priority_mem_buf_limit)]
+    if config.buffering_mode == 'filesystem':
+        properties.append(('Emitter_Storage.type', 'filesystem'))
+    # Backfilled records keep their low priority route
+    match = get_live_tag_regex(config) if config.backfill_active else 'docker.*'
+    return _filter_stage('rewrite_tag', match, properties,
+                         'retag records matching PRIORITY_PATTERNS or PRIORITY_CONTAINERS to the priority output')
+
+
+def _get_backfill_filter_stage(config):
+    # First, so the backfilled lines the live inputs ship are dropped before any other work
+    if not config.backfill_active:
+        return None
+    return _filter_stage('lua', f'{BACKFILL_TAG_PREFIX}*', [
+        ('script', DOCKER_METADATA_SCRIPT_PATH),
+        ('call', 'backfill_cutoff'),
+    ], 'keep the backfilled lines from before the live inputs started')
+
+
+def _get_lua_filter_stage():
+    return _filter_stage('lua', 'docker.*', [
+        ('script', DOCKER_METADATA_SCRIPT_PATH),
+        ('call', 'enrich_with_docker_metadata'),
+    ], 'enrich records with container metadata')
+
+
+def _get_container_filter_stages(config):
+    # Fluent Bit 1.9 grep checks its rules in order and stops at the first one that matches: a
+    # matching Exclude drops the record, and a matching Regex keeps it without checking the
+    # rules after it. So the Exclude rules go first, and each Regex selector after the first
+    # gets a filter of its own.
+    excludes = []
+    if config.skip_container_names:
+        excludes += _exclude_rules('docker_container_name', _split_patterns(config.skip_container_names))
+    if config.skip_image_names:
+        excludes += _exclude_rules('docker_container_image', _split_patterns(config.skip_image_names))
+    selectors = []
+    if config.match_container_name:
+        selectors.append(('Regex', f'docker_container_name {config.match_container_name.strip()}'))
+    if config.match_image_name:
+        selectors.append(('Regex', f'docker_container_image {config.match_image_name.strip()}'))
+    if not excludes and not selectors:
+        return []
+    description = 'apply container and image selectors'
+    stages = [_filter_stage('grep', '*', excludes + selectors[:1], description)]
+    stages += [_filter_stage('grep', '*', [selector], description) for selector in selectors[1:]]
+    return stages
+
+
+def _get_modify_filter_stage(config):
+    properties = [('Rename', 'log message')]
     # Add additional fields if specified
     if config.additional_fields:
         fields = config.additional_fields.split(',')
         for field in fields:
             try:
                 key, value = field.split(':', 1)
-                filters += f"    Add {key.strip()} {value.strip()}\n"
+                properties.append(('Add', f'{key.strip()} {value.strip()}'))
             except ValueError:
                 print(f"Warning: Skipping invalid additional field '{field}'. Expected format 'key:value'.")
 
@@ -197,30 +1234,525 @@ def _get_modify_filters(config):
         for field in fields:
             try:
                 key, value = field.split(':', 1)
-                filters += f"    Set {key.strip()} {value.strip()}\n"
+                properties.append(('Set', f'{key.strip()} {value.strip()}'))
             except ValueError:
                 print(f"Warning: Skipping invalid set field '{field}'. Expected format 'key:value'.")
 
+    return _filter_stage('modify', '*', properties, 'rename log to message and add configured fields')
+
+
+def build_filter_plan(config):
+    # Order the filters so that records are dropped as early and as cheaply as possible
+    stages = [
+        _get_backfill_filter_stage(config),
+        *_get_partial_lines_filter_stages(config),
+        _get_message_filter_stage(config),
+        _get_rate_limit_filter_stage(config),
+        _get_lua_filter_stage(),
+        *_get_container_filter_stages(config),
+        _get_modify_filter_stage(config),
+        _get_dedup_filter_stage(config),
+        _get_projection_filter_stage(config),
+        _get_priority_filter_stage(config),
+    ]
+    stages = [stage for stage in stages if stage is not None]
+    if priority_routing_enabled(config):
+        # Keep the retagged priority records from going through the filters a second time
+        for stage in stages:
+            if stage['match'] == '*':
+                stage['match'] = 'docker.*'
+    return stages
+
+
+def render_filter_plan(plan):
+    filters = ""
+    for stage in plan:
+        # Anchored matches are regular expressions
+        match_key = 'Match_Regex' if stage['match'].startswith('^') else 'Match'
+        filters += f"""
+[FILTER]
+    Name {stage['name']}
+    {match_key} {stage['match']}
+"""
+        for key, value in stage['properties']:
+            filters += f"    {key} {value}\n"
     return filters
 
 
-def _get_output_config(config):
+def describe_filter_plan(plan):
+    lines = ["Filter plan:"]
+    for index, stage in enumerate(plan, 1):
+        lines.append(f"  {index}. {stage['name']} (match {stage['match']}): {stage['description']}")
+        for key, value in stage['properties']:
+            lines.append(f"       {key} {value}")
+    return '\n'.join(lines)
+
+
+def generate_filters(config):
+    plan = build_filter_plan(config)
+    if config.filter_plan_debug == 'true':
+        print(describe_filter_plan(plan))
+    return render_filter_plan(plan)
+
+
+def _validate_regex_check_config(config):
+    if config.regex_check not in REGEX_CHECK_MODES:
+        raise ValueError(f"REGEX_CHECK must be one of: {', '.join(REGEX_CHECK_MODES)}")
+    if not _is_positive_number(config.regex_line_budget_ms):
+        raise ValueError("REGEX_LINE_BUDGET_MS must be a positive number of milliseconds")
+
+
+def _strip_slashes(pattern):
+    # Multiline rules hold their patterns between slashes
+    if len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/'):
+        return pattern[1:-1]
+    return pattern
+
+
+def get_filter_patterns(config):
+    # (filter, [(setting, pattern)]) of every generated filter and multiline parser that runs
+    # user patterns, with the patterns as Fluent Bit runs them
+    filters = []
+    for stage in build_filter_plan(config):
+        patterns = []
+        for key, value in stage['properties']:
+            if key in ('Regex', 'Exclude'):
+                field, pattern = value.split(' ', 1)
+            elif key == 'Rule':
+                field, pattern = value.split(' ')[:2]
+            else:
+                continue
+            if (key, field) in PATTERN_SETTINGS:
+                patterns.append((PATTERN_SETTINGS[(key, field)], pattern))
+        if patterns:
+            filters.append((f"{stage['name']} filter to {stage['description']}", patterns))
+
+    if config.multiline_start_state_rule:
+        patterns = [('MULTILINE_START_STATE_RULE', config.multiline_start_state_rule)]
+        if config.multiline_custom_rules:
+            patterns += [('MULTILINE_CUSTOM_RULES', _strip_slashes(rule.strip()))
+                         for rule in config.multiline_custom_rules.split(';') if rule.strip()]
+        filters.append(('multiline parser multiline-regex', patterns))
+    for rule in parse_multiline_rules(config):
+        setting = f"MULTILINE_RULES rule '{rule['name']}'"
+        patterns = [(setting, rule['start_state'])] + [(setting, pattern) for pattern in rule['cont']]
+        filters.append((f"multiline parser multiline-{rule['name']}", patterns))
+    return filters
+
+
+# Analysis of every user pattern already checked, keyed by pattern and line budget, so the
+# configurations rendered again on refresh do not time the same patterns again
+_regex_cost_cache = {}
+
+
+def check_regex_costs(config):
+    # A pattern that backtracks catastrophically on one line stalls the whole pipeline, so every
+    # user pattern is checked for super-linear constructs and timed on a corpus of typical and
+    # pathological lines before Fluent Bit runs it. Python's re stands in for Onigmo here; both
+    # are backtracking engines, so the constructs that blow up are the same.
+    if config.regex_check == 'off':
+        return
+    budget_ms = float(config.regex_line_budget_ms)
+    filters = get_filter_patterns(config)
+    patterns = [pattern for _, entries in filters for _, pattern in entries]
+    new_patterns = [pattern for pattern in dict.fromkeys(patterns) if (pattern, budget_ms) not in _regex_cost_cache]
+    if new_patterns:
+        for pattern, result in regex_cost.analyze_patterns(new_patterns, budget_ms).items():
+            _regex_cost_cache[(pattern, budget_ms)] = result
+
+    strict = config.regex_check == 'strict'
+    for filter_name, entries in filters:
+        # Warnings and estimates are printed once, when a filter has patterns not seen before
+        report = any(pattern in new_patterns for _, pattern in entries)
+        cost_ms = 0.0
+        for setting, pattern in entries:
+            result = _regex_cost_cache[(pattern, budget_ms)]
+            if result['error']:
+                if report:
+                    print(f"Warning: Could not analyze the {setting} pattern '{pattern}': {result['error']}")
+                continue
+            # A construct that can backtrack does not always blow up on real lines, so only the
+            # timing refuses a pattern
+            for _, description in result['findings']:
+                if report:
+                    print(f"Warning: {setting} pattern '{pattern}' {description}")
+            if result['worst_ms'] is None or result['worst_ms'] > budget_ms:
+                took = 'did not finish' if result['worst_ms'] is None else f"took {result['worst_ms']:.1f} ms"
+                message = f"{setting} pattern '{pattern}' {took} on a single line, over the {budget_ms:g} ms " \
+                          f"REGEX_LINE_BUDGET_MS"
+                if strict:
+                    raise ValueError(f"{message}. Rewrite it, or set REGEX_CHECK to warn to use it anyway")
+                if report:
+                    print(f"Warning: {message}")
+            cost_ms = None if cost_ms is None or result['cost_ms'] is None else cost_ms + result['cost_ms']
+        if report:
+            estimate = 'unknown' if cost_ms is None else f"about {cost_ms:.1f} ms"
+            print(f"Regex cost of the {filter_name}: {estimate} per {regex_cost.LINES_PER_ESTIMATE} lines")
+
+
+def _validate_output_config(config):
+    output_workers = get_performance_settings(config)['output_workers']
+    if output_workers and (not output_workers.isdigit() or int(output_workers) < 1):
+        raise ValueError("OUTPUT_WORKERS must be a positive number")
+    if not config.output_shards.isdigit() or not 1 <= int(config.output_shards) <= MAX_OUTPUT_SHARDS:
+        raise ValueError(f"OUTPUT_SHARDS must be a number between 1 and {MAX_OUTPUT_SHARDS}")
+    if config.output_engine not in OUTPUT_ENGINES:
+        raise ValueError(f"OUTPUT_ENGINE must be one of: {', '.join(OUTPUT_ENGINES)}")
+    if config.output_compress not in OUTPUT_COMPRESSION_MODES:
+        raise ValueError(f"OUTPUT_COMPRESS must be one of: {', '.join(OUTPUT_COMPRESSION_MODES)}")
+    retry_limit = config.output_retry_limit
+    if retry_limit and retry_limit != 'no_limits' and (not retry_limit.isdigit() or int(retry_limit) < 1):
+        raise ValueError("OUTPUT_RETRY_LIMIT must be a positive number or no_limits")
+    if config.output_engine == 'native':
+        url = urlsplit(config.logzio_url)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise ValueError("LOGZIO_URL must be an http or https URL when OUTPUT_ENGINE is native")
+
+
+def _validate_shards_config(config):
+    if not config.shards.isdigit() or not 1 <= int(config.shards) <= MAX_PROCESS_SHARDS:
+        raise ValueError(f"SHARDS must be a number between 1 and {MAX_PROCESS_SHARDS}")
+    containers_prefix = config.docker_containers_dir.rstrip('/') + '/*/'
+    if int(config.shards) > 1 and (not config.logs_path.startswith(containers_prefix) or ',' in config.logs_path):
+        raise ValueError(f"SHARDS requires LOGS_PATH to be a single path starting with {containers_prefix}")
+
+
+def _is_port(value):
+    return value.isdigit() and 1 <= int(value) <= 65535
+
+
+def get_aggregator_nodes(config):
+    # (host, port) of each aggregator in AGGREGATOR_HOSTS, host:port entries separated by commas
+    nodes = []
+    for address in config.aggregator_hosts.split(','):
+        if not address.strip():
+            continue
+        host, _, port = address.strip().partition(':')
+        nodes.append((host, port or config.forward_port))
+    return nodes
+
+
+def _validate_role_config(config):
+    if config.role not in ROLES:
+        raise ValueError(f"ROLE must be one of: {', '.join(ROLES)}")
+    if not _is_port(config.forward_port):
+        raise ValueError("FORWARD_PORT must be a port number")
+    if config.forward_tls not in FORWARD_TLS_MODES:
+        raise ValueError(f"FORWARD_TLS must be one of: {', '.join(FORWARD_TLS_MODES)}")
+    if config.role == 'agent':
+        nodes = get_aggregator_nodes(config)
+        if not nodes:
+            raise ValueError("ROLE agent requires AGGREGATOR_HOSTS")
+        if any(not host or not _is_port(port) for host, port in nodes):
+            raise ValueError("AGGREGATOR_HOSTS must be host or host:port entries separated by commas")
+    if config.role == 'aggregator':
+        # An aggregator has no log files to read, and its records no longer carry container IDs
+        # in their tags to split the outputs by
+        if config.shards != '1':
+            raise ValueError("ROLE aggregator cannot be used with SHARDS, one process receives every agent")
+        if config.backfill_mode == 'on':
+            raise ValueError("ROLE aggregator cannot be used with BACKFILL_MODE, set it on the agents")
+        if config.output_shards != '1':
+            raise ValueError("ROLE aggregator cannot be used with OUTPUT_SHARDS, use OUTPUT_WORKERS instead")
+        if config.forward_tls == 'on' and not (config.forward_tls_crt_file and config.forward_tls_key_file):
+            raise ValueError("FORWARD_TLS on requires FORWARD_TLS_CRT_FILE and FORWARD_TLS_KEY_FILE on an aggregator")
+        if not config.forward_shared_key and not _is_loopback(config.forward_listen):
+            print(f"Warning: The aggregator accepts records from anyone who can reach "
+                  f"{config.forward_listen}:{config.forward_port} and ships them with your token. "
+                  f"Set FORWARD_SHARED_KEY on the aggregator and its agents.")
+
+
+def _is_loopback(address):
+    if address in LOOPBACK_ADDRESSES:
+        return True
+    return address.startswith('127.')
+
+
+def uses_logzio_plugin(config):
+    # Agents forward to aggregators, and the native output ships without the plugin
+    return config.role != 'agent' and config.output_engine != 'native'
+
+
+def create_upstream_config(config):
+    # Aggregators an agent spreads its chunks over, round robin, when it has more than one
+    upstream_config = f"""
+[UPSTREAM]
+    name {UPSTREAM_NAME}
+"""
+    for index, (host, port) in enumerate(get_aggregator_nodes(config)):
+        upstream_config += f"""
+[NODE]
+    name aggregator-{index}
+    host {host}
+    port {port}
+"""
+        # The forward output takes the key and TLS settings of each node from the node
+        upstream_config += _get_forward_security_config(config)
+    return upstream_config
+
+
+def _get_forward_security_config(config, server=False):
+    # The shared key authenticates agents and aggregators to each other. With TLS, agents check
+    # the aggregator's certificate, against FORWARD_TLS_CA_FILE when it is set.
+    security_config = ""
+    if config.forward_shared_key:
+        security_config += f"    Shared_Key {config.forward_shared_key}\n"
+        security_config += f"    Self_Hostname {config.forward_self_hostname}\n"
+    if config.forward_tls == 'on':
+        security_config += "    tls on\n"
+        if server:
+            security_config += f"    tls.crt_file {config.forward_tls_crt_file}\n"
+            security_config += f"    tls.key_file {config.forward_tls_key_file}\n"
+        else:
+            security_config += "    tls.verify on\n"
+            if config.forward_tls_ca_file:
+                security_config += f"    tls.ca_file {config.forward_tls_ca_file}\n"
+    return security_config
+
+
+def _get_forward_input_config(config):
+    # Receives the records agents forward. Tags are kept, so each kind of record reaches its
+    # own output.
+    input_config = f"""
+[INPUT]
+    Name   forward
+    Listen {config.forward_listen}
+    Port   {config.forward_port}
+"""
+    input_config += _get_forward_security_config(config, server=True)
+    input_config += _get_input_buffering_config(config)
+    return input_config
+
+
+def _get_forward_output(config, output_id, match, kind):
+    # Waits for the aggregator to acknowledge each chunk, so a chunk lost on the way is retried
+    output_config = f"""
+[OUTPUT]
+    Name  forward
+    {match}
+    Alias {output_id}
+"""
+    nodes = get_aggregator_nodes(config)
+    if len(nodes) > 1:
+        output_config += f"    Upstream {UPSTREAM_CONF_PATH}\n"
+    else:
+        output_config += f"    Host  {nodes[0][0]}\n    Port  {nodes[0][1]}\n"
+        output_config += _get_forward_security_config(config)
+    output_config += f"    Tag   {FORWARD_TAGS[kind]}\n    Require_ack_response true\n"
+    return output_config
+
+
+def shard_config_path(index):
+    root, ext = os.path.splitext(FLUENT_BIT_CONF_PATH)
+    return f"{root}-shard-{index}{ext}"
+
+
+def _shard_file_path(path, index):
+    root, ext = os.path.splitext(path)
+    return f"{root}-shard-{index}{ext}"
+
+
+def get_lua_env(config):
+    # Environment of a Fluent Bit process for the settings docker-metadata.lua reads itself
+    # and that differ between shard processes
+    return {'DOCKER_METADATA_METRICS_FILE': config.docker_metadata_metrics_file,
+            'RATE_LIMIT_METRICS_FILE': config.rate_limit_metrics_file}
+
+
+def shard_config(config, index):
+    # Configuration of one of the SHARDS Fluent Bit processes. Each process owns the containers
+    # whose ID starts with its group of hex digits, and has its own offsets DB, filesystem
+    # buffer, output IDs, metrics port and metrics files.
+    shards = int(config.shards)
+    prefixes = split_container_id_prefixes(shards)[index]
+    shard = copy.copy(config)
+    shard.shards = '1'
+    shard.container_id_prefixes = prefixes
+    shard.logs_path = config.docker_containers_dir.rstrip('/') + f"/[{prefixes}]*/" + \
+        config.logs_path[len(config.docker_containers_dir.rstrip('/') + '/*/'):]
+    shard.output_id = f"{config.output_id}-shard-{index}"
+    db_path = get_tail_db_path(config)
+    if db_path:
+        shard.tail_db_path = _shard_file_path(db_path, index)
+    if config.docker_metadata_metrics_file:
+        shard.docker_metadata_metrics_file = _shard_file_path(config.docker_metadata_metrics_file, index)
+    if config.rate_limit_metrics_file:
+        shard.rate_limit_metrics_file = _shard_file_path(config.rate_limit_metrics_file, index)
+    shard.storage_path = os.path.join(config.storage_path, f"shard-{index}")
+    # Invalid values are left as they are for create_fluent_bit_config to report
+    if parse_size(config.storage_total_limit_size):
+        shard.storage_total_limit_size = str(parse_size(config.storage_total_limit_size) // shards)
+    if config.metrics_port.isdigit():
+        shard.metrics_port = str(int(config.metrics_port) + index)
+    return shard
+
+
+def split_container_id_prefixes(shards):
+    # Split the hex digits a container ID can start with into contiguous, near-equal groups
+    size, extra = divmod(len(CONTAINER_ID_DIGITS), shards)
+    groups = []
+    start = 0
+    for index in range(shards):
+        end = start + size + (1 if index < extra else 0)
+        groups.append(CONTAINER_ID_DIGITS[start:end])
+        start = end
+    return groups
+
+
+def get_live_tag_regex(config):
+    # Regex matching the tags of the records read by the live inputs
+    if config.backfill_active:
+        return "^docker\\.(?!backfill\\.)"
+    return "^docker\\."
+
+
+def get_output_shards(config):
+    # (output id, match property) of each output instance. Tags end with the log file name,
+    # <container id>-json.log, so each shard matches the IDs starting with its digits. The last
+    # shard matches every tag the others do not, so records of other files are still shipped.
+    # With priority routing or backfill, these bulk outputs only ship the live records.
+    live_tags = ''
+    if priority_routing_enabled(config) or config.backfill_active:
+        live_tags = get_live_tag_regex(config)
+    shards = int(config.output_shards)
+    if shards == 1:
+        return [(config.output_id, f"Match_Regex {live_tags}" if live_tags else "Match *")]
+
+    outputs = []
+    groups = split_container_id_prefixes(shards)
+    prefix = f"{live_tags}.*" if live_tags else ''
+    for index, digits in enumerate(groups[:-1]):
+        outputs.append((f"{config.output_id}-{index}", f"Match_Regex {prefix}\\.[{digits}][0-9a-f]*-json\\.log$"))
+    earlier_digits = ''.join(groups[:-1])
+    outputs.append((f"{config.output_id}-{shards - 1}",
+                    f"Match_Regex {live_tags or '^'}(?!.*\\.[{earlier_digits}][0-9a-f]*-json\\.log$)"))
+    return outputs
+
+
+def _get_logzio_plugin_output(config, output_id, match):
     output_config = f"""
 [OUTPUT]
     Name  logzio
-    Match *
+    {match}
     logzio_token {config.logzio_logs_token}
     logzio_url   {config.logzio_url}
     logzio_type  {config.logzio_type}
-    id {config.output_id}
-    headers user-agent:logzio-docker-collector-logs
+    id {output_id}
+    headers user-agent:{DEFAULT_USER_AGENT}
 """
     if config.headers:
         output_config += f"    headers      {config.headers}\n"
     return output_config
 
 
+def get_http_headers(config):
+    # HEADERS holds key:value pairs separated by commas, as the Logz.io plugin reads them
+    headers = [('User-Agent', DEFAULT_USER_AGENT)]
+    for header in config.headers.split(','):
+        if not header.strip():
+            continue
+        try:
+            key, value = header.split(':', 1)
+            headers.append((key.strip(), value.strip()))
+        except ValueError:
+            print(f"Warning: Skipping invalid header '{header}'. Expected format 'key:value'.")
+    return headers
+
+
+def _get_http_output(config, output_id, match):
+    # Same listener request as the Logz.io plugin: newline-delimited JSON records with an
+    # @timestamp field, authenticated by the token and typed by the type query parameters.
+    # Each flushed chunk is sent as one request, so FLUSH_INTERVAL sets the batching.
+    url = urlsplit(config.logzio_url)
+    tls = url.scheme == 'https'
+    port = url.port or (443 if tls else 80)
+    uri = f"{url.path.rstrip('/')}/?token={quote(config.logzio_logs_token, safe='')}" \
+          f"&type={quote(config.logzio_type, safe='')}"
+    output_config = f"""
+[OUTPUT]
+    Name  http
+    {match}
+    Alias {output_id}
+    Host  {url.hostname}
+    Port  {port}
+    URI   {uri}
+    Format json_lines
+    json_date_key    @timestamp
+    json_date_format iso8601
+"""
+    if tls:
+        output_config += "    tls        On\n    tls.verify On\n"
+    if config.output_compress == 'gzip':
+        output_config += "    compress gzip\n"
+    for key, value in get_http_headers(config):
+        output_config += f"    Header {key} {value}\n"
+    return output_config
+
+
+def get_outputs(config):
+    # (output id, match property, retry limit, workers, kind) of each output, where kind is
+    # live, priority or backfill
+    output_workers = get_performance_settings(config)['output_workers']
+    if config.role == 'aggregator':
+        # Ships the forwarded records of every agent by kind, and any other forwarded record
+        # with the live ones
+        other_tags = '|'.join(re.escape(FORWARD_TAGS[kind]) for kind in ('priority', 'backfill'))
+        return [
+            (config.output_id, f"Match_Regex ^(?!({other_tags})$)", config.output_retry_limit, output_workers, 'live'),
+            (f"{config.output_id}-priority", f"Match {FORWARD_TAGS['priority']}", config.priority_retry_limit, '',
+             'priority'),
+            (f"{config.output_id}-backfill", f"Match {FORWARD_TAGS['backfill']}", 'no_limits', '', 'backfill'),
+        ]
+
+    outputs = [(output_id, match, config.output_retry_limit, output_workers, 'live')
+               for output_id, match in get_output_shards(config)]
+    if priority_routing_enabled(config):
+        # Its own connections, queue and retry policy, so priority records never wait behind
+        # the bulk backlog, and give up sooner instead of retrying behind failing chunks
+        outputs.append((f"{config.output_id}-priority", f"Match {PRIORITY_TAG_PREFIX}*",
+                        config.priority_retry_limit, '', 'priority'))
+    if config.backfill_active:
+        # History queues behind neither live nor priority records, and is retried until it is
+        # shipped since the backfill inputs do not read it again
+        outputs.append((f"{config.output_id}-backfill", f"Match {BACKFILL_TAG_PREFIX}*", 'no_limits', '',
+                        'backfill'))
+    return outputs
+
+
+def _get_output_config(config):
+    outputs = get_outputs(config)
+    output_config = ""
+    for output_id, match, retry_limit, workers, kind in outputs:
+        if config.role == 'agent':
+            output_config += _get_forward_output(config, output_id, match, kind)
+        elif config.output_engine == 'native':
+            output_config += _get_http_output(config, output_id, match)
+        else:
+            output_config += _get_logzio_plugin_output(config, output_id, match)
+        if retry_limit:
+            output_config += f"    Retry_Limit {retry_limit}\n"
+        if workers:
+            output_config += f"    Workers {workers}\n"
+        if config.buffering_mode == 'filesystem':
+            # Once the spool reaches this size, Fluent Bit deletes the oldest chunks of this output.
+            # The limit is shared by the outputs so the spool stays within STORAGE_TOTAL_LIMIT_SIZE.
+            total_limit_size = config.storage_total_limit_size
+            if len(outputs) > 1:
+                total_limit_size = parse_size(total_limit_size) // len(outputs)
+            output_config += f"    storage.total_limit_size {total_limit_size}\n"
+    return output_config
+
+
 def create_multiline_parser_config(config):
+    multiline_config = ""
+    if config.multiline_start_state_rule:
+        multiline_config += _get_global_multiline_parser_config(config)
+    for rule in parse_multiline_rules(config):
+        multiline_config += _get_multiline_rule_parser_config(rule)
+    return multiline_config
+
+
+def _get_global_multiline_parser_config(config):
     # Base multiline parser configuration
     multiline_config = """
 [MULTILINE_PARSER]
@@ -251,6 +1783,23 @@ def create_multiline_parser_config(config):
     return multiline_config
 
 
+def _get_multiline_rule_parser_config(rule):
+    # Multiline parser of one MULTILINE_RULES entry, used only by the input of its containers
+    multiline_config = f"""
+[MULTILINE_PARSER]
+    name          multiline-{rule['name']}
+    type          regex
+    flush_timeout {rule['flush_timeout']}
+"""
+    if rule['cont']:
+        multiline_config += f'    rule      "start_state"   "/{rule["start_state"]}/"  "cont"\n'
+        for pattern in rule['cont']:
+            multiline_config += f'    rule      "cont"          "/{pattern}/"                     "cont"\n'
+    else:
+        multiline_config += f'    rule      "start_state"   "/{rule["start_state"]}/"\n'
+    return multiline_config
+
+
 def save_config_file(config_content, filename):
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     with open(filename, 'w') as file:
@@ -262,27 +1811,47 @@ def main():
     # Instantiate the configuration object
     config = Config()
 
-    # Check if the Logz.io plugin exists before proceeding with configuration
-    try:
-        # Attempt to open the plugin file to check for its existence
-        with open(PLUGIN_PATH, 'r') as f:
-            print(f"{PLUGIN_PATH} File found")
-    except FileNotFoundError:
-        print(f"Error: {PLUGIN_PATH} file not found. Configuration will not be created.")
-        return
-    except PermissionError:
-        print(f"Error: Permission denied when accessing {PLUGIN_PATH}. Check your file permissions.")
-        return
-    except Exception as e:
-        print(f"An unexpected error occurred while checking {PLUGIN_PATH}: {e}")
-        return
+    # Check if the Logz.io plugin exists before proceeding with configuration, unless the
+    # native http output ships the logs or an agent forwards them
+    if uses_logzio_plugin(config):
+        try:
+            # Attempt to open the plugin file to check for its existence
+            with open(PLUGIN_PATH, 'r') as f:
+                print(f"{PLUGIN_PATH} File found")
+        except FileNotFoundError:
+            print(f"Error: {PLUGIN_PATH} file not found. Configuration will not be created.")
+            return
+        except PermissionError:
+            print(f"Error: Permission denied when accessing {PLUGIN_PATH}. Check your file permissions.")
+            return
+        except Exception as e:
+            print(f"An unexpected error occurred while checking {PLUGIN_PATH}: {e}")
+            return
 
-    # Generate and save Fluent Bit configuration
-    fluent_bit_config = create_fluent_bit_config(config)
-    save_config_file(fluent_bit_config, FLUENT_BIT_CONF_PATH)
+    # Generate and save the Fluent Bit configuration, one per shard process when sharded
+    _validate_shards_config(config)
+    if int(config.shards) > 1:
+        configs = [(shard_config(config, index), shard_config_path(index)) for index in range(int(config.shards))]
+    else:
+        configs = [(config, FLUENT_BIT_CONF_PATH)]
+    for process_config, config_path in configs:
+        fluent_bit_config = create_fluent_bit_config(process_config)
+        save_config_file(fluent_bit_config, config_path)
+
+        # Create the filesystem buffer directory
+        if process_config.buffering_mode == 'filesystem':
+            os.makedirs(process_config.storage_path, exist_ok=True)
+
+        # Create the directory of the tail offsets database
+        if get_tail_db_path(process_config):
+            os.makedirs(os.path.dirname(get_tail_db_path(process_config)), exist_ok=True)
+
+    # Generate and save the aggregators an agent load balances over
+    if config.role == 'agent' and len(get_aggregator_nodes(config)) > 1:
+        save_config_file(create_upstream_config(config), UPSTREAM_CONF_PATH)
 
     # Generate and save multiline parser configuration if rules are defined
-    if config.multiline_start_state_rule:
+    if config.multiline_start_state_rule or config.multiline_rules:
         multiline_config = create_multiline_parser_config(config)
         save_config_file(multiline_config, PARSERS_MULTILINE_CONF_PATH)
 
@@ -1,30 +1,132 @@
 local M = {}
 
 -- Directory where Docker stores container data
-M.DOCKER_VAR_DIR = '/var/lib/docker/containers/'
+M.DOCKER_VAR_DIR = (os.getenv("DOCKER_CONTAINERS_DIR") or '/var/lib/docker/containers'):gsub('/*$', '') .. '/'
 
 -- Docker container configuration file
 M.DOCKER_CONTAINER_CONFIG_FILE = '/config.v2.json'
 
--- Cache Time-To-Live in seconds
-M.CACHE_TTL_SEC = 300  -- Cache entries are valid for 5 minutes
+-- Maximum number of containers kept in the metadata cache
+M.CACHE_MAX_ENTRIES = tonumber(os.getenv("METADATA_CACHE_SIZE") or "") or 4096
 
--- Cache Cleanup Interval in seconds
-M.CACHE_CLEANUP_INTERVAL = 600  -- Perform cleanup every 10 minutes
+-- Seconds between checks that a cached container's config file did not change
+M.CACHE_REVALIDATE_SEC = 10
 
--- Table defining patterns to extract metadata from Docker config file
+-- Seconds a missing container config file is remembered before it is looked up again
+M.NEGATIVE_CACHE_TTL_SEC = 5
+
+-- Number of bytes at the start of a config file included in its signature.
+-- The container state (Pid, StartedAt) lives there, so restarts change the signature.
+M.SIGNATURE_HEAD_BYTES = 256
+
+-- Maximum number of bytes read from a container config file
+M.CONFIG_MAX_READ_BYTES = tonumber(os.getenv("DOCKER_METADATA_MAX_READ_BYTES") or "") or 8388608
+
+-- Number of bytes read from a container config file at a time
+M.CONFIG_READ_CHUNK_BYTES = 65536
+
+-- Bytes kept from the previous chunk so values split across two reads are still found
+M.CONFIG_CHUNK_OVERLAP_BYTES = 4096
+
+-- Table mapping metadata fields to the keys they are extracted from in the Docker config file
 M.DOCKER_CONTAINER_METADATA = {
-  ['docker_container_name'] = '\"Name\":\"/?(.-)\"',  -- Extract container name
-  ['docker_container_image'] = '\"Image\":\"/?(.-)\"',  -- Extract container image name
-  ['docker_container_started'] = '\"StartedAt\":\"/?(.-)\"'  -- Extract container start time
+  ['docker_container_name'] = 'Name',  -- Extract container name
+  ['docker_container_image'] = 'Image',  -- Extract container image name
+  ['docker_container_started'] = 'StartedAt'  -- Extract container start time
 }
 
--- Cache to store metadata for containers
-M.cache = {}
-M.last_cleanup_time = os.time()
+-- Metadata index kept up to date from Docker events by metadata_index.py, disabled when empty.
+-- Containers found in it are enriched without reading their config file.
+M.METADATA_INDEX_FILE = os.getenv("DOCKER_METADATA_INDEX_FILE") or ''
+
+-- Seconds between checks that the metadata index file changed
+M.INDEX_CHECK_INTERVAL_SEC = 1
+
+-- Seconds after which an index whose heartbeat stopped changing is ignored. metadata_index.py
+-- writes it at least every 30 seconds while it runs, so a stale index means it stopped.
+M.INDEX_STALE_SEC = tonumber(os.getenv("DOCKER_METADATA_INDEX_STALE_SEC") or "") or 90
+
+-- File the metadata counters are written to in Prometheus text format, disabled when empty.
+-- It can be collected with the node_exporter textfile collector.
+M.METRICS_FILE = os.getenv("DOCKER_METADATA_METRICS_FILE") or ''
+
+-- Seconds between writes of the metrics file
+M.METRICS_INTERVAL_SEC = tonumber(os.getenv("DOCKER_METADATA_METRICS_INTERVAL") or "") or 10
+
+-- Upper bounds, in seconds, of the config file read latency histogram buckets
+M.READ_LATENCY_BUCKETS = { 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1 }
+
+-- Rate limit applied to every container, as rate:burst:action, disabled when empty.
+-- action is drop, tag, or sample:N to keep one in N records over the limit.
+M.RATE_LIMIT = os.getenv("RATE_LIMIT") or ''
+
+-- Per-container and per-image rate limits, as container:<pattern>=<limit> or
+-- image:<pattern>=<limit> entries separated by semicolons. Patterns are Lua patterns.
+M.RATE_LIMIT_RULES = os.getenv("RATE_LIMIT_RULES") or ''
+
+-- File the rate limit counters are written to in Prometheus text format, disabled when empty
+M.RATE_LIMIT_METRICS_FILE = os.getenv("RATE_LIMIT_METRICS_FILE") or ''
+
+-- Seconds within which consecutive identical messages of a container are collapsed
+M.DEDUP_WINDOW_SEC = tonumber(os.getenv("LOG_DEDUP_WINDOW_SEC") or "") or 10
+
+-- Maximum number of containers whose last message is remembered for deduplication
+M.DEDUP_MAX_CONTAINERS = tonumber(os.getenv("LOG_DEDUP_MAX_CONTAINERS") or "") or 4096
+
+-- Snapshot written by create_fluent_bit_config when backfill starts. It holds, for each log
+-- file with history, the offset where the live input took over from the backfill input.
+M.BACKFILL_SNAPSHOT_FILE = os.getenv("BACKFILL_SNAPSHOT_FILE") or '/fluent-bit/db/backfill.snapshot'
+
+-- Fields the backfill tail inputs add with the path of the file and the offset of the line
+M.BACKFILL_PATH_KEY = 'backfill_path'
+M.BACKFILL_OFFSET_KEY = 'backfill_offset'
+
+-- Function to parse a size such as 512k, 1M or 2G into bytes, or nil when it is invalid
+function M.parse_size(value)
+  local number, unit = tostring(value or ''):lower():match('^%s*(%d+)%s*([kmg]?)b?%s*$')
+  if not number then
+    return nil
+  end
+  local units = { [''] = 1, k = 1024, m = 1024 * 1024, g = 1024 * 1024 * 1024 }
+  return tonumber(number) * units[unit]
+end
+
+-- Maximum size in bytes of the log of one event, reassembled from partial lines or joined by
+-- a multiline parser. Larger events are truncated and marked with M.TRUNCATED_KEY.
+M.MAX_EVENT_SIZE = M.parse_size(os.getenv("MAX_EVENT_SIZE")) or 1048576
+
+-- Seconds after which the partial line of a container whose next fragment never came is
+-- shipped as it is
+M.PARTIAL_LINE_TIMEOUT_SEC = tonumber(os.getenv("PARTIAL_LINE_TIMEOUT_SEC") or "") or 5
+
+-- Field set on the events truncated to M.MAX_EVENT_SIZE
+M.TRUNCATED_KEY = 'truncated'
+
+-- Field holding the tag of a timed out partial line shipped under the heartbeat's tag. A
+-- rewrite_tag filter retags the line to it, and it is enriched with its own container's metadata.
+M.PARTIAL_TAG_KEY = 'partial_tag'
+
+-- Tag of the records a dummy input sends every second, so timed out partial lines are shipped
+-- on time even when no record is read
+M.PARTIAL_LINE_HEARTBEAT_TAG = 'docker.partial_lines.heartbeat'
+
+-- Prefixes of the fields added for allowlisted container labels and environment variables
+M.LABEL_FIELD_PREFIX = 'docker_container_label_'
+M.ENV_FIELD_PREFIX = 'docker_container_env_'
 
 local debug_mode = os.getenv("DEBUG_MODE") == "true"
 
+-- Whether diagnostic fields, such as the source of the metadata, are added to records
+M.DIAGNOSTIC_FIELDS = debug_mode
+
+-- LuaFileSystem is optional; when available, config file signatures include the mtime
+local has_lfs, lfs = pcall(require, 'lfs')
+
+-- LuaSocket is optional; when available, read latency is measured in wall clock time
+-- instead of CPU time
+local has_socket, socket = pcall(require, 'socket')
+local clock = has_socket and socket.gettime or os.clock
+
 -- Function to print debug messages if debug mode is enabled
 local function debug_print(...)
   if debug_mode then
@@ -32,6 +134,112 @@ local function debug_print(...)
   end
 end
 
+-- Least recently used cache with O(1) lookup, insertion and eviction.
+-- Entries live in a doubly linked list ordered from most to least recently used.
+local LRUCache = {}
+LRUCache.__index = LRUCache
+
+-- Function to create an LRU cache holding at most capacity entries
+function M.new_lru_cache(capacity)
+  local head = {}
+  head.prev = head
+  head.next = head
+  return setmetatable({ capacity = capacity, size = 0, nodes = {}, head = head, evictions = 0 }, LRUCache)
+end
+
+local function unlink(node)
+  node.prev.next = node.next
+  node.next.prev = node.prev
+end
+
+local function push_front(head, node)
+  node.prev = head
+  node.next = head.next
+  head.next.prev = node
+  head.next = node
+end
+
+-- Function to get a value and mark it as most recently used
+function LRUCache:get(key)
+  local node = self.nodes[key]
+  if node == nil then
+    return nil
+  end
+  unlink(node)
+  push_front(self.head, node)
+  return node.value
+end
+
+-- Function to insert or replace a value, evicting the least recently used entry when full
+function LRUCache:set(key, value)
+  local node = self.nodes[key]
+  if node then
+    node.value = value
+    unlink(node)
+    push_front(self.head, node)
+    return
+  end
+
+  node = { key = key, value = value }
+  self.nodes[key] = node
+  push_front(self.head, node)
+  self.size = self.size + 1
+
+  if self.size > self.capacity then
+    local oldest = self.head.prev
+    unlink(oldest)
+    self.nodes[oldest.key] = nil
+    self.size = self.size - 1
+    self.evictions = self.evictions + 1
+    debug_print("Evicted cache entry for container:", oldest.key)
+    if self.on_evict then
+      self.on_evict(oldest.key, oldest.value)
+    end
+  end
+end
+
+-- Function to remove a value from the cache
+function LRUCache:delete(key)
+  local node = self.nodes[key]
+  if node then
+    unlink(node)
+    self.nodes[key] = nil
+    self.size = self.size - 1
+  end
+end
+
+-- Function to reset the metadata cache and its counters
+function M.reset_cache(capacity)
+  M.cache = M.new_lru_cache(capacity or M.CACHE_MAX_ENTRIES)
+  M.cache_stats = { hits = 0, misses = 0, negative_hits = 0, invalidations = 0, disk_reads = 0, records_enriched = 0,
+                    index_hits = 0, index_loads = 0 }
+  M.metadata_index = { entries = {}, generation = nil, heartbeat = nil, checked_at = nil, alive_at = nil }
+  M.read_latency = { buckets = {}, sum = 0, count = 0 }
+  for i = 1, #M.READ_LATENCY_BUCKETS do
+    M.read_latency.buckets[i] = 0
+  end
+  M.metrics_state = { written_at = nil, records_enriched = 0 }
+end
+
+-- Function to get the metadata cache counters
+function M.get_cache_stats()
+  return {
+    hits = M.cache_stats.hits,
+    misses = M.cache_stats.misses,
+    negative_hits = M.cache_stats.negative_hits,
+    invalidations = M.cache_stats.invalidations,
+    disk_reads = M.cache_stats.disk_reads,
+    records_enriched = M.cache_stats.records_enriched,
+    index_hits = M.cache_stats.index_hits,
+    index_loads = M.cache_stats.index_loads,
+    evictions = M.cache.evictions,
+    size = M.cache.size
+  }
+end
+
+-- Cache to store metadata for containers
+M.reset_cache()
+
 -- Function to extract container ID from log tag
 function M.get_container_id_from_tag(tag)
   debug_print("Getting container ID from tag:", tag)
@@ -40,64 +248,368 @@ function M.get_container_id_from_tag(tag)
   return container_id
 end
 
--- Function to read and extract metadata from Docker config file
+-- Function to split a comma separated environment variable into a list of trimmed values
+local function split_list(value)
+  local items = {}
+  for item in (value or ''):gmatch('[^,]+') do
+    item = item:match('^%s*(.-)%s*$')
+    if item ~= '' then
+      table.insert(items, item)
+    end
+  end
+  return items
+end
+
+-- Function to build the list of extractors used when reading Docker config files.
+-- fields is a list of keys of M.DOCKER_CONTAINER_METADATA (all of them when nil),
+-- labels and env_keys are lists of container label names and environment variable names.
+function M.configure_metadata_fields(fields, labels, env_keys)
+  local extractors = {}
+  if fields == nil then
+    fields = {}
+    for field in pairs(M.DOCKER_CONTAINER_METADATA) do
+      table.insert(fields, field)
+    end
+    table.sort(fields)
+  end
+  for _, field in ipairs(fields) do
+    local key = M.DOCKER_CONTAINER_METADATA[field]
+    if key then
+      table.insert(extractors, { field = field, anchor = '"' .. key .. '":"', strip_slash = true })
+    else
+      debug_print("Ignoring unknown metadata field:", field)
+    end
+  end
+  for _, label in ipairs(labels or {}) do
+    local field = M.LABEL_FIELD_PREFIX .. label:gsub('[^%w_]', '_')
+    table.insert(extractors, { field = field, anchor = '"' .. label .. '":"' })
+  end
+  for _, env_key in ipairs(env_keys or {}) do
+    local field = M.ENV_FIELD_PREFIX .. env_key:gsub('[^%w_]', '_')
+    table.insert(extractors, { field = field, anchor = '"' .. env_key .. '=' })
+  end
+  M.metadata_extractors = extractors
+  return extractors
+end
+
+M.configure_metadata_fields(
+  os.getenv("DOCKER_METADATA_FIELDS") and split_list(os.getenv("DOCKER_METADATA_FIELDS")) or nil,
+  split_list(os.getenv("DOCKER_METADATA_LABELS")),
+  split_list(os.getenv("DOCKER_METADATA_ENV"))
+)
+
+-- Function to find the string value that follows an extractor's anchor in a buffer.
+-- Returns nil when the anchor is missing or its value is cut off at the end of the buffer.
+local function find_value(buffer, extractor)
+  local _, anchor_end = buffer:find(extractor.anchor, 1, true)
+  if not anchor_end then
+    return nil
+  end
+  local value_start = anchor_end + 1
+  if extractor.strip_slash and buffer:sub(value_start, value_start) == '/' then
+    value_start = value_start + 1
+  end
+  local quote = value_start
+  while true do
+    quote = buffer:find('"', quote, true)
+    if not quote then
+      return nil
+    end
+    -- Skip escaped quotes inside the value
+    local backslashes = 0
+    while buffer:sub(quote - backslashes - 1, quote - backslashes - 1) == '\\' do
+      backslashes = backslashes + 1
+    end
+    if backslashes % 2 == 0 then
+      return buffer:sub(value_start, quote - 1)
+    end
+    quote = quote + 1
+  end
+end
+
+-- Function to extract metadata from an open Docker config file in a single pass.
+-- Reading stops as soon as every extractor has a value or M.CONFIG_MAX_READ_BYTES were read.
+function M.extract_metadata(fl, extractors)
+  local pending = {}
+  for i, extractor in ipairs(extractors) do
+    pending[i] = extractor
+  end
+
+  local data = {}
+  local carry = ''
+  local bytes_read = 0
+  while #pending > 0 and bytes_read < M.CONFIG_MAX_READ_BYTES do
+    local chunk = fl:read(math.min(M.CONFIG_READ_CHUNK_BYTES, M.CONFIG_MAX_READ_BYTES - bytes_read))
+    if chunk == nil or chunk == '' then
+      break
+    end
+    bytes_read = bytes_read + #chunk
+    local buffer = carry .. chunk
+
+    for i = #pending, 1, -1 do
+      local extractor = pending[i]
+      local value = find_value(buffer, extractor)
+      if value then
+        data[extractor.field] = value
+        debug_print("Found metadata:", extractor.field, value)
+        table.remove(pending, i)
+      end
+    end
+
+    carry = buffer:sub(-M.CONFIG_CHUNK_OVERLAP_BYTES)
+  end
+
+  debug_print("Read", bytes_read, "bytes of container config,", #pending, "fields not found")
+  return data
+end
+
+-- Function to record the latency of a config file read in the histogram
+function M.observe_read_latency(seconds)
+  local latency = M.read_latency
+  for i, bound in ipairs(M.READ_LATENCY_BUCKETS) do
+    if seconds <= bound then
+      latency.buckets[i] = latency.buckets[i] + 1
+    end
+  end
+  latency.sum = latency.sum + seconds
+  latency.count = latency.count + 1
+end
+
+-- Function to render the metadata counters in Prometheus text format.
+-- The enrichment rate covers the time since the previous render.
+function M.render_metrics(current_time)
+  local stats = M.get_cache_stats()
+  local state = M.metrics_state
+  local rate = 0
+  if state.written_at and current_time > state.written_at then
+    rate = (stats.records_enriched - state.records_enriched) / (current_time - state.written_at)
+  end
+  state.written_at = current_time
+  state.records_enriched = stats.records_enriched
+
+  local lines = {}
+  local function metric(name, metric_type, help, value)
+    table.insert(lines, '# HELP ' .. name .. ' ' .. help)
+    table.insert(lines, '# TYPE ' .. name .. ' ' .. metric_type)
+    table.insert(lines, name .. ' ' .. value)
+  end
+  metric('docker_metadata_cache_hits_total', 'counter', 'Lookups answered from the metadata cache.', stats.hits)
+  metric('docker_metadata_cache_misses_total', 'counter', 'Lookups that read the container config file.', stats.misses)
+  metric('docker_metadata_cache_negative_hits_total', 'counter',
+    'Lookups answered from the cache of missing config files.', stats.negative_hits)
+  metric('docker_metadata_cache_invalidations_total', 'counter',
+    'Cached entries dropped because the config file changed.', stats.invalidations)
+  metric('docker_metadata_cache_evictions_total', 'counter', 'Cached entries evicted to make room.', stats.evictions)
+  metric('docker_metadata_cache_entries', 'gauge', 'Containers in the metadata cache.', stats.size)
+  metric('docker_metadata_disk_reads_total', 'counter', 'Container config file reads.', stats.disk_reads)
+  metric('docker_metadata_index_hits_total', 'counter', 'Lookups answered from the metadata index.', stats.index_hits)
+  metric('docker_metadata_index_loads_total', 'counter', 'Loads of the changed metadata index file.',
+    stats.index_loads)
+  metric('docker_metadata_records_enriched_total', 'counter', 'Records enriched with container metadata.',
+    stats.records_enriched)
+  metric('docker_metadata_records_enriched_per_second', 'gauge',
+    'Records enriched per second since the previous metrics write.', string.format('%.3f', rate))
+
+  local name = 'docker_metadata_disk_read_seconds'
+  table.insert(lines, '# HELP ' .. name .. ' Latency of container config file reads.')
+  table.insert(lines, '# TYPE ' .. name .. ' histogram')
+  for i, bound in ipairs(M.READ_LATENCY_BUCKETS) do
+    table.insert(lines, string.format('%s_bucket{le="%g"} %d', name, bound, M.read_latency.buckets[i]))
+  end
+  table.insert(lines, string.format('%s_bucket{le="+Inf"} %d', name, M.read_latency.count))
+  table.insert(lines, string.format('%s_sum %.6f', name, M.read_latency.sum))
+  table.insert(lines, string.format('%s_count %d', name, M.read_latency.count))
+  return table.concat(lines, '\n') .. '\n'
+end
+
+-- Function to write the metrics file, replacing the previous one atomically
+function M.write_metrics_file(path, current_time)
+  local tmp_path = path .. '.tmp'
+  local fl = io.open(tmp_path, 'w')
+  if fl == nil then
+    debug_print("Failed to write metrics file:", tmp_path)
+    return false
+  end
+  fl:write(M.render_metrics(current_time))
+  fl:close()
+  return os.rename(tmp_path, path) ~= nil
+end
+
+-- Function to write the metrics file when it is enabled and M.METRICS_INTERVAL_SEC passed
+local function maybe_write_metrics(current_time)
+  if M.METRICS_FILE == '' then
+    return
+  end
+  local written_at = M.metrics_state.written_at
+  if written_at == nil or current_time - written_at >= M.METRICS_INTERVAL_SEC then
+    M.write_metrics_file(M.METRICS_FILE, current_time)
+  end
+end
+
+-- Function to compute the signature of an open config file.
+-- Uses the mtime and size when LuaFileSystem is available, the size and first bytes otherwise.
+local function file_signature(fl, path)
+  if has_lfs then
+    local attributes = lfs.attributes(path)
+    if attributes then
+      return attributes.modification .. ':' .. attributes.size
+    end
+  end
+  local size = fl:seek('end')
+  fl:seek('set')
+  local head = fl:read(M.SIGNATURE_HEAD_BYTES) or ''
+  fl:seek('set')
+  return tostring(size) .. ':' .. head
+end
+
+-- Function to get the signature of a container's config file, or nil when it is missing
+function M.get_config_signature(container_id)
+  local docker_config_file = M.DOCKER_VAR_DIR .. container_id .. M.DOCKER_CONTAINER_CONFIG_FILE
+  local fl = io.open(docker_config_file, 'r')
+  if fl == nil then
+    return nil
+  end
+  local signature = file_signature(fl, docker_config_file)
+  fl:close()
+  return signature
+end
+
+-- Function to read and extract metadata from Docker config file.
+-- Returns the metadata and the config file signature, or nil when the file is missing.
 function M.get_container_metadata_from_disk(container_id)
   local docker_config_file = M.DOCKER_VAR_DIR .. container_id .. M.DOCKER_CONTAINER_CONFIG_FILE
   debug_print("Reading metadata from:", docker_config_file)
 
+  local started = clock()
+  M.cache_stats.disk_reads = M.cache_stats.disk_reads + 1
   local fl = io.open(docker_config_file, 'r')
   if fl == nil then
     debug_print("Failed to open file:", docker_config_file)
-    return { source = 'disk' }
+    M.observe_read_latency(clock() - started)
+    return nil
   end
 
-  local data = { time = os.time() }
+  local signature = file_signature(fl, docker_config_file)
+  local data = M.extract_metadata(fl, M.metadata_extractors)
+  fl:close()
+  data['time'] = os.time()
+  M.observe_read_latency(clock() - started)
+
+  debug_print("Metadata extracted for container:", container_id)
+  return data, signature
+end
+
+-- Function to undo the escaping of tabs, newlines and backslashes in a metadata index value
+local function unescape_index_value(value)
+  return (value:gsub('\\(.)', { t = '\t', n = '\n', ['\\'] = '\\' }))
+end
 
-  for line in fl:lines() do
-    for key, regex in pairs(M.DOCKER_CONTAINER_METADATA) do
-      local match = line:match(regex)
-      if match then
-        data[key] = match
-        debug_print("Found metadata:", key, match)
+-- Function to parse the lines of a metadata index file. Each line holds a container ID
+-- followed by tab separated field and value pairs.
+function M.parse_metadata_index(lines)
+  local entries = {}
+  for line in lines do
+    if line:sub(1, 1) ~= '#' and line ~= '' then
+      local columns = {}
+      for column in (line .. '\t'):gmatch('([^\t]*)\t') do
+        table.insert(columns, column)
       end
+      local data = {}
+      for i = 2, #columns - 1, 2 do
+        data[columns[i]] = unescape_index_value(columns[i + 1])
+      end
+      entries[columns[1]] = data
     end
   end
-  fl:close()
+  return entries
+end
 
-  if next(data) == nil then
-    debug_print("No metadata found in file:", docker_config_file)
-    return nil
-  else
-    debug_print("Metadata extracted for container:", container_id)
-    return data
+-- Function to reload the metadata index when its first line, which holds a generation number
+-- bumped when the entries change, changed. Checked at most every M.INDEX_CHECK_INTERVAL_SEC
+-- seconds. The second line holds a heartbeat that changes on every write, read without
+-- reloading the entries. Returns whether the index is current: present, and its heartbeat
+-- changed within M.INDEX_STALE_SEC.
+function M.refresh_metadata_index(current_time)
+  local index = M.metadata_index
+  if index.checked_at == nil or current_time - index.checked_at >= M.INDEX_CHECK_INTERVAL_SEC then
+    index.checked_at = current_time
+    local fl = io.open(M.METADATA_INDEX_FILE, 'r')
+    if fl == nil then
+      index.entries, index.generation, index.heartbeat, index.alive_at = {}, nil, nil, nil
+      return false
+    end
+    local generation = fl:read('*l')
+    local heartbeat = fl:read('*l')
+    if generation ~= index.generation then
+      index.entries = M.parse_metadata_index(fl:lines())
+      index.generation = generation
+      M.cache_stats.index_loads = M.cache_stats.index_loads + 1
+      debug_print("Loaded metadata index:", generation)
+    end
+    if heartbeat ~= index.heartbeat then
+      index.heartbeat = heartbeat
+      index.alive_at = current_time
+    end
+    fl:close()
   end
+  return index.alive_at ~= nil and current_time - index.alive_at < M.INDEX_STALE_SEC
 end
 
--- Function to clean up expired cache entries
-function M.cleanup_cache()
-  local current_time = os.time()
-  for container_id, cached_data in pairs(M.cache) do
-    if current_time - cached_data['time'] > M.CACHE_TTL_SEC then
-      M.cache[container_id] = nil
-      debug_print("Removed expired cache entry for container:", container_id)
+-- Function to look up a container's metadata, from the metadata index when it is enabled,
+-- current and knows the container, going to disk only on a cache miss otherwise. Cached entries are revalidated against the config file signature every
+-- M.CACHE_REVALIDATE_SEC seconds, and missing config files are cached for
+-- M.NEGATIVE_CACHE_TTL_SEC seconds. Returns the metadata (or nil) and its source.
+function M.lookup_container_metadata(container_id, current_time)
+  if M.METADATA_INDEX_FILE ~= '' and M.refresh_metadata_index(current_time) then
+    local data = M.metadata_index.entries[container_id]
+    if data then
+      M.cache_stats.index_hits = M.cache_stats.index_hits + 1
+      return data, 'index'
     end
   end
-  M.last_cleanup_time = current_time
-  debug_print("Cache cleanup completed at:", os.date('%Y-%m-%d %H:%M:%S', current_time))
+
+  local entry = M.cache:get(container_id)
+  if entry then
+    if entry.negative then
+      if current_time < entry.expires_at then
+        M.cache_stats.negative_hits = M.cache_stats.negative_hits + 1
+        return nil, 'unknown'
+      end
+    elseif current_time - entry.checked_at < M.CACHE_REVALIDATE_SEC then
+      M.cache_stats.hits = M.cache_stats.hits + 1
+      return entry.data, 'cache'
+    else
+      local signature = M.get_config_signature(container_id)
+      if signature ~= nil and signature == entry.signature then
+        entry.checked_at = current_time
+        M.cache_stats.hits = M.cache_stats.hits + 1
+        return entry.data, 'cache'
+      end
+      debug_print("Config file changed for container:", container_id)
+      M.cache_stats.invalidations = M.cache_stats.invalidations + 1
+    end
+  end
+
+  M.cache_stats.misses = M.cache_stats.misses + 1
+  local data, signature = M.get_container_metadata_from_disk(container_id)
+  if data then
+    M.cache:set(container_id, { data = data, signature = signature, checked_at = current_time })
+    return data, 'disk'
+  end
+
+  debug_print("No metadata found for container:", container_id)
+  M.cache:set(container_id, { negative = true, expires_at = current_time + M.NEGATIVE_CACHE_TTL_SEC })
+  return nil, 'unknown'
 end
 
 -- Function to enrich log records with Docker metadata
 function M.enrich_with_docker_metadata(tag, timestamp, record)
   debug_print("Enriching record with tag:", tag)
 
-  -- Perform cache cleanup if necessary
-  local current_time = os.time()
-  if current_time - M.last_cleanup_time > M.CACHE_CLEANUP_INTERVAL then
-    debug_print("Performing cache cleanup...")
-    M.cleanup_cache()
-  end
-
-  local container_id = M.get_container_id_from_tag(tag)
+  -- A timed out partial line carries the tag of its own container
+  local partial_tag = record[M.PARTIAL_TAG_KEY]
+  record[M.PARTIAL_TAG_KEY] = nil
+  local container_id = M.get_container_id_from_tag(partial_tag or tag)
   if not container_id then
     debug_print("No container ID found for tag:", tag)
     return 0, 0, 0
@@ -106,18 +618,10 @@ function M.enrich_with_docker_metadata(tag, timestamp, record)
   local new_record = record
   new_record['docker_container_id'] = container_id
 
-  local cached_data = M.cache[container_id]
-  if cached_data == nil or (current_time - cached_data['time'] > M.CACHE_TTL_SEC) then
-    cached_data = M.get_container_metadata_from_disk(container_id)
-    if cached_data then
-      M.cache[container_id] = cached_data
-      new_record['source'] = 'disk'
-    else
-      debug_print("No metadata found for container:", container_id)
-      new_record['source'] = 'unknown'
-    end
-  else
-    new_record['source'] = 'cache'
+  local current_time = os.time()
+  local cached_data, source = M.lookup_container_metadata(container_id, current_time)
+  if M.DIAGNOSTIC_FIELDS then
+    new_record['source'] = source
   end
 
   if cached_data then
@@ -126,7 +630,9 @@ function M.enrich_with_docker_metadata(tag, timestamp, record)
         new_record[key] = value
       end
     end
+    M.cache_stats.records_enriched = M.cache_stats.records_enriched + 1
   end
+  maybe_write_metrics(current_time)
 
   debug_print("Enriched record:", new_record)
   for k, v in pairs(new_record) do
@@ -136,7 +642,469 @@ function M.enrich_with_docker_metadata(tag, timestamp, record)
   return 1, timestamp, new_record
 end
 
+-- Function to parse a rate limit such as 100:500:drop, 100:500:tag or 100:500:sample:10.
+-- Returns nil when the limit is malformed.
+function M.parse_rate_limit(spec)
+  local rate, burst, action = spec:match('^%s*([%d%.]+):(%d+):(.-)%s*$')
+  rate, burst = tonumber(rate), tonumber(burst)
+  if not rate or rate <= 0 or not burst or burst < 1 then
+    return nil
+  end
+  if action == 'drop' or action == 'tag' then
+    return { rate = rate, burst = burst, action = action }
+  end
+  local sample_every = tonumber(action:match('^sample:(%d+)$') or '')
+  if sample_every and sample_every >= 1 then
+    return { rate = rate, burst = burst, action = 'sample', sample_every = sample_every }
+  end
+  return nil
+end
+
+-- Function to configure the rate limits from a default limit and a list of rules.
+-- Malformed limits and rules are ignored; the generator validates them beforehand.
+function M.configure_rate_limits(default_spec, rules_spec)
+  M.default_rate_limit = default_spec ~= '' and M.parse_rate_limit(default_spec) or nil
+  M.rate_limit_rules = {}
+  for entry in (rules_spec or ''):gmatch('[^;]+') do
+    local selector, pattern, spec = entry:match('^%s*(%a+):(.-)=([^=]+)$')
+    local limit = spec and M.parse_rate_limit(spec)
+    if limit and (selector == 'container' or selector == 'image') then
+      table.insert(M.rate_limit_rules, { selector = selector, pattern = pattern, limit = limit })
+    else
+      debug_print("Ignoring invalid rate limit rule:", entry)
+    end
+  end
+  M.reset_rate_limits()
+end
+
+-- Function to reset the rate limit buckets and counters
+function M.reset_rate_limits()
+  M.rate_limit_buckets = M.new_lru_cache(M.CACHE_MAX_ENTRIES)
+  M.rate_limit_totals = { dropped = 0, tagged = 0 }
+  M.rate_limit_reported_at = nil
+end
+
+-- Function to find the rate limit of a container: the first matching rule, or the default.
+-- Rules need the container's name and image, which come from the metadata cache. Also returns
+-- the container's name and whether its metadata was found.
+function M.resolve_rate_limit(container_id)
+  if #M.rate_limit_rules == 0 then
+    return M.default_rate_limit, nil, true
+  end
+  local data = M.lookup_container_metadata(container_id, os.time())
+  local resolved = data ~= nil
+  data = data or {}
+  local values = { container = data['docker_container_name'], image = data['docker_container_image'] }
+  for _, rule in ipairs(M.rate_limit_rules) do
+    local value = values[rule.selector]
+    if value then
+      local ok, found = pcall(string.find, value, rule.pattern)
+      if ok and found then
+        return rule.limit, values.container, resolved
+      end
+    end
+  end
+  return M.default_rate_limit, values.container, resolved
+end
+
+-- Function to resolve the limit of a container's bucket again, every M.CACHE_REVALIDATE_SEC
+-- seconds in case it was renamed, and every M.NEGATIVE_CACHE_TTL_SEC seconds while its metadata
+-- is not found. The tokens are kept, up to the burst of the new limit.
+local function revalidate_rate_limit(container_id, bucket, current_time)
+  local interval = bucket.resolved and M.CACHE_REVALIDATE_SEC or M.NEGATIVE_CACHE_TTL_SEC
+  if #M.rate_limit_rules == 0 or current_time - bucket.resolved_at < interval then
+    return
+  end
+  local limit, name, resolved = M.resolve_rate_limit(container_id)
+  bucket.name, bucket.resolved, bucket.resolved_at = name, resolved, current_time
+  if limit ~= bucket.limit then
+    bucket.limit = limit
+    bucket.tokens = limit and math.min(bucket.tokens or limit.burst, limit.burst)
+  end
+end
+
+-- Function to render the rate limit counters of the containers in Prometheus text format
+function M.render_rate_limit_metrics()
+  local lines = {
+    '# HELP docker_rate_limited_records_total Records over their container rate limit, by action.',
+    '# TYPE docker_rate_limited_records_total counter'
+  }
+  local node = M.rate_limit_buckets.head.next
+  while node ~= M.rate_limit_buckets.head do
+    local bucket = node.value
+    if bucket.dropped > 0 or bucket.tagged > 0 then
+      local labels = string.format('container_id="%s",container_name="%s"', node.key, bucket.name or '')
+      table.insert(lines, string.format('docker_rate_limited_records_total{%s,action="drop"} %d', labels, bucket.dropped))
+      table.insert(lines, string.format('docker_rate_limited_records_total{%s,action="tag"} %d', labels, bucket.tagged))
+    end
+    node = node.next
+  end
+  return table.concat(lines, '\n') .. '\n'
+end
+
+-- Function to print the containers that went over their limit since the last report, and
+-- write the rate limit metrics file, at most every M.METRICS_INTERVAL_SEC seconds
+local function maybe_report_rate_limits(current_time)
+  if M.rate_limit_reported_at and current_time - M.rate_limit_reported_at < M.METRICS_INTERVAL_SEC then
+    return
+  end
+  M.rate_limit_reported_at = current_time
+
+  local node = M.rate_limit_buckets.head.next
+  while node ~= M.rate_limit_buckets.head do
+    local bucket = node.value
+    local dropped, tagged = bucket.dropped - bucket.reported_dropped, bucket.tagged - bucket.reported_tagged
+    if dropped > 0 or tagged > 0 then
+      print(string.format("Rate limit: container %s (%s) went over its limit, %d records dropped, %d tagged",
+        node.key, bucket.name or 'unknown', dropped, tagged))
+      bucket.reported_dropped, bucket.reported_tagged = bucket.dropped, bucket.tagged
+    end
+    node = node.next
+  end
+
+  if M.RATE_LIMIT_METRICS_FILE ~= '' then
+    local fl = io.open(M.RATE_LIMIT_METRICS_FILE .. '.tmp', 'w')
+    if fl then
+      fl:write(M.render_rate_limit_metrics())
+      fl:close()
+      os.rename(M.RATE_LIMIT_METRICS_FILE .. '.tmp', M.RATE_LIMIT_METRICS_FILE)
+    end
+  end
+end
+
+-- Function to enforce the per-container rate limits with a token bucket per container.
+-- Buckets refill at the limit's rate, measured on the record timestamps, up to its burst.
+-- Runs before enrichment, so records over the limit are dropped before any metadata work.
+function M.rate_limit_records(tag, timestamp, record)
+  local container_id = M.get_container_id_from_tag(tag)
+  if not container_id then
+    return 0, 0, 0
+  end
+
+  local current_time = os.time()
+  local bucket = M.rate_limit_buckets:get(container_id)
+  if bucket == nil then
+    local limit, name, resolved = M.resolve_rate_limit(container_id)
+    bucket = {
+      limit = limit, name = name, resolved = resolved, resolved_at = current_time, tokens = limit and limit.burst,
+      updated_at = timestamp, over_limit = 0, dropped = 0, tagged = 0, reported_dropped = 0, reported_tagged = 0
+    }
+    M.rate_limit_buckets:set(container_id, bucket)
+  else
+    revalidate_rate_limit(container_id, bucket, current_time)
+  end
+  local limit = bucket.limit
+  if limit == nil then
+    return 0, 0, 0
+  end
+
+  if timestamp > bucket.updated_at then
+    bucket.tokens = math.min(limit.burst, bucket.tokens + (timestamp - bucket.updated_at) * limit.rate)
+    bucket.updated_at = timestamp
+  end
+  if bucket.tokens >= 1 then
+    bucket.tokens = bucket.tokens - 1
+    return 0, 0, 0
+  end
+
+  bucket.over_limit = bucket.over_limit + 1
+  local code = -1
+  if limit.action == 'tag' then
+    record['throttled'] = true
+    bucket.tagged = bucket.tagged + 1
+    M.rate_limit_totals.tagged = M.rate_limit_totals.tagged + 1
+    code = 1
+  elseif limit.action == 'sample' and bucket.over_limit % limit.sample_every == 1 % limit.sample_every then
+    code = 0
+  else
+    bucket.dropped = bucket.dropped + 1
+    M.rate_limit_totals.dropped = M.rate_limit_totals.dropped + 1
+  end
+  maybe_report_rate_limits(current_time)
+  if code == -1 then
+    return -1, 0, 0
+  end
+  return code, timestamp, record
+end
+
+M.configure_rate_limits(M.RATE_LIMIT, M.RATE_LIMIT_RULES)
+
+-- Summaries of the runs ended since the last record, shipped with the next record of any container
+local ended_runs = {}
+
+-- Function to reset the deduplication state, keeping the last message of at most capacity containers
+function M.reset_dedup(capacity)
+  M.dedup_runs = M.new_lru_cache(capacity or M.DEDUP_MAX_CONTAINERS)
+  M.dedup_runs.on_evict = function(_, run)
+    if run.repeats > 0 then
+      table.insert(ended_runs, run)
+    end
+  end
+  M.dedup_checked_at = nil
+  ended_runs = {}
+end
+
+M.reset_dedup()
+
+-- Function to format a record timestamp as an ISO 8601 UTC time with microseconds
+local function format_timestamp(timestamp)
+  local seconds = math.floor(timestamp)
+  local microseconds = math.floor((timestamp - seconds) * 1000000)
+  return os.date('!%Y-%m-%dT%H:%M:%S', seconds) .. string.format('.%06dZ', microseconds)
+end
+
+-- Function to build the record standing for the repeats collapsed in a run
+local function dedup_summary(run)
+  local summary = {}
+  for key, value in pairs(run.record) do
+    summary[key] = value
+  end
+  summary['repeat_count'] = run.repeats
+  summary['first_timestamp'] = format_timestamp(run.started_at)
+  summary['last_timestamp'] = format_timestamp(run.last_repeat_at)
+  return summary
+end
+
+-- Function to end the runs opened at least M.DEDUP_WINDOW_SEC ago, so the repeats of a
+-- container that went quiet are shipped. Checked at most once per second.
+local function end_expired_runs(current_time)
+  if M.dedup_checked_at == current_time then
+    return
+  end
+  M.dedup_checked_at = current_time
+  for key, node in pairs(M.dedup_runs.nodes) do
+    local run = node.value
+    if current_time - run.opened_at >= M.DEDUP_WINDOW_SEC then
+      M.dedup_runs:delete(key)
+      if run.repeats > 0 then
+        table.insert(ended_runs, run)
+      end
+    end
+  end
+end
+
+-- Function to collapse consecutive identical messages of a container. The first record of
+-- a run is shipped right away; identical messages within M.DEDUP_WINDOW_SEC of it are held
+-- back and counted. The next record that ends the run (another message, or the same one
+-- after the window) is preceded by a copy of the repeated record with repeat_count, and the
+-- timestamps of the run's first record and last repeat, so the container's order is kept.
+-- Runs are tracked by tag, which is unique per container log file. Runs that no record of
+-- their container ended within the window, or that were evicted to make room for another
+-- container, are shipped with the next record of any container.
+function M.deduplicate_records(tag, timestamp, record)
+  end_expired_runs(os.time())
+  local message = record['message']
+  local run = M.dedup_runs:get(tag)
+
+  if type(message) == 'string' and run and run.message == message
+      and timestamp - run.started_at < M.DEDUP_WINDOW_SEC then
+    run.repeats = run.repeats + 1
+    run.last_repeat_at = timestamp
+    if #ended_runs == 0 then
+      return -1, 0, 0
+    end
+    record = nil
+  else
+    if run and run.repeats > 0 then
+      M.dedup_runs:delete(tag)
+      table.insert(ended_runs, run)
+    end
+    if type(message) == 'string' then
+      M.dedup_runs:set(tag, { message = message, record = record, started_at = timestamp, repeats = 0,
+                              opened_at = os.time() })
+    else
+      -- Structured messages are not compared; they end the current run
+      M.dedup_runs:delete(tag)
+    end
+    if #ended_runs == 0 then
+      return 0, 0, 0
+    end
+  end
+
+  local records = {}
+  for _, ended_run in ipairs(ended_runs) do
+    table.insert(records, dedup_summary(ended_run))
+  end
+  ended_runs = {}
+  if record then
+    table.insert(records, record)
+  end
+  return 1, timestamp, records
+end
+
+-- Function to parse the backfill snapshot lines, each holding an inode, the cut offset and
+-- the path of a log file separated by tabs. Returns the files by path and their number.
+function M.parse_backfill_snapshot(lines)
+  local files, count = {}, 0
+  for line in lines do
+    local cut, path = line:match('^%d+\t(%d+)\t(.+)$')
+    if cut then
+      files[path] = { cut = tonumber(cut), last_offset = -1, done = false }
+      count = count + 1
+    end
+  end
+  return files, count
+end
+
+-- Function to load the backfill snapshot once. Without a snapshot every backfill record is
+-- dropped, since the live input then ships every line.
+function M.load_backfill_snapshot()
+  local fl = io.open(M.BACKFILL_SNAPSHOT_FILE, 'r')
+  if fl == nil then
+    M.backfill_files, M.backfill_remaining = {}, 0
+    return
+  end
+  M.backfill_files, M.backfill_remaining = M.parse_backfill_snapshot(fl:lines())
+  fl:close()
+end
+
+-- Function to keep the backfill records of the lines before the cut of their file, which the
+-- live input does not ship. Lines of files missing from the snapshot, lines at or after the
+-- cut, and lines of a newer file at the same path after a rotation, whose offsets go back,
+-- are dropped.
+function M.backfill_cutoff(tag, timestamp, record)
+  -- A timed out partial line retagged to its own file was cut before it was held
+  if record[M.PARTIAL_TAG_KEY] ~= nil then
+    return 0, 0, 0
+  end
+  if M.backfill_files == nil then
+    M.load_backfill_snapshot()
+  end
+  local path, offset = record[M.BACKFILL_PATH_KEY], tonumber(record[M.BACKFILL_OFFSET_KEY])
+  record[M.BACKFILL_PATH_KEY] = nil
+  record[M.BACKFILL_OFFSET_KEY] = nil
+
+  local file = path and M.backfill_files[path]
+  if not file or file.done or offset == nil or offset <= file.last_offset then
+    return -1, 0, 0
+  end
+  if offset >= file.cut then
+    file.done = true
+    M.backfill_remaining = M.backfill_remaining - 1
+    if M.backfill_remaining == 0 then
+      print("Backfill: every log file was read up to where the live input started")
+    end
+    return -1, 0, 0
+  end
+  file.last_offset = offset
+  return 1, timestamp, record
+end
+
+-- Function to reset the partial lines being reassembled
+function M.reset_partial_lines()
+  M.partial_lines = {}
+end
+
+M.reset_partial_lines()
+
+-- Function to add a fragment to an event, keeping at most M.MAX_EVENT_SIZE bytes of it.
+-- Once an event is truncated, its later fragments are dropped.
+local function append_fragment(event, fragment)
+  if event.truncated then
+    return
+  end
+  local room = M.MAX_EVENT_SIZE - event.size
+  if #fragment > room then
+    fragment = fragment:sub(1, room)
+    event.truncated = true
+  end
+  table.insert(event.parts, fragment)
+  event.size = event.size + #fragment
+end
+
+-- Function to build the record of an event from its first fragment's record and its parts
+local function event_record(event, tag)
+  local record = event.record
+  record['log'] = table.concat(event.parts)
+  if event.truncated then
+    record[M.TRUNCATED_KEY] = true
+  end
+  if event.tag ~= tag then
+    record[M.PARTIAL_TAG_KEY] = event.tag
+  end
+  return record
+end
+
+-- Function to ship the partial lines whose next fragment did not come within
+-- M.PARTIAL_LINE_TIMEOUT_SEC, such as the last output of a container that stopped mid-line.
+-- Called on each heartbeat record, which is dropped.
+local function flush_partial_lines(tag, timestamp)
+  local current_time = os.time()
+  local records = {}
+  for key, event in pairs(M.partial_lines) do
+    if current_time - event.updated_at >= M.PARTIAL_LINE_TIMEOUT_SEC then
+      M.partial_lines[key] = nil
+      table.insert(records, event_record(event, tag))
+    end
+  end
+  if #records == 0 then
+    return -1, 0, 0
+  end
+  return 1, timestamp, records
+end
+
+-- Function to reassemble the lines Docker's json-file driver splits into partial lines of
+-- 16KB. Every fragment but the last has a log that does not end with a newline. Fragments are
+-- held by tag, which is unique per container log file, and stream, until the last one comes;
+-- the event then takes the place of the last fragment. Events, including complete lines
+-- joined by a multiline parser, are cut to M.MAX_EVENT_SIZE bytes.
+-- Partial lines whose next fragment did not come in time are shipped on the next heartbeat.
+-- Fragments are only held in memory, so the ones held when Fluent Bit stops are lost.
+function M.reassemble_partial_lines(tag, timestamp, record)
+  if tag == M.PARTIAL_LINE_HEARTBEAT_TAG then
+    return flush_partial_lines(tag, timestamp)
+  end
+  -- A timed out partial line retagged to its own container is already an event
+  if record[M.PARTIAL_TAG_KEY] ~= nil then
+    return 0, 0, 0
+  end
+  local log = record['log']
+  if type(log) ~= 'string' then
+    return 0, 0, 0
+  end
+
+  local current_time = os.time()
+  local records = {}
+  local key = tag .. '\0' .. tostring(record['stream'] or '')
+  local event = M.partial_lines[key]
+  -- A fragment that comes after the timeout starts a new event
+  if event ~= nil and current_time - event.updated_at >= M.PARTIAL_LINE_TIMEOUT_SEC then
+    M.partial_lines[key] = nil
+    table.insert(records, event_record(event, tag))
+    event = nil
+  end
+
+  local complete = log:sub(-1) == '\n'
+  if event == nil and complete and #log <= M.MAX_EVENT_SIZE and #records == 0 then
+    return 0, 0, 0
+  end
+
+  if event == nil then
+    event = { tag = tag, record = record, timestamp = timestamp, parts = {}, size = 0, truncated = false }
+  end
+  append_fragment(event, log)
+  event.updated_at = current_time
+  if not complete then
+    M.partial_lines[key] = event
+    if #records == 0 then
+      return -1, 0, 0
+    end
+    return 1, timestamp, records
+  end
+
+  M.partial_lines[key] = nil
+  table.insert(records, event_record(event, tag))
+  if #records == 1 then
+    return 1, event.timestamp, records[1]
+  end
+  return 1, timestamp, records
+end
+
 -- Make functions globally accessible
 _G['enrich_with_docker_metadata'] = M.enrich_with_docker_metadata
+_G['rate_limit_records'] = M.rate_limit_records
+_G['deduplicate_records'] = M.deduplicate_records
+_G['backfill_cutoff'] = M.backfill_cutoff
+_G['reassemble_partial_lines'] = M.reassemble_partial_lines
 
-return M
\ No newline at end of file
+return M
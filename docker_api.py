@@ -0,0 +1,99 @@
+import http.client
+import json
+import socket
+import urllib.parse
+
+# Define constants for the Docker Engine API
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+DOCKER_API_TIMEOUT_SEC = 5
+
+
+class DockerAPIError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+# HTTP connection to the Docker Engine API over its Unix socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=DOCKER_API_TIMEOUT_SEC):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _get_json(socket_path, path):
+    connection = UnixHTTPConnection(socket_path)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        body = response.read()
+    except OSError as e:
+        raise DockerAPIError(f"Docker API request 'GET {path}' on {socket_path} failed: {e}") from e
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        raise DockerAPIError(f"Docker API request 'GET {path}' returned status {response.status}", response.status)
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        raise DockerAPIError(f"Docker API request 'GET {path}' returned invalid JSON: {e}") from e
+
+
+def list_containers(socket_path=DEFAULT_DOCKER_SOCKET):
+    # Return the ID, name and image of every container, running or not
+    containers = []
+    for container in _get_json(socket_path, '/containers/json?all=1'):
+        names = container.get('Names') or ['']
+        containers.append({
+            'id': container['Id'],
+            'name': names[0].lstrip('/'),
+            'image': container.get('Image', ''),
+        })
+    return containers
+
+
+def inspect_container(socket_path, container_id):
+    # Return the inspect document of a container, or None when it no longer exists
+    try:
+        return _get_json(socket_path, f'/containers/{container_id}/json')
+    except DockerAPIError as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+def stream_events(socket_path=DEFAULT_DOCKER_SOCKET, since=None, until=None):
+    # Yield Docker container events as they happen, until the connection closes. With until,
+    # Docker closes the connection at that time.
+    filters = urllib.parse.quote(json.dumps({'type': ['container']}))
+    path = f'/events?filters={filters}'
+    if since is not None:
+        path += f'&since={since}'
+    if until is not None:
+        path += f'&until={until}'
+    connection = UnixHTTPConnection(socket_path, timeout=None)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        if response.status != 200:
+            raise DockerAPIError(f"Docker API request 'GET {path}' returned status {response.status}",
+                                 response.status)
+        while True:
+            line = response.readline()
+            if not line:
+                return
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    raise DockerAPIError(f"Docker API events stream returned invalid JSON: {e}") from e
+    except OSError as e:
+        raise DockerAPIError(f"Docker API request 'GET {path}' on {socket_path} failed: {e}") from e
+    finally:
+        connection.close()
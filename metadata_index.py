@@ -0,0 +1,158 @@
+import os
+import re
+import time
+
+import docker_api
+
+# Define constants for the metadata index
+RETRY_INTERVAL_SEC = 5
+# Seconds between writes of the index while no container changes, so the Lua filter can tell
+# the indexer is still running from its heartbeat
+HEARTBEAT_INTERVAL_SEC = 30
+LABEL_FIELD_PREFIX = 'docker_container_label_'
+ENV_FIELD_PREFIX = 'docker_container_env_'
+
+# Container events after which the metadata of the container is looked up again
+INDEXED_EVENTS = ('create', 'start', 'restart', 'rename', 'update', 'destroy')
+
+# Functions extracting each built-in metadata field from a container inspect document, or None
+# when it is missing. They return the same values docker-metadata.lua reads from config.v2.json.
+METADATA_FIELDS = {
+    'docker_container_name': lambda container: (container.get('Name') or '').lstrip('/') or None,
+    'docker_container_image': lambda container: (container.get('Config') or {}).get('Image'),
+    'docker_container_started': lambda container: (container.get('State') or {}).get('StartedAt'),
+}
+
+
+def split_list(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def field_name(prefix, key):
+    return prefix + re.sub(r'[^A-Za-z0-9_]', '_', key)
+
+
+def escape_value(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+# Keeps a file with the metadata of every container up to date from Docker events, so the
+# Lua filter does not need to read config files. Each line of the file holds a container ID
+# followed by tab separated field and value pairs. The first line holds a generation that
+# changes only with the entries, which the Lua filter checks to reload the file only when they
+# changed; the second holds a heartbeat that changes on every write.
+class MetadataIndexer:
+    def __init__(self, socket_path, index_path, fields=None, labels=(), env_keys=()):
+        self.socket_path = socket_path
+        self.index_path = index_path
+        if fields is None:
+            fields = sorted(METADATA_FIELDS)
+        self.fields = [field for field in fields if field in METADATA_FIELDS]
+        self.labels = list(labels)
+        self.env_keys = list(env_keys)
+        self.entries = {}
+        self.written_entries = None
+        self.generation = None
+
+    def container_fields(self, container):
+        config = container.get('Config') or {}
+        data = {}
+        for field in self.fields:
+            value = METADATA_FIELDS[field](container)
+            if value is not None:
+                data[field] = value
+        container_labels = config.get('Labels') or {}
+        for label in self.labels:
+            if label in container_labels:
+                data[field_name(LABEL_FIELD_PREFIX, label)] = container_labels[label]
+        container_env = dict(entry.split('=', 1) for entry in config.get('Env') or [] if '=' in entry)
+        for env_key in self.env_keys:
+            if env_key in container_env:
+                data[field_name(ENV_FIELD_PREFIX, env_key)] = container_env[env_key]
+        return data
+
+    def update(self, container_id):
+        # Look up a container again, returning whether its entry changed
+        container = docker_api.inspect_container(self.socket_path, container_id)
+        if container is None:
+            return self.entries.pop(container_id, None) is not None
+        data = self.container_fields(container)
+        if self.entries.get(container_id) == data:
+            return False
+        self.entries[container_id] = data
+        return True
+
+    def write(self):
+        # Replace the index file atomically so the Lua filter never reads a partial file
+        if self.entries != self.written_entries:
+            self.generation = time.time_ns()
+            self.written_entries = dict(self.entries)
+        lines = [f'# generation {self.generation}', f'# heartbeat {time.time_ns()}']
+        for container_id, data in sorted(self.entries.items()):
+            lines.append(container_id + ''.join(f'\t{key}\t{escape_value(value)}' for key, value in data.items()))
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.index_path)
+
+    def sync(self):
+        # Index every container from scratch. Returns the time to follow events from, taken
+        # before listing so no event happening meanwhile is missed.
+        since = int(time.time())
+        self.entries = {}
+        for container in docker_api.list_containers(self.socket_path):
+            self.update(container['id'])
+        self.write()
+        return since
+
+    def handle_event(self, event):
+        if event.get('Type') != 'container' or event.get('Action') not in INDEXED_EVENTS:
+            return False
+        container_id = (event.get('Actor') or {}).get('ID') or event.get('id')
+        if not container_id:
+            return False
+        if event['Action'] == 'destroy':
+            return self.entries.pop(container_id, None) is not None
+        return self.update(container_id)
+
+    def follow_events(self, since):
+        # Update the index on container events until the events stream closes. Events are
+        # followed in windows of HEARTBEAT_INTERVAL_SEC, and the index is written after each one.
+        while True:
+            until = int(time.time()) + HEARTBEAT_INTERVAL_SEC
+            for event in docker_api.stream_events(self.socket_path, since, until):
+                if self.handle_event(event):
+                    self.write()
+            if time.time() < until:
+                return
+            self.write()
+            since = until
+
+    def run(self):
+        while True:
+            try:
+                since = self.sync()
+                print(f"Indexed the metadata of {len(self.entries)} containers in {self.index_path}")
+                self.follow_events(since)
+                print("Warning: The Docker events stream closed, indexing the containers again.")
+            except (OSError, docker_api.DockerAPIError) as e:
+                print(f"Warning: Could not update the container metadata index: {e}")
+            except Exception as e:
+                # Keep indexing; a stopped indexer would leave the Lua filter on a stale index
+                print(f"Warning: Unexpected error updating the container metadata index: {e!r}")
+            time.sleep(RETRY_INTERVAL_SEC)
+
+
+def main():
+    indexer = MetadataIndexer(
+        os.getenv('DOCKER_SOCKET', docker_api.DEFAULT_DOCKER_SOCKET),
+        os.environ['DOCKER_METADATA_INDEX_FILE'],
+        split_list(os.getenv('DOCKER_METADATA_FIELDS')) if os.getenv('DOCKER_METADATA_FIELDS') is not None else None,
+        split_list(os.getenv('DOCKER_METADATA_LABELS')),
+        split_list(os.getenv('DOCKER_METADATA_ENV')),
+    )
+    indexer.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import multiprocessing
+import re
+import string
+import time
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+# Possessive repeats and atomic groups exist from Python 3.11
+POSSESSIVE_REPEAT = getattr(sre_constants, 'POSSESSIVE_REPEAT', None)
+ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+
+# Define constants for the regex cost analysis
+EXPONENTIAL = 'exponential'
+POLYNOMIAL = 'polynomial'
+PATHOLOGICAL_LINE_LENGTH = 2048
+NEAR_MISS_REPEATS = 32
+LINES_PER_ESTIMATE = 10000
+
+# Characters the character classes of a pattern are compared on, to tell whether two parts of
+# it can match the same text
+ALPHABET = string.printable + 'é '
+
+# Container log lines of the usual shapes, the lines a pattern's cost per line is estimated on
+TYPICAL_LINES = [
+    '{"level":"info","ts":"2024-05-01T12:00:00.123Z","caller":"server/handler.go:87","msg":"request served",'
+    '"method":"GET","path":"/api/v1/orders","status":200,"duration_ms":12}',
+    '10.0.0.12 - - [01/May/2024:12:00:00 +0000] "GET /api/v1/orders?page=2 HTTP/1.1" 200 5123 "-" '
+    '"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"',
+    '2024-05-01 12:00:00.123 ERROR 1 --- [nio-8080-exec-3] c.e.orders.OrderController : '
+    'Failed to process order 81723: connection refused',
+    '\tat com.example.orders.OrderRepository.save(OrderRepository.java:142)',
+    'Traceback (most recent call last):',
+    '  File "/app/worker.py", line 57, in handle_message',
+    'time="2024-05-01T12:00:00Z" level=warning msg="retrying request" attempt=3 backoff=2s component=client',
+    'I0501 12:00:00.123456       1 reflector.go:255] Listing and watching *v1.Pod from informers/factory.go:134',
+    'panic: runtime error: invalid memory address or nil pointer dereference',
+    '[2024-05-01 12:00:00,123] INFO [Consumer clientId=consumer-1, groupId=orders] Resetting offset '
+    'for partition orders-3 to position FetchPosition{offset=18271} (org.apache.kafka.clients.consumer)',
+    'LOG:  duration: 1523.112 ms  statement: SELECT o.id, o.total FROM orders o JOIN customers c ON '
+    'c.id = o.customer_id WHERE c.region = \'eu-west-1\' AND o.created_at > now() - interval \'1 day\'',
+    'ok',
+]
+
+# Pieces the pathological lines are made of: single character classes, and the separators
+# patterns usually place between their repeats
+PATHOLOGICAL_UNITS = ['a', '0', ' ', '\t', '.', '-', '/', ',', '=', ':', '"', '\\', 'a ', 'a,', 'a=', 'a.',
+                      'a/', 'a-', 'a:', '0.', 'a0', '{"a":']
+
+
+def pathological_lines():
+    # Lines built to make backtracking patterns slow. Long runs of one unit make overlapping
+    # repeats quadratic; short runs followed by a character that fails the match make nested
+    # repeats exponential.
+    lines = []
+    for unit in PATHOLOGICAL_UNITS:
+        lines.append(unit * (PATHOLOGICAL_LINE_LENGTH // len(unit)))
+        lines.append(unit * NEAR_MISS_REPEATS + '!')
+    return lines
+
+
+def _category_predicate(category):
+    predicates = {
+        sre_constants.CATEGORY_DIGIT: str.isdigit,
+        sre_constants.CATEGORY_SPACE: str.isspace,
+        sre_constants.CATEGORY_WORD: lambda char: char.isalnum() or char == '_',
+        sre_constants.CATEGORY_LINEBREAK: lambda char: char == '\n',
+    }
+    negated = {
+        sre_constants.CATEGORY_NOT_DIGIT: sre_constants.CATEGORY_DIGIT,
+        sre_constants.CATEGORY_NOT_SPACE: sre_constants.CATEGORY_SPACE,
+        sre_constants.CATEGORY_NOT_WORD: sre_constants.CATEGORY_WORD,
+        sre_constants.CATEGORY_NOT_LINEBREAK: sre_constants.CATEGORY_LINEBREAK,
+    }
+    if category in negated:
+        predicate = predicates[negated[category]]
+        return lambda char: not predicate(char)
+    return predicates.get(category, lambda char: True)
+
+
+def _class_chars(items):
+    # Characters of the alphabet a character class such as [^,\s] matches
+    chars = set()
+    negate = False
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            negate = True
+        elif op is sre_constants.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_constants.RANGE:
+            chars.update(char for char in ALPHABET if av[0] <= ord(char) <= av[1])
+        elif op is sre_constants.CATEGORY:
+            chars.update(filter(_category_predicate(av), ALPHABET))
+        else:
+            chars.update(ALPHABET)
+    return set(ALPHABET) - chars if negate else chars
+
+
+def _chars(subpattern, first_only=False):
+    # Characters of the alphabet a part of a pattern can consume, or only the ones it can start with
+    chars = set()
+    for op, av in subpattern:
+        item_chars = set()
+        if op is sre_constants.LITERAL:
+            item_chars = {chr(av)}
+        elif op is sre_constants.NOT_LITERAL:
+            item_chars = set(ALPHABET) - {chr(av)}
+        elif op is sre_constants.ANY:
+            item_chars = set(ALPHABET) - {'\n'}
+        elif op is sre_constants.IN:
+            item_chars = _class_chars(av)
+        elif op is sre_constants.SUBPATTERN:
+            item_chars = _chars(av[-1], first_only)
+        elif op is ATOMIC_GROUP:
+            item_chars = _chars(av, first_only)
+        elif op is sre_constants.BRANCH:
+            for branch in av[1]:
+                item_chars |= _chars(branch, first_only)
+        elif op in _repeat_ops() or op is POSSESSIVE_REPEAT:
+            item_chars = _chars(av[2], first_only)
+        elif op is sre_constants.GROUPREF:
+            item_chars = set(ALPHABET)
+        chars |= item_chars
+        if first_only and _min_width(subpattern, op, av) > 0:
+            break
+    return chars
+
+
+def _repeat_ops():
+    # Possessive repeats never backtrack, so only the greedy and lazy ones are analyzed
+    return (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+
+def _min_width(subpattern, op, av):
+    return sre_parse.SubPattern(subpattern.state, [(op, av)]).getwidth()[0]
+
+
+def _is_unbounded_repeat(op, av):
+    return op in _repeat_ops() and av[1] == sre_constants.MAXREPEAT
+
+
+def _sequence(subpattern):
+    # Items of a sequence, with the groups inlined
+    items = []
+    for op, av in subpattern:
+        if op is sre_constants.SUBPATTERN:
+            items += _sequence(av[-1])
+        else:
+            items.append((op, av))
+    return items
+
+
+def _children(op, av):
+    # Sub-patterns directly inside an item
+    if op is sre_constants.SUBPATTERN:
+        return [av[-1]]
+    if op is sre_constants.BRANCH:
+        return list(av[1])
+    if op in _repeat_ops() or op is POSSESSIVE_REPEAT:
+        return [av[2]]
+    if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        return [av[1]]
+    if op is ATOMIC_GROUP:
+        return [av]
+    return []
+
+
+def _walk(subpattern):
+    # Every sub-pattern of a pattern, the pattern itself first
+    yield subpattern
+    for op, av in subpattern:
+        for child in _children(op, av):
+            yield from _walk(child)
+
+
+def _unbounded_repeats(subpattern):
+    return [(op, av) for part in _walk(subpattern) for op, av in part if _is_unbounded_repeat(op, av)]
+
+
+def _separated(subpattern, items, repeat_chars):
+    # Whether a mandatory item matching none of a repeat's characters lies among the items, so
+    # the repeat cannot run over into the text of the next one
+    return any(_min_width(subpattern, op, av) > 0 and not (_chars([(op, av)]) & repeat_chars)
+               for op, av in items)
+
+
+def _check_repeat_body(subpattern, body, findings):
+    items = _sequence(body)
+    # A repeat inside a repeat can split the same text between its iterations in exponentially
+    # many ways, unless something the inner repeat cannot match ends every iteration
+    for index, (op, av) in enumerate(items):
+        for _, inner_av in _unbounded_repeats(sre_parse.SubPattern(body.state, [(op, av)])):
+            others = items[:index] + items[index + 1:]
+            if not _separated(body, others, _chars(inner_av[2])):
+                findings.append((EXPONENTIAL, 'nests a repeat inside a repeat, which backtracks exponentially '
+                                              'on lines that almost match'))
+                return
+    # So can alternatives that start with the same characters
+    for op, av in items:
+        if op is sre_constants.BRANCH:
+            firsts = [_chars(branch, first_only=True) for branch in av[1]]
+            if any(firsts[i] & firsts[j] for i in range(len(firsts)) for j in range(i + 1, len(firsts))):
+                findings.append((EXPONENTIAL, 'repeats alternatives that can match the same text, which '
+                                              'backtracks exponentially on lines that almost match'))
+                return
+
+
+def _check_sequence(subpattern, findings, top_level):
+    items = _sequence(subpattern)
+    repeats = [index for index, (op, av) in enumerate(items) if _is_unbounded_repeat(op, av)]
+    if top_level:
+        # Onigmo tries a pattern starting with .* only at the start of a line, and a repeat
+        # ending the pattern never has to give text back
+        if repeats and repeats[0] == 0 and items[0][1][2].data == [(sre_constants.ANY, None)]:
+            repeats = repeats[1:]
+        if repeats and repeats[-1] == len(items) - 1:
+            repeats = repeats[:-1]
+    # Two repeats can split the same text between them only when the second one can start with
+    # a character the first one consumes, as in \w+\w+ but not in [a-z]+(-[a-z]+)*
+    for position, first in enumerate(repeats):
+        first_chars = _chars(items[first][1][2])
+        for second in repeats[position + 1:]:
+            if first_chars & _chars(items[second][1][2], first_only=True) and \
+                    not _separated(subpattern, items[first + 1:second], first_chars):
+                findings.append((POLYNOMIAL, 'has repeats that can match the same text one after the other, '
+                                             'which backtracks polynomially on long lines'))
+                return
+
+
+def find_super_linear_constructs(pattern):
+    # (severity, description) of the constructs that can make a pattern take more than linear
+    # time in the line length. Exponential ones can stall Fluent Bit on a single line.
+    parsed = sre_parse.parse(pattern)
+    findings = []
+    for part in _walk(parsed):
+        for op, av in part:
+            if _is_unbounded_repeat(op, av) or (op in _repeat_ops() and av[1] > 1):
+                _check_repeat_body(part, av[2], findings)
+            if op is sre_constants.GROUPREF:
+                findings.append((POLYNOMIAL, 'uses a backreference, which can backtrack polynomially on long lines'))
+        _check_sequence(part, findings, part is parsed)
+    # Report each kind of construct once
+    return list(dict.fromkeys(findings))
+
+
+def _starts_with_any_star(pattern):
+    parsed = sre_parse.parse(pattern)
+    if not parsed.data or parsed.state.flags & re.DOTALL:
+        return False
+    op, av = parsed.data[0]
+    return op is sre_constants.MAX_REPEAT and av[0] == 0 and av[2].data == [(sre_constants.ANY, None)]
+
+
+def _time_patterns(connection, patterns, lines):
+    # Runs in a child process, sending the seconds each pattern takes on each line
+    for pattern in patterns:
+        compiled = re.compile(pattern)
+        # Onigmo tries a pattern starting with .* only at the start of a line, like match does
+        search = compiled.match if _starts_with_any_star(pattern) else compiled.search
+        times = []
+        for line in lines:
+            start = time.perf_counter()
+            search(line)
+            times.append(time.perf_counter() - start)
+        connection.send(times)
+    connection.close()
+
+
+def time_patterns(patterns, lines, timeout):
+    # Seconds each pattern takes on each line, or None for a pattern still running after the
+    # timeout. The patterns run in a child process, so one that backtracks forever is killed.
+    results = {}
+    pending = list(patterns)
+    while pending:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_time_patterns, args=(sender, pending, lines), daemon=True)
+        process.start()
+        sender.close()
+        while pending:
+            try:
+                if not receiver.poll(timeout):
+                    results[pending.pop(0)] = None
+                    break
+                results[pending[0]] = receiver.recv()
+                pending.pop(0)
+            except EOFError:
+                results[pending.pop(0)] = None
+                break
+        process.kill()
+        process.join()
+        receiver.close()
+    return results
+
+
+def analyze_patterns(patterns, line_budget_ms):
+    # Analysis of every pattern: the super-linear constructs found in it, the most time it took
+    # on one line of the corpus, None when it was still running after the timeout, and its
+    # estimated cost per 10k typical lines. Patterns Python cannot parse get an error instead.
+    results = {}
+    timed = []
+    for pattern in dict.fromkeys(patterns):
+        try:
+            re.compile(pattern)
+            results[pattern] = {'findings': find_super_linear_constructs(pattern), 'error': None}
+            timed.append(pattern)
+        except (re.error, RecursionError) as e:
+            results[pattern] = {'findings': [], 'error': str(e), 'worst_ms': 0.0, 'cost_ms': 0.0}
+
+    lines = TYPICAL_LINES + pathological_lines()
+    timeout = line_budget_ms / 1000 * len(lines) + 1
+    for pattern, times in time_patterns(timed, lines, timeout).items():
+        if times is None:
+            results[pattern].update(worst_ms=None, cost_ms=None)
+            continue
+        typical = times[:len(TYPICAL_LINES)]
+        results[pattern].update(worst_ms=max(times) * 1000,
+                                cost_ms=sum(typical) / len(typical) * 1000 * LINES_PER_ESTIMATE)
+    return results
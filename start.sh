@@ -1,8 +1,37 @@
 #!/bin/bash
 set -e  # Exit immediately if a command exits with a non-zero status
 
+# Let Fluent Bit keep every log file open on large hosts, up to the hard limit of the container
+if [ "${SCALING_MODE}" = "auto" ]; then
+    ulimit -n "$(ulimit -Hn)" || echo "Warning: Could not raise the open file limit."
+fi
+
 # Run the Python script to generate the Fluent Bit configuration files
 python3 /opt/fluent-bit/docker-collector-logs/create_fluent_bit_config.py
 
-# Start Fluent Bit using the generated configuration
-exec /usr/local/bin/fluent-bit -e /fluent-bit/plugins/out_logzio.so -c /fluent-bit/etc/fluent-bit.conf -vv
+# Keep the container metadata index up to date from Docker events, restarting the indexer
+# if it exits
+if [ -n "${DOCKER_METADATA_INDEX_FILE}" ]; then
+    (
+        while true; do
+            python3 /opt/fluent-bit/docker-collector-logs/metadata_index.py \
+                || echo "Warning: The container metadata indexer exited with code $?, restarting it."
+            sleep 5
+        done
+    ) &
+fi
+
+# Keep the tail paths up to date when they depend on the containers running on the host,
+# run one Fluent Bit process per shard when sharded, and remove the backfill inputs once
+# the history was read
+if [ "${CONTAINER_FILTER_MODE}" = "path" ] || [ "${JSON_DECODE_MODE}" = "selective" ] || [ -n "${MULTILINE_RULES}" ] \
+    || [ "${SHARDS:-1}" != "1" ] || [ "${BACKFILL_MODE}" = "on" ]; then
+    exec python3 /opt/fluent-bit/docker-collector-logs/supervisor.py
+fi
+
+# Start Fluent Bit using the generated configuration, loading the Logz.io plugin unless the
+# native http output is used or an agent forwards the logs
+if [ "${OUTPUT_ENGINE}" = "native" ] || [ "${ROLE}" = "agent" ]; then
+    exec /usr/local/bin/fluent-bit -c /fluent-bit/etc/fluent-bit.conf
+fi
+exec /usr/local/bin/fluent-bit -e /fluent-bit/plugins/out_logzio.so -c /fluent-bit/etc/fluent-bit.conf
@@ -0,0 +1,180 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import create_fluent_bit_config
+
+# Define constants for the supervised Fluent Bit process
+FLUENT_BIT_BIN = "/usr/local/bin/fluent-bit"
+STOP_TIMEOUT_SEC = 30
+POLL_INTERVAL_SEC = 1
+RESTART_DELAY_SEC = 5
+
+
+def fluent_bit_command(config_path, load_plugin=True):
+    # The Logz.io plugin is only loaded when an output uses it
+    if not load_plugin:
+        return [FLUENT_BIT_BIN, '-c', config_path]
+    return [FLUENT_BIT_BIN, '-e', create_fluent_bit_config.PLUGIN_PATH, '-c', config_path]
+
+
+# Runs Fluent Bit as a child process, forwards termination signals to it and
+# periodically re-renders its configuration, restarting it when the result changes.
+# env holds environment variables set for the process on top of the supervisor's own.
+class Supervisor:
+    def __init__(self, command, config_path, render_config, refresh_interval, env=None):
+        self.command = command
+        self.config_path = config_path
+        self.render_config = render_config
+        self.refresh_interval = refresh_interval
+        self.env = env
+        self.process = None
+        self.stopping = False
+
+    def start(self):
+        env = {**os.environ, **self.env} if self.env else None
+        self.process = subprocess.Popen(self.command, env=env)
+        print(f"Started Fluent Bit with PID {self.process.pid}")
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=STOP_TIMEOUT_SEC)
+        except subprocess.TimeoutExpired:
+            print(f"Warning: Fluent Bit did not stop within {STOP_TIMEOUT_SEC} seconds, killing it.")
+            self.process.kill()
+            self.process.wait()
+
+    def refresh(self):
+        # Re-render the configuration and restart Fluent Bit if it changed
+        new_config = self.render_config()
+        try:
+            with open(self.config_path, 'r') as file:
+                current_config = file.read()
+        except FileNotFoundError:
+            current_config = None
+
+        if new_config == current_config:
+            return False
+
+        create_fluent_bit_config.save_config_file(new_config, self.config_path)
+        print("Fluent Bit configuration changed, restarting Fluent Bit.")
+        self.stop()
+        self.start()
+        return True
+
+    def _forward_signal(self, signum, frame):
+        self.stopping = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signum)
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._forward_signal)
+
+        self.start()
+        next_refresh = time.monotonic() + self.refresh_interval
+        while True:
+            returncode = self.process.poll()
+            if returncode is not None:
+                print(f"Fluent Bit exited with code {returncode}")
+                return returncode
+
+            if not self.stopping and time.monotonic() >= next_refresh:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Warning: Could not refresh the Fluent Bit configuration: {e}")
+                next_refresh = time.monotonic() + self.refresh_interval
+
+            time.sleep(POLL_INTERVAL_SEC)
+
+
+# Runs one Supervisor per shard process. Shards that exit are restarted after
+# RESTART_DELAY_SEC, and termination signals are forwarded to every shard.
+class ShardSupervisor:
+    def __init__(self, supervisors, refresh_interval):
+        self.supervisors = supervisors
+        self.refresh_interval = refresh_interval
+        self.restart_at = {}
+        self.stopping = False
+
+    def _forward_signal(self, signum, frame):
+        self.stopping = True
+        for supervisor in self.supervisors:
+            supervisor._forward_signal(signum, frame)
+
+    def restart_exited(self):
+        # Restart the shards whose process exited once RESTART_DELAY_SEC passed
+        now = time.monotonic()
+        for index, supervisor in enumerate(self.supervisors):
+            returncode = supervisor.process.poll()
+            if returncode is None:
+                continue
+            if index not in self.restart_at:
+                print(f"Fluent Bit shard {index} exited with code {returncode}, "
+                      f"restarting it in {RESTART_DELAY_SEC} seconds.")
+                self.restart_at[index] = now + RESTART_DELAY_SEC
+            elif now >= self.restart_at[index]:
+                del self.restart_at[index]
+                supervisor.start()
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._forward_signal)
+
+        for supervisor in self.supervisors:
+            supervisor.start()
+        next_refresh = time.monotonic() + self.refresh_interval
+        while True:
+            if self.stopping:
+                returncodes = [supervisor.process.poll() for supervisor in self.supervisors]
+                if all(returncode is not None for returncode in returncodes):
+                    print(f"Fluent Bit shards exited with codes {returncodes}")
+                    return max(returncodes)
+            else:
+                self.restart_exited()
+
+            if not self.stopping and time.monotonic() >= next_refresh:
+                for index, supervisor in enumerate(self.supervisors):
+                    try:
+                        supervisor.refresh()
+                    except Exception as e:
+                        print(f"Warning: Could not refresh the configuration of Fluent Bit shard {index}: {e}")
+                next_refresh = time.monotonic() + self.refresh_interval
+
+            time.sleep(POLL_INTERVAL_SEC)
+
+
+def main():
+    config = create_fluent_bit_config.Config()
+    load_plugin = create_fluent_bit_config.uses_logzio_plugin(config)
+    if int(config.shards) > 1:
+        supervisors = []
+        for index in range(int(config.shards)):
+            shard = create_fluent_bit_config.shard_config(config, index)
+            config_path = create_fluent_bit_config.shard_config_path(index)
+            supervisors.append(Supervisor(
+                fluent_bit_command(config_path, load_plugin),
+                config_path,
+                lambda shard=shard: create_fluent_bit_config.create_fluent_bit_config(shard),
+                int(config.filter_refresh_interval),
+                create_fluent_bit_config.get_lua_env(shard),
+            ))
+        sys.exit(ShardSupervisor(supervisors, int(config.filter_refresh_interval)).run())
+
+    supervisor = Supervisor(
+        fluent_bit_command(create_fluent_bit_config.FLUENT_BIT_CONF_PATH, load_plugin),
+        create_fluent_bit_config.FLUENT_BIT_CONF_PATH,
+        lambda: create_fluent_bit_config.create_fluent_bit_config(config),
+        int(config.filter_refresh_interval),
+    )
+    sys.exit(supervisor.run())
+
+
+if __name__ == "__main__":
+    main()
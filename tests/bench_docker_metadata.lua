@@ -0,0 +1,118 @@
+-- Micro-benchmark for container metadata cache misses.
+-- Run with: busted bench_docker_metadata.lua
+package.path = "../?.lua;" .. package.path
+local docker_metadata = require("docker-metadata")
+local busted = require("busted")
+
+-- Config file sizes to benchmark, in bytes
+local CONFIG_SIZES = { 100 * 1024, 512 * 1024, 2 * 1024 * 1024 }
+
+-- CPU seconds spent measuring each implementation
+local MEASURE_SECONDS = 1
+
+-- Patterns used by the line-by-line extractor this benchmark compares against
+local LEGACY_PATTERNS = {
+    ['docker_container_name'] = '\"Name\":\"/?(.-)\"',
+    ['docker_container_image'] = '\"Image\":\"/?(.-)\"',
+    ['docker_container_started'] = '\"StartedAt\":\"/?(.-)\"'
+}
+
+-- Function to build a config.v2.json document padded to roughly the requested size.
+-- The padding goes into Env and Labels, which is where large configs get their bulk.
+local function build_config(size)
+    local env = { '"PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"' }
+    local labels = {}
+    local padding = 0
+    local i = 0
+    while padding < size do
+        i = i + 1
+        local env_entry = string.format('"APP_SETTING_%d=%s"', i, string.rep('v', 200))
+        local label_entry = string.format('"com.example.label.%d":"%s"', i, string.rep('l', 200))
+        table.insert(env, env_entry)
+        table.insert(labels, label_entry)
+        padding = padding + #env_entry + #label_entry + 2
+    end
+    return '{"StreamConfig":{},"State":{"Running":true,"Paused":false,"Pid":4242,'
+        .. '"StartedAt":"2024-05-01T10:00:00.000000000Z","FinishedAt":"0001-01-01T00:00:00Z"},'
+        .. '"ID":"0123456789abcdef","Created":"2024-05-01T09:59:59.000000000Z","Path":"/docker-entrypoint.sh",'
+        .. '"Config":{"Hostname":"0123456789ab","Env":[' .. table.concat(env, ',') .. '],'
+        .. '"Cmd":["nginx","-g","daemon off;"],"Image":"nginx:1.25",'
+        .. '"Labels":{' .. table.concat(labels, ',') .. '}},'
+        .. '"Image":"sha256:0123456789abcdef","NetworkSettings":{"Bridge":"","SandboxID":"abc"},'
+        .. '"LogPath":"/var/lib/docker/containers/0123456789abcdef/0123456789abcdef-json.log",'
+        .. '"Name":"/web-frontend","Driver":"overlay2","RestartCount":0}'
+end
+
+-- Function reproducing the line-by-line extractor, run against the same files for comparison
+local function legacy_metadata_from_disk(path)
+    local fl = io.open(path, 'r')
+    local data = { time = os.time() }
+    for line in fl:lines() do
+        for key, regex in pairs(LEGACY_PATTERNS) do
+            local match = line:match(regex)
+            if match then
+                data[key] = match
+            end
+        end
+    end
+    fl:close()
+    return data
+end
+
+-- Function to run fn repeatedly for MEASURE_SECONDS of CPU time and return calls per second
+local function measure(fn)
+    local calls = 0
+    local started = os.clock()
+    local elapsed = 0
+    while elapsed < MEASURE_SECONDS do
+        fn()
+        calls = calls + 1
+        elapsed = os.clock() - started
+    end
+    return calls / elapsed
+end
+
+describe("Docker metadata cache miss benchmark", function()
+
+    local base_dir
+    local original_var_dir
+
+    before_each(function()
+        original_var_dir = docker_metadata.DOCKER_VAR_DIR
+        base_dir = os.tmpname()
+        os.remove(base_dir)
+        docker_metadata.DOCKER_VAR_DIR = base_dir .. '/'
+    end)
+
+    after_each(function()
+        docker_metadata.DOCKER_VAR_DIR = original_var_dir
+        os.execute('rm -rf "' .. base_dir .. '"')
+    end)
+
+    for _, size in ipairs(CONFIG_SIZES) do
+        it(string.format("measures misses per second for a %dKB config file", math.floor(size / 1024)), function()
+            local container_id = string.format("%064x", size)
+            os.execute('mkdir -p "' .. base_dir .. '/' .. container_id .. '"')
+            local path = base_dir .. '/' .. container_id .. docker_metadata.DOCKER_CONTAINER_CONFIG_FILE
+            local fl = io.open(path, 'w')
+            fl:write(build_config(size))
+            fl:close()
+
+            local metadata = docker_metadata.get_container_metadata_from_disk(container_id)
+            assert.are.equal("web-frontend", metadata['docker_container_name'])
+            assert.are.equal("nginx:1.25", metadata['docker_container_image'])
+            assert.are.equal("2024-05-01T10:00:00.000000000Z", metadata['docker_container_started'])
+
+            local single_pass = measure(function()
+                docker_metadata.get_container_metadata_from_disk(container_id)
+            end)
+            local line_scan = measure(function()
+                legacy_metadata_from_disk(path)
+            end)
+
+            print(string.format("config=%dKB single_pass=%.0f misses/s line_scan=%.0f misses/s speedup=%.1fx",
+                math.floor(size / 1024), single_pass, line_scan, single_pass / line_scan))
+        end)
+    end
+
+end)
@@ -0,0 +1,70 @@
+import argparse
+import os
+import tempfile
+
+import fluent_bit_runner
+from synthetic_logs import append_log_lines, write_container
+
+# Reports the average size of the records the collector ships, before and after field
+# projection. Each setup runs Fluent Bit on the same container logs with the records written
+# as JSON lines to a file, and divides the size of that file by the number of records.
+#
+#   PYTHONPATH=. python3 tests/bench_field_projection.py --lines 20000
+#
+# Needs the Fluent Bit binary (FLUENT_BIT_BIN).
+
+CONTAINER_ID = 'd' * 64
+PROJECTION = 'drop:time,stream,docker_container_started'
+
+SETUPS = [
+    ('with source field', {'DEBUG_MODE': 'true'}),
+    ('default', {}),
+    ('projected', {'FIELD_PROJECTION': PROJECTION}),
+    ('projected, kept fields', {'FIELD_PROJECTION': 'keep:message,docker_container_name,docker_container_image'}),
+]
+
+
+def run_setup(containers_dir, work_dir, env, lines, timeout):
+    output_path = os.path.join(work_dir, 'output', 'records.json')
+    os.makedirs(os.path.dirname(output_path))
+    run_env = {
+        'DOCKER_CONTAINERS_DIR': containers_dir,
+        'LOGS_PATH': f'{containers_dir}/*/*.log',
+        'READ_FROM_HEAD': 'true',
+        **env,
+    }
+    config_text = fluent_bit_runner.render_config(run_env, fluent_bit_runner.file_output_config(output_path))
+    with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(work_dir, 'run'), run_env):
+        completed = fluent_bit_runner.wait_for(
+            lambda: len(fluent_bit_runner.read_json_lines(output_path)) >= lines, timeout=timeout)
+    records = len(fluent_bit_runner.read_json_lines(output_path))
+    return completed, records, os.path.getsize(output_path) if records else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the size of shipped records with field projection')
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--timeout', type=int, default=300, help='seconds to wait for each setup')
+    args = parser.parse_args()
+
+    if not fluent_bit_runner.fluent_bit_available():
+        print('Fluent Bit binary not available')
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        containers_dir = os.path.join(temp_dir, 'containers')
+        write_container(containers_dir, CONTAINER_ID, 'bench-web', 'nginx:1.25')
+        append_log_lines(containers_dir, CONTAINER_ID,
+                         [f'10.0.0.1 - - "GET /api/items/{line} HTTP/1.1" 200 512' for line in range(args.lines)])
+        baseline = None
+        for index, (name, env) in enumerate(SETUPS):
+            completed, records, size = run_setup(containers_dir, os.path.join(temp_dir, f'setup-{index}'), env,
+                                                 args.lines, args.timeout)
+            per_event = size / records if records else 0
+            baseline = baseline or per_event
+            status = '' if completed else f' (timed out, {records} records)'
+            print(f'{name:<24} {per_event:8.1f} bytes/event {per_event / baseline - 1:+8.1%}{status}')
+
+
+if __name__ == '__main__':
+    main()
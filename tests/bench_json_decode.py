@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import resource
+import tempfile
+
+import fluent_bit_runner
+from synthetic_logs import append_log_lines, write_container
+
+# Compares the CPU time Fluent Bit spends parsing Docker logs with the JSON-decoding parser
+# (docker) and the plain-text parser (docker_plain), on corpora with a growing share of JSON
+# lines. Each run reads a pre-written log file once with Exit_On_Eof and discards the records,
+# so the CPU time of the Fluent Bit process is dominated by reading and parsing.
+#
+#   PYTHONPATH=. python3 tests/bench_json_decode.py --lines 500000
+#
+# Needs the Fluent Bit binary (FLUENT_BIT_BIN).
+
+CONTAINER_ID = 'c' * 64
+JSON_SHARES = (0.0, 0.1, 0.5, 1.0)
+
+BENCH_CONFIG = """
+[SERVICE]
+    Parsers_File parsers.conf
+    Flush        1
+    Daemon       Off
+    Log_Level    warn
+
+[INPUT]
+    Name           tail
+    Path           {path}
+    Parser         {parser}
+    Read_from_Head true
+    Exit_On_Eof    true
+    Buffer_Max_Size 64k
+
+[OUTPUT]
+    Name  null
+    Match *
+"""
+
+
+def write_corpus(containers_dir, lines, json_share):
+    write_container(containers_dir, CONTAINER_ID, 'bench', 'bench:latest')
+    json_every = int(1 / json_share) if json_share else 0
+    corpus = []
+    for index in range(lines):
+        if json_every and index % json_every == 0:
+            corpus.append(json.dumps({'level': 'info', 'request_id': index, 'path': '/api/items',
+                                      'duration_ms': 12.5, 'msg': 'request completed'}))
+        else:
+            corpus.append(f'2024-05-01 10:00:00 INFO request {index} completed in 12.5ms path=/api/items')
+    append_log_lines(containers_dir, CONTAINER_ID, corpus)
+
+
+def cpu_seconds(work_dir, path, parser):
+    # CPU time (user + system) of one Fluent Bit run reading path to the end
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    fluent_bit = fluent_bit_runner.FluentBitProcess(BENCH_CONFIG.format(path=path, parser=parser), work_dir)
+    fluent_bit.start()
+    fluent_bit.process.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JSON decoding cost of the Docker log parsers')
+    parser.add_argument('--lines', type=int, default=500000)
+    parser.add_argument('--runs', type=int, default=3, help='runs per measurement, the fastest is kept')
+    args = parser.parse_args()
+
+    if not fluent_bit_runner.fluent_bit_available():
+        print('Fluent Bit binary not available')
+        return
+
+    print(f"{'JSON lines':>10} {'docker':>10} {'docker_plain':>13} {'CPU saved':>10}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for json_share in JSON_SHARES:
+            containers_dir = os.path.join(temp_dir, f'corpus-{json_share}')
+            write_corpus(containers_dir, args.lines, json_share)
+            path = f'{containers_dir}/*/*.log'
+            results = {}
+            for parser_name in ('docker', 'docker_plain'):
+                results[parser_name] = min(
+                    cpu_seconds(os.path.join(temp_dir, f'run-{json_share}-{parser_name}-{run}'), path, parser_name)
+                    for run in range(args.runs))
+            saved = 1 - results['docker_plain'] / results['docker'] if results['docker'] else 0
+            print(f"{json_share:>10.0%} {results['docker']:>9.2f}s {results['docker_plain']:>12.2f}s {saved:>10.1%}")
+
+
+if __name__ == '__main__':
+    main()
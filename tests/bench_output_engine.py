@@ -0,0 +1,53 @@
+import argparse
+import os
+import tempfile
+
+import fluent_bit_runner
+from bench_output_shards import run_setup, write_logs
+
+# Compares the Logz.io Go plugin with the native http output on the same logs, shipped to a
+# local listener stand-in. For each engine it reports how long it took until every record
+# arrived, the number of requests and the payload bytes received on the wire.
+#
+#   PYTHONPATH=. python3 tests/bench_output_engine.py --containers 8 --lines 50000
+#
+# Needs the Fluent Bit binary (FLUENT_BIT_BIN); the plugin setup also needs the Logz.io
+# plugin (LOGZIO_PLUGIN_PATH) and is skipped without it.
+
+SETUPS = [
+    ('logzio plugin', {'OUTPUT_ENGINE': 'plugin'}),
+    ('native, gzip', {'OUTPUT_ENGINE': 'native', 'OUTPUT_COMPRESS': 'gzip'}),
+    ('native, uncompressed', {'OUTPUT_ENGINE': 'native', 'OUTPUT_COMPRESS': 'none'}),
+    ('native, gzip, 2 workers', {'OUTPUT_ENGINE': 'native', 'OUTPUT_WORKERS': '2'}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Logz.io plugin against the native http output')
+    parser.add_argument('--containers', type=int, default=8)
+    parser.add_argument('--lines', type=int, default=50000, help='log lines per container')
+    parser.add_argument('--timeout', type=int, default=600, help='seconds to wait for each setup')
+    args = parser.parse_args()
+
+    if not fluent_bit_runner.fluent_bit_available():
+        print('Fluent Bit binary not available')
+        return
+
+    expected_records = args.containers * args.lines
+    print(f'{expected_records} records from {args.containers} containers')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        containers_dir = os.path.join(temp_dir, 'containers')
+        write_logs(containers_dir, args.containers, args.lines)
+        for index, (name, env) in enumerate(SETUPS):
+            if env['OUTPUT_ENGINE'] == 'plugin' and not fluent_bit_runner.logzio_plugin_available():
+                print(f'{name:<24} skipped, Logz.io plugin not available')
+                continue
+            completed, received, elapsed, requests, payload_bytes = run_setup(
+                containers_dir, os.path.join(temp_dir, f'run-{index}'), env, expected_records, args.timeout)
+            status = '' if completed else f' (timed out, {received} received)'
+            print(f'{name:<24} {elapsed:8.2f}s {received / elapsed:12.0f} records/s '
+                  f'{requests:6d} requests {payload_bytes / 1024 ** 2:8.1f} MiB{status}')
+
+
+if __name__ == '__main__':
+    main()
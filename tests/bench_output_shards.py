@@ -0,0 +1,80 @@
+import argparse
+import os
+import tempfile
+import time
+
+import fluent_bit_runner
+from logzio_listener import LogzioListener
+from synthetic_logs import append_log_lines, write_container
+
+# Compares shipping throughput of a single Logz.io output with sharded outputs and output
+# workers. Each run pre-writes the same logs for many containers, starts Fluent Bit against
+# a local listener stand-in, and measures how long it takes until every record arrived.
+#
+#   PYTHONPATH=. python3 tests/bench_output_shards.py --containers 32 --lines 20000
+#
+# Needs the Fluent Bit binary and the Logz.io plugin (FLUENT_BIT_BIN, LOGZIO_PLUGIN_PATH).
+
+SETUPS = [
+    ('single output', {}),
+    ('2 workers', {'OUTPUT_WORKERS': '2'}),
+    ('4 shards', {'OUTPUT_SHARDS': '4'}),
+    ('4 shards, 2 workers', {'OUTPUT_SHARDS': '4', 'OUTPUT_WORKERS': '2'}),
+]
+
+
+def write_logs(containers_dir, containers, lines):
+    # Container IDs spread over every hex prefix so each shard gets a share of the logs
+    for index in range(containers):
+        container_id = f'{index % 16:x}{index:063x}'[:64]
+        write_container(containers_dir, container_id, f'bench-{index}', 'bench:latest')
+        append_log_lines(containers_dir, container_id,
+                         [f'bench line {line} of container {index} ' + 'x' * 120 for line in range(lines)])
+
+
+def run_setup(containers_dir, work_dir, env, expected_records, timeout):
+    with LogzioListener() as listener:
+        run_env = {
+            'LOGZIO_LOGS_TOKEN': 'bench_token',
+            'LOGZIO_URL': listener.url,
+            'LOGS_PATH': f'{containers_dir}/*/*.log',
+            'DOCKER_CONTAINERS_DIR': containers_dir,
+            'READ_FROM_HEAD': 'true',
+            **env,
+        }
+        config_text = fluent_bit_runner.render_config(run_env)
+        with fluent_bit_runner.FluentBitProcess(config_text, work_dir, run_env):
+            start = time.monotonic()
+            completed = fluent_bit_runner.wait_for(lambda: listener.record_count() >= expected_records,
+                                                   timeout=timeout, interval=0.05)
+            elapsed = time.monotonic() - start
+        requests, payload_bytes = listener.request_stats()
+        return completed, listener.record_count(), elapsed, requests, payload_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sharded Logz.io outputs against a local listener')
+    parser.add_argument('--containers', type=int, default=32)
+    parser.add_argument('--lines', type=int, default=20000, help='log lines per container')
+    parser.add_argument('--timeout', type=int, default=600, help='seconds to wait for each setup')
+    args = parser.parse_args()
+
+    if not (fluent_bit_runner.fluent_bit_available() and fluent_bit_runner.logzio_plugin_available()):
+        print('Fluent Bit binary or Logz.io plugin not available')
+        return
+
+    expected_records = args.containers * args.lines
+    print(f'{expected_records} records from {args.containers} containers')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        containers_dir = os.path.join(temp_dir, 'containers')
+        write_logs(containers_dir, args.containers, args.lines)
+        for index, (name, env) in enumerate(SETUPS):
+            completed, received, elapsed, requests, payload_bytes = run_setup(
+                containers_dir, os.path.join(temp_dir, f'run-{index}'), env, expected_records, args.timeout)
+            status = '' if completed else f' (timed out, {received} received)'
+            print(f'{name:<22} {elapsed:8.2f}s {received / elapsed:12.0f} records/s '
+                  f'{requests:6d} requests {payload_bytes / 1024 ** 2:8.1f} MiB{status}')
+
+
+if __name__ == '__main__':
+    main()
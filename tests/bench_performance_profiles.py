@@ -0,0 +1,103 @@
+import argparse
+import os
+import re
+import tempfile
+import time
+
+import fluent_bit_runner
+from logzio_listener import LogzioListener
+from synthetic_logs import append_log_lines, write_container
+
+# Measures each PERFORMANCE_PROFILE against a local listener stand-in:
+#  - throughput: events/s shipping a pre-written backlog
+#  - latency: p50/p99 seconds from writing a line to the listener receiving it, at a steady rate
+#
+#   PYTHONPATH=. python3 tests/bench_performance_profiles.py --backlog 200000 --rate 2000
+#
+# Needs the Fluent Bit binary and the Logz.io plugin (FLUENT_BIT_BIN, LOGZIO_PLUGIN_PATH).
+
+CONTAINER_ID = 'b' * 64
+SENT_PATTERN = re.compile(r'sent=(\d+\.\d+)')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def start_pipeline(temp_dir, name, listener, profile):
+    containers_dir = os.path.join(temp_dir, name, 'containers')
+    write_container(containers_dir, CONTAINER_ID, 'bench', 'bench:latest')
+    env = {
+        'LOGZIO_LOGS_TOKEN': 'bench_token',
+        'LOGZIO_URL': listener.url,
+        'LOGS_PATH': f'{containers_dir}/*/*.log',
+        'DOCKER_CONTAINERS_DIR': containers_dir,
+        'READ_FROM_HEAD': 'true',
+        'PERFORMANCE_PROFILE': profile,
+    }
+    config_text = fluent_bit_runner.render_config(env)
+    return containers_dir, fluent_bit_runner.FluentBitProcess(config_text, os.path.join(temp_dir, name, 'run'), env)
+
+
+def measure_throughput(temp_dir, profile, backlog, timeout):
+    with LogzioListener() as listener:
+        containers_dir, fluent_bit = start_pipeline(temp_dir, f'{profile}-throughput', listener, profile)
+        append_log_lines(containers_dir, CONTAINER_ID, [f'backlog line {i} ' + 'x' * 120 for i in range(backlog)])
+        with fluent_bit:
+            start = time.monotonic()
+            fluent_bit_runner.wait_for(lambda: listener.record_count() >= backlog, timeout=timeout, interval=0.05)
+            elapsed = time.monotonic() - start
+        return listener.record_count() / elapsed
+
+
+def measure_latency(temp_dir, profile, rate, duration, timeout):
+    with LogzioListener() as listener:
+        containers_dir, fluent_bit = start_pipeline(temp_dir, f'{profile}-latency', listener, profile)
+        with fluent_bit:
+            time.sleep(2)
+            sent = 0
+            start = time.monotonic()
+            while time.monotonic() - start < duration:
+                # Write in batches of 10ms worth of lines to hold the rate
+                batch = max(1, rate // 100)
+                append_log_lines(containers_dir, CONTAINER_ID, [f'sent={time.time():.6f}'] * batch)
+                sent += batch
+                time.sleep(max(0.0, start + sent / rate - time.monotonic()))
+            fluent_bit_runner.wait_for(lambda: listener.record_count() >= sent, timeout=timeout)
+
+        latencies = []
+        with listener.lock:
+            for arrived_at, record in listener.records:
+                match = SENT_PATTERN.search(str(record.get('message', '')))
+                if match:
+                    latencies.append(arrived_at - float(match.group(1)))
+        return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PERFORMANCE_PROFILE settings against a local listener')
+    parser.add_argument('--backlog', type=int, default=200000, help='lines shipped in the throughput run')
+    parser.add_argument('--rate', type=int, default=2000, help='lines per second written in the latency run')
+    parser.add_argument('--duration', type=int, default=30, help='seconds of writing in the latency run')
+    parser.add_argument('--timeout', type=int, default=600)
+    args = parser.parse_args()
+
+    if not (fluent_bit_runner.fluent_bit_available() and fluent_bit_runner.logzio_plugin_available()):
+        print('Fluent Bit binary or Logz.io plugin not available')
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        print(f"{'profile':<16} {'events/s':>10} {'p50 latency':>12} {'p99 latency':>12}")
+        for profile in ('low-latency', 'balanced', 'high-throughput'):
+            events_per_sec = measure_throughput(temp_dir, profile, args.backlog, args.timeout)
+            latencies = measure_latency(temp_dir, profile, args.rate, args.duration, args.timeout)
+            if not latencies:
+                print(f'{profile:<16} {events_per_sec:10.0f} {"no records":>12}')
+                continue
+            print(f'{profile:<16} {events_per_sec:10.0f} {percentile(latencies, 0.5):11.3f}s '
+                  f'{percentile(latencies, 0.99):11.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fluent_bit_runner
+from logzio_listener import LogzioListener
+from synthetic_logs import WorkloadWriter, write_workload
+
+# Offline end-to-end benchmark of the collector. For each scenario it writes synthetic Docker
+# logs, renders the configuration with create_fluent_bit_config, runs Fluent Bit against a
+# local Logz.io listener stand-in and measures:
+#  - events/s draining a pre-written backlog
+#  - p50/p99 latency from writing a line to the listener receiving it, at a steady rate
+#  - CPU seconds and peak RSS of Fluent Bit over the whole run
+#
+#   PYTHONPATH=. python3 tests/bench_pipeline.py --output results.json
+#   PYTHONPATH=. python3 tests/bench_pipeline.py --scenario default --baseline results.json
+#
+# Results are written as JSON. With --baseline, scenarios whose events/s dropped or whose p99
+# latency, CPU or RSS grew by more than --tolerance are reported and the exit code is 1.
+#
+# Needs the Fluent Bit binary and the Logz.io plugin (FLUENT_BIT_BIN, LOGZIO_PLUGIN_PATH).
+
+# Workload and collector environment of each scenario
+SCENARIOS = {
+    'default': {
+        'containers': 8, 'backlog_lines': 20000, 'rate': 2000, 'duration': 20, 'line_size': 200, 'json_ratio': 0.2,
+        'env': {},
+    },
+    'many-containers': {
+        'containers': 200, 'backlog_lines': 1000, 'rate': 2000, 'duration': 20, 'line_size': 200, 'json_ratio': 0.2,
+        'env': {},
+    },
+    'large-lines': {
+        'containers': 8, 'backlog_lines': 5000, 'rate': 500, 'duration': 20, 'line_size': 16000, 'json_ratio': 0.2,
+        'env': {'BUFFER_MAX_SIZE': '64k'},
+    },
+    'plain-text': {
+        'containers': 8, 'backlog_lines': 20000, 'rate': 2000, 'duration': 20, 'line_size': 200, 'json_ratio': 0.0,
+        'env': {'JSON_DECODE_MODE': 'never'},
+    },
+    'low-latency': {
+        'containers': 8, 'backlog_lines': 20000, 'rate': 2000, 'duration': 20, 'line_size': 200, 'json_ratio': 0.2,
+        'env': {'PERFORMANCE_PROFILE': 'low-latency'},
+    },
+    'high-throughput': {
+        'containers': 32, 'backlog_lines': 20000, 'rate': 5000, 'duration': 20, 'line_size': 200, 'json_ratio': 0.2,
+        'env': {'PERFORMANCE_PROFILE': 'high-throughput', 'OUTPUT_SHARDS': '4'},
+    },
+    'native-output': {
+        'containers': 8, 'backlog_lines': 20000, 'rate': 2000, 'duration': 20, 'line_size': 200, 'json_ratio': 0.2,
+        'env': {'OUTPUT_ENGINE': 'native'},
+    },
+    'filesystem-buffering': {
+        'containers': 8, 'backlog_lines': 20000, 'rate': 2000, 'duration': 20, 'line_size': 200, 'json_ratio': 0.2,
+        'env': {'BUFFERING_MODE': 'filesystem'},
+    },
+}
+
+# Metrics compared with a baseline, and whether a higher value is better
+COMPARED_METRICS = {
+    'events_per_sec': True,
+    'latency_p99_ms': False,
+    'cpu_seconds': False,
+    'peak_rss_mb': False,
+}
+
+SENT_PATTERN = re.compile(r'sent=(\d+\.\d+)')
+SAMPLE_INTERVAL_SEC = 0.2
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class ProcessSampler(threading.Thread):
+    # Samples the CPU time and RSS of a process until stopped
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.cpu_seconds = 0.0
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        try:
+            self.cpu_seconds = fluent_bit_runner.cpu_seconds(self.pid)
+            self.peak_rss = max(self.peak_rss, fluent_bit_runner.rss_bytes(self.pid))
+        except OSError:
+            pass
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL_SEC):
+            self.sample()
+
+    def stop(self):
+        self.sample()
+        self.stopped.set()
+        self.join()
+
+
+def run_scenario(work_dir, scenario, timeout):
+    containers_dir = os.path.join(work_dir, 'containers')
+    ids = write_workload(containers_dir, scenario['containers'], scenario['backlog_lines'], scenario['line_size'],
+                         scenario['json_ratio'])
+    backlog = scenario['containers'] * scenario['backlog_lines']
+
+    with LogzioListener() as listener:
+        env = {
+            'LOGZIO_LOGS_TOKEN': 'bench_token',
+            'LOGZIO_URL': listener.url,
+            'LOGS_PATH': f'{containers_dir}/*/*.log',
+            'DOCKER_CONTAINERS_DIR': containers_dir,
+            'READ_FROM_HEAD': 'true',
+            'STORAGE_PATH': os.path.join(work_dir, 'storage'),
+            **scenario['env'],
+        }
+        config_text = fluent_bit_runner.render_config(env)
+        with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(work_dir, 'run'), env) as fluent_bit:
+            sampler = ProcessSampler(fluent_bit.process.pid)
+            sampler.start()
+
+            start = time.monotonic()
+            drained = fluent_bit_runner.wait_for(lambda: listener.record_count() >= backlog, timeout=timeout,
+                                                 interval=0.05)
+            drain_seconds = time.monotonic() - start
+
+            writer = WorkloadWriter(containers_dir, ids, scenario['rate'], scenario['duration'], scenario['line_size'],
+                                    scenario['json_ratio'])
+            writer.start()
+            writer.join()
+            delivered = fluent_bit_runner.wait_for(lambda: listener.record_count() >= backlog + writer.written,
+                                                   timeout=timeout)
+            sampler.stop()
+
+        latencies = []
+        with listener.lock:
+            for arrived_at, record in listener.records:
+                match = SENT_PATTERN.search(json.dumps(record))
+                if match:
+                    latencies.append((arrived_at - float(match.group(1))) * 1000)
+        requests, payload_bytes = listener.request_stats()
+
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {
+        'complete': drained and delivered,
+        'events_sent': backlog + writer.written,
+        'events_received': listener.record_count(),
+        'events_per_sec': round(backlog / drain_seconds, 1) if drained else None,
+        'latency_p50_ms': round(p50, 1) if p50 is not None else None,
+        'latency_p99_ms': round(p99, 1) if p99 is not None else None,
+        'cpu_seconds': round(sampler.cpu_seconds, 2),
+        'peak_rss_mb': round(sampler.peak_rss / 1024 ** 2, 1),
+        'requests': requests,
+        'payload_mb': round(payload_bytes / 1024 ** 2, 2),
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # Describe every metric that regressed by more than tolerance compared with the baseline
+    regressions = []
+    for name, result in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f'{name}: {metric} {old} -> {new} ({change:+.0%})')
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=fluent_bit_runner.REPO_DIR).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark against a local listener stand-in')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, can be repeated (default: all)')
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression')
+    parser.add_argument('--timeout', type=int, default=600, help='seconds to wait for delivery in each phase')
+    args = parser.parse_args()
+
+    if not (fluent_bit_runner.fluent_bit_available() and fluent_bit_runner.logzio_plugin_available()):
+        print('Fluent Bit binary or Logz.io plugin not available', file=sys.stderr)
+        return 2
+
+    results = {
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'fluent_bit_version': fluent_bit_runner.fluent_bit_version(),
+        'cpu_count': os.cpu_count(),
+        'scenarios': {},
+    }
+    for name in args.scenario or SCENARIOS:
+        print(f'Running scenario {name}', file=sys.stderr)
+        with tempfile.TemporaryDirectory() as work_dir:
+            results['scenarios'][name] = {'workload': SCENARIOS[name],
+                                          **run_scenario(work_dir, SCENARIOS[name], args.timeout)}
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report + '\n')
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_with_baseline(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import fluent_bit_runner
+from bench_pipeline import SENT_PATTERN, percentile
+from logzio_listener import LogzioListener
+from synthetic_logs import WorkloadWriter, append_log_lines, write_workload
+
+# Measures the latency of priority records while the output is saturated, with and without
+# priority routing. Each run pre-writes a bulk backlog, starts Fluent Bit against a local
+# listener stand-in that holds every response for --response-delay seconds, and keeps writing
+# bulk lines and a few ERROR lines. It reports p50/p99 latency from writing a line to the
+# listener receiving it, separately for the ERROR lines and the bulk lines.
+#
+#   PYTHONPATH=. python3 tests/bench_priority.py --backlog-lines 50000 --response-delay 0.2
+#
+# Needs the Fluent Bit binary and the Logz.io plugin (FLUENT_BIT_BIN, LOGZIO_PLUGIN_PATH).
+
+SETUPS = [
+    ('no priority routing', {}),
+    ('priority routing', {'PRIORITY_PATTERNS': '^ERROR'}),
+]
+
+
+class PriorityWriter(threading.Thread):
+    # Appends an ERROR line with its sent time to a container rate times per second
+    def __init__(self, containers_dir, container_id, rate, duration):
+        super().__init__(daemon=True)
+        self.containers_dir = containers_dir
+        self.container_id = container_id
+        self.rate = rate
+        self.duration = duration
+        self.written = 0
+
+    def run(self):
+        start = time.monotonic()
+        while time.monotonic() - start < self.duration:
+            append_log_lines(self.containers_dir, self.container_id,
+                             [f'ERROR seq={self.written} sent={time.time():.6f} payment failed'])
+            self.written += 1
+            time.sleep(max(0.0, start + self.written / self.rate - time.monotonic()))
+
+
+def run_setup(work_dir, env, args):
+    containers_dir = os.path.join(work_dir, 'containers')
+    ids = write_workload(containers_dir, args.containers, args.backlog_lines)
+
+    with LogzioListener(response_delay=args.response_delay) as listener:
+        run_env = {
+            'LOGZIO_LOGS_TOKEN': 'bench_token',
+            'LOGZIO_URL': listener.url,
+            'LOGS_PATH': f'{containers_dir}/*/*.log',
+            'DOCKER_CONTAINERS_DIR': containers_dir,
+            'READ_FROM_HEAD': 'true',
+            **env,
+        }
+        config_text = fluent_bit_runner.render_config(run_env)
+        with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(work_dir, 'run'), run_env):
+            bulk_writer = WorkloadWriter(containers_dir, ids, args.rate, args.duration)
+            priority_writer = PriorityWriter(containers_dir, ids[0], args.priority_rate, args.duration)
+            bulk_writer.start()
+            priority_writer.start()
+            bulk_writer.join()
+            priority_writer.join()
+            expected = args.containers * args.backlog_lines + bulk_writer.written + priority_writer.written
+            completed = fluent_bit_runner.wait_for(lambda: listener.record_count() >= expected,
+                                                   timeout=args.timeout, interval=0.05)
+
+        latencies = {'priority': [], 'bulk': []}
+        with listener.lock:
+            for arrived_at, record in listener.records:
+                text = json.dumps(record)
+                match = SENT_PATTERN.search(text)
+                if match:
+                    kind = 'priority' if 'ERROR seq=' in text else 'bulk'
+                    latencies[kind].append((arrived_at - float(match.group(1))) * 1000)
+        return completed, listener.record_count(), expected, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark priority record latency under output saturation')
+    parser.add_argument('--containers', type=int, default=8)
+    parser.add_argument('--backlog-lines', type=int, default=50000, help='bulk backlog lines per container')
+    parser.add_argument('--rate', type=int, default=5000, help='bulk lines per second while measuring')
+    parser.add_argument('--priority-rate', type=int, default=20, help='ERROR lines per second while measuring')
+    parser.add_argument('--duration', type=int, default=30, help='seconds to write lines for')
+    parser.add_argument('--response-delay', type=float, default=0.2, help='seconds the listener holds each response')
+    parser.add_argument('--timeout', type=int, default=600, help='seconds to wait for each setup')
+    args = parser.parse_args()
+
+    if not (fluent_bit_runner.fluent_bit_available() and fluent_bit_runner.logzio_plugin_available()):
+        print('Fluent Bit binary or Logz.io plugin not available')
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for index, (name, env) in enumerate(SETUPS):
+            completed, received, expected, latencies = run_setup(os.path.join(temp_dir, f'run-{index}'), env, args)
+            status = '' if completed else f' (timed out, {received} of {expected} received)'
+            print(f'{name}:{status}')
+            for kind in ('priority', 'bulk'):
+                p50, p99 = percentile(latencies[kind], 0.5), percentile(latencies[kind], 0.99)
+                if p50 is None:
+                    print(f'  {kind:<9} no records received')
+                    continue
+                print(f'  {kind:<9} p50 {p50:9.1f} ms  p99 {p99:9.1f} ms  ({len(latencies[kind])} records)')
+
+
+if __name__ == '__main__':
+    main()
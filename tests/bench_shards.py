@@ -0,0 +1,70 @@
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+import fluent_bit_runner
+from logzio_listener import LogzioListener
+from synthetic_logs import write_workload
+
+# Measures how shipping throughput scales with the number of Fluent Bit processes (SHARDS).
+# Each run pre-writes the same logs for many containers, starts one Fluent Bit process per
+# shard against a local listener stand-in, and measures how long it takes until every record
+# arrived.
+#
+#   PYTHONPATH=. python3 tests/bench_shards.py --containers 64 --lines 20000 --shards 1 2 4
+#
+# Needs the Fluent Bit binary and the Logz.io plugin (FLUENT_BIT_BIN, LOGZIO_PLUGIN_PATH).
+
+
+def run_shards(containers_dir, work_dir, shards, expected_records, timeout):
+    with LogzioListener() as listener, contextlib.ExitStack() as processes:
+        env = {
+            'LOGZIO_LOGS_TOKEN': 'bench_token',
+            'LOGZIO_URL': listener.url,
+            'LOGS_PATH': f'{containers_dir}/*/*.log',
+            'DOCKER_CONTAINERS_DIR': containers_dir,
+            'READ_FROM_HEAD': 'true',
+            'SHARDS': str(shards),
+        }
+        start = time.monotonic()
+        for index in range(shards):
+            config_text = fluent_bit_runner.render_config(env, shard=index if shards > 1 else None)
+            processes.enter_context(
+                fluent_bit_runner.FluentBitProcess(config_text, os.path.join(work_dir, f'shard-{index}'), env))
+        completed = fluent_bit_runner.wait_for(lambda: listener.record_count() >= expected_records,
+                                               timeout=timeout, interval=0.05)
+        elapsed = time.monotonic() - start
+        return completed, listener.record_count(), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark throughput of sharded Fluent Bit processes')
+    parser.add_argument('--containers', type=int, default=64)
+    parser.add_argument('--lines', type=int, default=20000, help='log lines per container')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4], help='shard counts to compare')
+    parser.add_argument('--timeout', type=int, default=600, help='seconds to wait for each run')
+    args = parser.parse_args()
+
+    if not (fluent_bit_runner.fluent_bit_available() and fluent_bit_runner.logzio_plugin_available()):
+        print('Fluent Bit binary or Logz.io plugin not available')
+        return
+
+    expected_records = args.containers * args.lines
+    print(f'{expected_records} records from {args.containers} containers on {os.cpu_count()} CPUs')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        containers_dir = os.path.join(temp_dir, 'containers')
+        write_workload(containers_dir, args.containers, args.lines)
+        baseline = None
+        for shards in args.shards:
+            completed, received, elapsed = run_shards(containers_dir, os.path.join(temp_dir, f'run-{shards}'),
+                                                      shards, expected_records, args.timeout)
+            rate = received / elapsed
+            baseline = baseline or rate
+            status = '' if completed else f' (timed out, {received} received)'
+            print(f'{shards:>2} shards {elapsed:8.2f}s {rate:12.0f} records/s {rate / baseline:6.2f}x{status}')
+
+
+if __name__ == '__main__':
+    main()
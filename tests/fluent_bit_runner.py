@@ -0,0 +1,141 @@
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import time
+from unittest.mock import patch
+
+import create_fluent_bit_config
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Fluent Bit binary and Logz.io plugin used by the tests that run a real pipeline
+FLUENT_BIT_BIN = os.getenv('FLUENT_BIT_BIN') or shutil.which('fluent-bit') or '/fluent-bit/bin/fluent-bit'
+LOGZIO_PLUGIN_PATH = os.getenv('LOGZIO_PLUGIN_PATH', create_fluent_bit_config.PLUGIN_PATH)
+STOP_TIMEOUT_SEC = 30
+
+
+def fluent_bit_available():
+    return os.access(FLUENT_BIT_BIN, os.X_OK)
+
+
+def logzio_plugin_available():
+    return os.path.exists(LOGZIO_PLUGIN_PATH)
+
+
+def file_output_config(path):
+    # Output writing every record as a JSON line to path
+    return f"""
+[OUTPUT]
+    Name   file
+    Match  *
+    Path   {os.path.dirname(path)}
+    File   {os.path.basename(path)}
+    Format plain
+"""
+
+
+def render_config(env, output_config=None, shard=None):
+    # Render the collector configuration for env, using the Lua script from this repository.
+    # When output_config is given it replaces the generated outputs. When shard is given, the
+    # configuration of that shard process is rendered.
+    script_path = os.path.join(REPO_DIR, 'docker-metadata.lua')
+    with patch.dict(os.environ, env, clear=True), \
+            patch.object(create_fluent_bit_config, 'DOCKER_METADATA_SCRIPT_PATH', script_path), \
+            patch('builtins.print'):
+        config = create_fluent_bit_config.Config()
+        if shard is not None:
+            config = create_fluent_bit_config.shard_config(config, shard)
+        if output_config is None:
+            return create_fluent_bit_config.create_fluent_bit_config(config)
+        with patch.object(create_fluent_bit_config, '_get_output_config', lambda config: output_config):
+            return create_fluent_bit_config.create_fluent_bit_config(config)
+
+
+def wait_for(predicate, timeout=30, interval=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return predicate()
+
+
+def rss_bytes(pid):
+    # Resident set size of a process, read from /proc
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def cpu_seconds(pid):
+    # User and system CPU time of a process, read from /proc
+    with open(f'/proc/{pid}/stat') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def fluent_bit_version():
+    try:
+        return subprocess.run([FLUENT_BIT_BIN, '--version'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def read_json_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+# A Fluent Bit process running a rendered configuration from its own work directory
+class FluentBitProcess:
+    def __init__(self, config_text, work_dir, env=None, multiline_config=None):
+        self.config_text = config_text
+        self.work_dir = work_dir
+        self.env = env or {}
+        self.multiline_config = multiline_config
+        self.process = None
+        self.log_path = os.path.join(work_dir, 'fluent-bit.log')
+
+    def start(self):
+        os.makedirs(self.work_dir, exist_ok=True)
+        config_path = os.path.join(self.work_dir, 'fluent-bit.conf')
+        with open(config_path, 'w') as file:
+            file.write(self.config_text)
+        shutil.copy(os.path.join(REPO_DIR, 'configs', 'parsers.conf'), os.path.join(self.work_dir, 'parsers.conf'))
+        multiline_path = os.path.join(self.work_dir, 'parsers_multiline.conf')
+        if self.multiline_config is None:
+            shutil.copy(os.path.join(REPO_DIR, 'configs', 'parser_multiline.conf'), multiline_path)
+        else:
+            with open(multiline_path, 'w') as file:
+                file.write(self.multiline_config)
+
+        command = [FLUENT_BIT_BIN, '-c', config_path]
+        if re.search(r'Name\s+logzio', self.config_text):
+            command[1:1] = ['-e', LOGZIO_PLUGIN_PATH]
+        with open(self.log_path, 'a') as log_file:
+            self.process = subprocess.Popen(command, env={**os.environ, **self.env}, cwd=self.work_dir,
+                                            stdout=log_file, stderr=subprocess.STDOUT)
+        return self
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=STOP_TIMEOUT_SEC)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,88 @@
+import gzip
+import http.server
+import json
+import threading
+import time
+
+
+# Local stand-in for the Logz.io listener. Accepts bulk payloads of newline-delimited
+# JSON records, optionally gzip-compressed, and records when each request arrived.
+# While stalled, requests are held open without a response until resume() is called.
+# response_delay holds every response for that many seconds, like a saturated listener.
+class LogzioListener(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, response_delay=0.0):
+        super().__init__((host, port), LogzioListenerHandler)
+        self.response_delay = response_delay
+        self.lock = threading.Lock()
+        self.requests = []
+        self.records = []
+        self.not_stalled = threading.Event()
+        self.not_stalled.set()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.resume()
+        self.shutdown()
+        self.server_close()
+
+    def stall(self):
+        self.not_stalled.clear()
+
+    def resume(self):
+        self.not_stalled.set()
+
+    def record_count(self):
+        with self.lock:
+            return len(self.records)
+
+    def request_stats(self):
+        # Number of requests and total payload bytes received on the wire
+        with self.lock:
+            return len(self.requests), sum(request['bytes'] for request in self.requests)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class LogzioListenerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.not_stalled.wait()
+        arrived_at = time.time()
+        if self.server.response_delay:
+            time.sleep(self.server.response_delay)
+
+        payload = body
+        if self.headers.get('Content-Encoding') == 'gzip' or body[:2] == b'\x1f\x8b':
+            payload = gzip.decompress(body)
+        records = [json.loads(line) for line in payload.splitlines() if line.strip()]
+
+        with self.server.lock:
+            self.server.requests.append({'path': self.path, 'bytes': len(body), 'records': len(records),
+                                         'arrived_at': arrived_at})
+            for record in records:
+                self.server.records.append((arrived_at, record))
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,114 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+# Size of the fragments Docker's json-file driver splits longer lines into
+DOCKER_PARTIAL_LINE_SIZE = 16384
+
+
+def docker_time(moment=None):
+    # Format a time the way Docker's json-file logging driver does
+    moment = moment or datetime.datetime.now(datetime.timezone.utc)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%f') + '000Z'
+
+
+def docker_log_line(message, stream='stdout', moment=None):
+    # Render one line of a Docker json-file log
+    return json.dumps({'log': message + '\n', 'stream': stream, 'time': docker_time(moment)}) + '\n'
+
+
+def docker_partial_lines(message, stream='stdout', moment=None):
+    # Render a line the way Docker's json-file driver writes it, split into partial lines
+    # where every fragment but the last has no trailing newline
+    fragments = [message[start:start + DOCKER_PARTIAL_LINE_SIZE]
+                 for start in range(0, len(message), DOCKER_PARTIAL_LINE_SIZE)] or ['']
+    fragments[-1] += '\n'
+    return ''.join(json.dumps({'log': fragment, 'stream': stream, 'time': docker_time(moment)}) + '\n'
+                   for fragment in fragments)
+
+
+def write_container(containers_dir, container_id, name, image, lines=()):
+    # Create a container directory with a config.v2.json and a json-file log holding lines
+    container_dir = os.path.join(containers_dir, container_id)
+    os.makedirs(container_dir, exist_ok=True)
+    with open(os.path.join(container_dir, 'config.v2.json'), 'w') as file:
+        json.dump({
+            'State': {'Running': True, 'StartedAt': docker_time()},
+            'ID': container_id,
+            'Config': {'Image': image, 'Env': [], 'Labels': {}},
+            'Image': 'sha256:' + container_id,
+            'Name': f'/{name}',
+        }, file)
+    log_path = container_log_path(containers_dir, container_id)
+    open(log_path, 'a').close()
+    append_log_lines(containers_dir, container_id, lines)
+    return log_path
+
+
+def container_log_path(containers_dir, container_id):
+    return os.path.join(containers_dir, container_id, f'{container_id}-json.log')
+
+
+def append_log_lines(containers_dir, container_id, lines, stream='stdout'):
+    with open(container_log_path(containers_dir, container_id), 'a') as file:
+        for line in lines:
+            file.write(docker_log_line(line, stream))
+
+
+def synthetic_message(sequence, line_size, as_json, sent_at=None):
+    # A log message padded to about line_size bytes. sent_at, when given, is embedded as
+    # sent=<seconds> so the receiving side can compute end-to-end latency from any record.
+    marker = f'sent={sent_at:.6f}' if sent_at is not None else 'backlog'
+    if as_json:
+        message = {'level': 'info', 'seq': sequence, 'marker': marker, 'pad': ''}
+        message['pad'] = 'x' * max(0, line_size - len(json.dumps(message)))
+        return json.dumps(message)
+    message = f'INFO seq={sequence} {marker} '
+    return message + 'x' * max(0, line_size - len(message))
+
+
+def container_ids(count):
+    # Container IDs spread over every hex prefix, like the IDs Docker generates
+    return [f'{index % 16:x}{index:063x}'[:64] for index in range(count)]
+
+
+def write_workload(containers_dir, containers, backlog_lines=0, line_size=200, json_ratio=0.0):
+    # Create containers with backlog_lines each, a json_ratio share of them JSON objects
+    ids = container_ids(containers)
+    json_every = round(1 / json_ratio) if json_ratio else 0
+    for index, container_id in enumerate(ids):
+        write_container(containers_dir, container_id, f'synthetic-{index}', f'synthetic/image-{index % 4}:latest')
+        append_log_lines(containers_dir, container_id,
+                         [synthetic_message(line, line_size, bool(json_every) and line % json_every == 0)
+                          for line in range(backlog_lines)])
+    return ids
+
+
+class WorkloadWriter(threading.Thread):
+    # Appends lines to the containers round-robin at a steady total rate, in batches of
+    # 10ms worth of lines, until duration seconds passed
+    def __init__(self, containers_dir, ids, rate, duration, line_size=200, json_ratio=0.0):
+        super().__init__(daemon=True)
+        self.containers_dir = containers_dir
+        self.ids = ids
+        self.rate = rate
+        self.duration = duration
+        self.line_size = line_size
+        self.json_every = round(1 / json_ratio) if json_ratio else 0
+        self.written = 0
+
+    def run(self):
+        batch = max(1, self.rate // 100)
+        start = time.monotonic()
+        while time.monotonic() - start < self.duration:
+            container_id = self.ids[(self.written // batch) % len(self.ids)]
+            sent_at = time.time()
+            append_log_lines(self.containers_dir, container_id,
+                             [synthetic_message(self.written + i, self.line_size,
+                                                bool(self.json_every) and (self.written + i) % self.json_every == 0,
+                                                sent_at)
+                              for i in range(batch)])
+            self.written += batch
+            time.sleep(max(0.0, start + self.written / self.rate - time.monotonic()))
@@ -0,0 +1,73 @@
+package.path = "../?.lua;" .. package.path
+local docker_metadata = require("docker-metadata")
+local busted = require("busted")
+
+-- Function to run the lines of a file, as (offset, message) pairs, through the backfill
+-- filter the way Fluent Bit does, returning the messages kept
+local function run_lines(path, lines)
+    local kept = {}
+    for _, line in ipairs(lines) do
+        local record = { log = line[2], backfill_path = path, backfill_offset = line[1] }
+        local code, _, result = docker_metadata.backfill_cutoff("docker.backfill.x", 1, record)
+        if code == 1 then
+            assert.is_nil(result.backfill_path)
+            assert.is_nil(result.backfill_offset)
+            table.insert(kept, result.log)
+        end
+    end
+    return kept
+end
+
+local function write_snapshot(content)
+    local fl = io.open(docker_metadata.BACKFILL_SNAPSHOT_FILE, 'w')
+    fl:write(content)
+    fl:close()
+end
+
+describe("Backfill cutoff", function()
+
+    before_each(function()
+        docker_metadata.BACKFILL_SNAPSHOT_FILE = os.tmpname()
+        docker_metadata.backfill_files = nil
+    end)
+
+    after_each(function()
+        os.remove(docker_metadata.BACKFILL_SNAPSHOT_FILE)
+    end)
+
+    it("keeps the lines before the cut of their file", function()
+        write_snapshot("# backfill snapshot\n11\t20\t/logs/a.log\n12\t10\t/logs/b.log\n")
+        assert.are.same({ "a0", "a1" }, run_lines("/logs/a.log", { { 0, "a0" }, { 10, "a1" }, { 20, "a2" }, { 30, "a3" } }))
+        assert.are.same({ "b0" }, run_lines("/logs/b.log", { { 0, "b0" }, { 10, "b1" } }))
+    end)
+
+    it("drops the lines of files missing from the snapshot", function()
+        write_snapshot("# backfill snapshot\n11\t20\t/logs/a.log\n")
+        assert.are.same({}, run_lines("/logs/new.log", { { 0, "n0" }, { 10, "n1" } }))
+    end)
+
+    it("drops every line without a snapshot", function()
+        os.remove(docker_metadata.BACKFILL_SNAPSHOT_FILE)
+        assert.are.same({}, run_lines("/logs/a.log", { { 0, "a0" } }))
+    end)
+
+    it("drops the lines of a newer file at the same path", function()
+        write_snapshot("# backfill snapshot\n11\t30\t/logs/a.log\n")
+        -- The file is rotated after its second line was read, and a new file is created at the same path
+        local kept = run_lines("/logs/a.log", { { 0, "a0" }, { 10, "a1" }, { 0, "new0" }, { 20, "a2" }, { 10, "new1" },
+                                                { 30, "a3" }, { 20, "new2" } })
+        assert.are.same({ "a0", "a1", "a2" }, kept)
+    end)
+
+    it("reports when every file was read up to its cut", function()
+        write_snapshot("# backfill snapshot\n11\t10\t/logs/a.log\n12\t10\t/logs/b.log\n")
+        local printed = {}
+        local original_print = print
+        _G.print = function(message) table.insert(printed, message) end
+        run_lines("/logs/a.log", { { 0, "a0" }, { 10, "a1" } })
+        assert.are.same({}, printed)
+        run_lines("/logs/b.log", { { 0, "b0" }, { 10, "b1" }, { 20, "b2" } })
+        _G.print = original_print
+        assert.are.same({ "Backfill: every log file was read up to where the live input started" }, printed)
+    end)
+end)
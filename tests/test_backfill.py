@@ -0,0 +1,216 @@
+import unittest
+from unittest.mock import patch
+import os
+import sqlite3
+import tempfile
+import time
+
+# Import the modules to be tested
+import backfill
+import create_fluent_bit_config
+import fluent_bit_runner
+from synthetic_logs import append_log_lines, container_log_path, docker_log_line, write_container
+
+
+def read_lines(path):
+    # (start offset, line) of every complete line of a file
+    lines = []
+    offset = 0
+    with open(path, 'rb') as file:
+        for line in file:
+            if line.endswith(b'\n'):
+                lines.append((offset, line))
+            offset += len(line)
+    return lines
+
+
+class TestBackfillSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, 'db', 'tail.db')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, name, content):
+        path = os.path.join(self.temp_dir.name, name)
+        with open(path, 'wb') as file:
+            file.write(content)
+        return path
+
+    def test_line_aligned_size_leaves_a_partial_line_out(self):
+        self.assertEqual(13, backfill.line_aligned_size(self._write('a.log', b'first\nsecond\nthi')))
+        self.assertEqual(13, backfill.line_aligned_size(self._write('b.log', b'first\nsecond\n')))
+        self.assertEqual(0, backfill.line_aligned_size(self._write('c.log', b'no newline yet')))
+        long_line = b'x' * (backfill.READ_BLOCK_SIZE * 2) + b'\n'
+        self.assertEqual(len(long_line), backfill.line_aligned_size(self._write('d.log', long_line + b'partial')))
+
+    def test_snapshot_skips_empty_and_already_tracked_files(self):
+        tracked = self._write('tracked.log', b'shipped before\n')
+        history = self._write('history.log', b'old\n')
+        self._write('empty.log', b'')
+        files = backfill.list_log_files(os.path.join(self.temp_dir.name, '*.log'))
+        entries = backfill.take_snapshot(files, {os.stat(tracked).st_ino: 15})
+        self.assertEqual([(os.stat(history).st_ino, 4, history)], entries)
+
+    def test_list_log_files_applies_the_exclude_path_and_cutoff(self):
+        old = self._write('old.log', b'old\n')
+        os.utime(old, (time.time() - 3600, time.time() - 3600))
+        self._write('skipped.log', b'skipped\n')
+        recent = self._write('recent.log', b'recent\n')
+        files = backfill.list_log_files(os.path.join(self.temp_dir.name, '*.log'),
+                                        os.path.join(self.temp_dir.name, 'skip*'), time.time() - 60)
+        self.assertEqual([recent], files)
+
+    def test_snapshot_round_trip(self):
+        snapshot_path = os.path.join(self.temp_dir.name, 'db', 'backfill.snapshot')
+        self.assertIsNone(backfill.read_snapshot(snapshot_path))
+        entries = [(11, 20, '/logs/a.log'), (12, 4096, '/logs/with space.log')]
+        backfill.write_snapshot(snapshot_path, entries)
+        self.assertEqual(entries, backfill.read_snapshot(snapshot_path))
+        backfill.write_snapshot(snapshot_path, [])
+        self.assertEqual([], backfill.read_snapshot(snapshot_path))
+
+    def test_seeding_keeps_tracked_offsets(self):
+        backfill.seed_tail_db(self.db_path, [(11, 20, '/logs/a.log')])
+        backfill.seed_tail_db(self.db_path, [(11, 5, '/logs/a.log'), (12, 30, '/logs/b.log')])
+        self.assertEqual({11: 20, 12: 30}, backfill.read_tail_db_offsets(self.db_path))
+        connection = sqlite3.connect(self.db_path)
+        rows = connection.execute('SELECT name, rotated FROM in_tail_files ORDER BY id').fetchall()
+        connection.close()
+        self.assertEqual([('/logs/a.log', 0), ('/logs/b.log', 0)], rows)
+
+    def test_pending_entries(self):
+        a = self._write('a.log', b'a\n' * 10)
+        b = self._write('b.log', b'b\n' * 10)
+        entries = [(os.stat(a).st_ino, 20, a), (os.stat(b).st_ino, 20, b), (999, 20, self._write('c.log', b'c\n')),
+                   (998, 20, os.path.join(self.temp_dir.name, 'removed.log'))]
+        pending = backfill.pending_entries(entries, {os.stat(a).st_ino: 20, os.stat(b).st_ino: 18})
+        self.assertEqual([(os.stat(b).st_ino, 20, b)], pending)
+
+
+class TestBackfillHandOff(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.containers_dir = os.path.join(self.temp_dir.name, 'containers')
+        self.env = {
+            'LOGZIO_LOGS_TOKEN': 'test_token',
+            'DOCKER_CONTAINERS_DIR': self.containers_dir,
+            'LOGS_PATH': f'{self.containers_dir}/*/*.log',
+            'TAIL_DB_PATH': os.path.join(self.temp_dir.name, 'db', 'tail.db'),
+            'BACKFILL_SNAPSHOT_FILE': os.path.join(self.temp_dir.name, 'db', 'backfill.snapshot'),
+            'BACKFILL_MODE': 'on',
+        }
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {**self.env, **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def _write_history(self):
+        # Three containers with history, one of them in the middle of writing a line
+        for index in range(3):
+            write_container(self.containers_dir, f'{index}' * 12, f'app-{index}', 'app:latest',
+                            [f'history {index} {line}' for line in range(50)])
+        partial = docker_log_line('half written line')
+        with open(container_log_path(self.containers_dir, '0' * 12), 'a') as file:
+            file.write(partial[:20])
+        return partial
+
+    def test_live_and_backfill_inputs_partition_every_line(self):
+        partial = self._write_history()
+        self._create_config()
+
+        # Logs written after the snapshot: the partial line is completed, the containers keep
+        # logging, and a new container starts
+        with open(container_log_path(self.containers_dir, '0' * 12), 'a') as file:
+            file.write(partial[20:])
+        for index in range(3):
+            append_log_lines(self.containers_dir, f'{index}' * 12, [f'live {index} {line}' for line in range(20)])
+        write_container(self.containers_dir, 'f' * 12, 'new', 'app:latest', [f'new {line}' for line in range(20)])
+
+        # The live input reads each file from its seeded offset, or from its start when it is new.
+        # The backfill input keeps the lines starting before the cut of the file in the snapshot.
+        live_offsets = backfill.read_tail_db_offsets(self.env['TAIL_DB_PATH'])
+        cuts = {path: cut for _, cut, path in backfill.read_snapshot(self.env['BACKFILL_SNAPSHOT_FILE'])}
+        for container_id in ['0' * 12, '1' * 12, '2' * 12, 'f' * 12]:
+            path = container_log_path(self.containers_dir, container_id)
+            lines = read_lines(path)
+            start = live_offsets.get(os.stat(path).st_ino, 0)
+            live = [line for offset, line in lines if offset >= start]
+            backfilled = [line for offset, line in lines if offset < cuts.get(path, 0)]
+            self.assertEqual([line for _, line in lines], backfilled + live, container_id)
+            self.assertEqual(0 if container_id == 'f' * 12 else 50, len(backfilled), container_id)
+
+    def test_history_is_cut_at_the_last_complete_line(self):
+        self._write_history()
+        self._create_config()
+        path = container_log_path(self.containers_dir, '0' * 12)
+        entries = {entry[2]: entry for entry in backfill.read_snapshot(self.env['BACKFILL_SNAPSHOT_FILE'])}
+        self.assertEqual(3, len(entries))
+        self.assertEqual(os.path.getsize(path) - 20, entries[path][1])
+        self.assertEqual(entries[path][1], backfill.read_tail_db_offsets(self.env['TAIL_DB_PATH'])[entries[path][0]])
+
+    def test_ignore_older_cutoff(self):
+        self._write_history()
+        old_path = container_log_path(self.containers_dir, '1' * 12)
+        os.utime(old_path, (time.time() - 3 * 86400, time.time() - 3 * 86400))
+        config = self._create_config(BACKFILL_IGNORE_OLDER='2d')
+        paths = [entry[2] for entry in backfill.read_snapshot(self.env['BACKFILL_SNAPSHOT_FILE'])]
+        self.assertEqual(2, len(paths))
+        self.assertNotIn(old_path, paths)
+        self.assertIn('    ignore_older 2d\n', config)
+
+    def test_backfill_inputs_stop_once_history_is_read(self):
+        self._write_history()
+        self.assertIn('docker.backfill.*', self._create_config())
+
+        # The backfill input read every file past its cut
+        with patch.dict(os.environ, self.env):
+            backfill_db_path = create_fluent_bit_config.get_backfill_db_path(create_fluent_bit_config.Config())
+        entries = backfill.read_snapshot(self.env['BACKFILL_SNAPSHOT_FILE'])
+        connection = sqlite3.connect(backfill_db_path)
+        with connection:
+            connection.executescript(backfill.TAIL_DB_SCHEMA)
+            connection.executemany('INSERT INTO in_tail_files (name, offset, inode) VALUES (?, ?, ?)',
+                                   [(path, cut, inode) for inode, cut, path in entries])
+        connection.close()
+
+        config = self._create_config()
+        self.assertNotIn('backfill', config)
+        self.assertIn('    Match *\n', config)
+
+    @unittest.skipUnless(fluent_bit_runner.fluent_bit_available(), 'Fluent Bit binary not available')
+    def test_fluent_bit_ships_every_line_once(self):
+        partial = self._write_history()
+        output_path = os.path.join(self.temp_dir.name, 'output', 'records.log')
+        os.makedirs(os.path.dirname(output_path))
+        env = {**self.env, 'BACKFILL_RATE': '4k'}
+        config_text = fluent_bit_runner.render_config(env, fluent_bit_runner.file_output_config(output_path))
+
+        def shipped_messages():
+            return [record['message'].rstrip('\n') for record in fluent_bit_runner.read_json_lines(output_path)]
+
+        with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(self.temp_dir.name, 'run'), env):
+            with open(container_log_path(self.containers_dir, '0' * 12), 'a') as file:
+                file.write(partial[20:])
+            for index in range(3):
+                append_log_lines(self.containers_dir, f'{index}' * 12, [f'live {index} {line}' for line in range(20)])
+            self.assertTrue(fluent_bit_runner.wait_for(lambda: len(shipped_messages()) >= 3 * 70 + 1, timeout=60))
+            time.sleep(2)
+
+        expected = [f'history {index} {line}' for index in range(3) for line in range(50)]
+        expected += [f'live {index} {line}' for index in range(3) for line in range(20)] + ['half written line']
+        self.assertEqual(sorted(expected), sorted(shipped_messages()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+from unittest.mock import patch
+import gzip
+import json
+import os
+import tempfile
+import urllib.request
+
+# Import the modules to be tested
+import bench_pipeline
+import create_fluent_bit_config
+from logzio_listener import LogzioListener
+from synthetic_logs import WorkloadWriter, container_log_path, synthetic_message, write_workload
+
+
+class TestSyntheticWorkload(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.containers_dir = os.path.join(self.temp_dir.name, 'containers')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _read_log(self, container_id):
+        with open(container_log_path(self.containers_dir, container_id)) as file:
+            return [json.loads(line) for line in file]
+
+    def test_workload_writes_docker_json_file_logs(self):
+        ids = write_workload(self.containers_dir, containers=3, backlog_lines=10, line_size=300, json_ratio=0.5)
+        self.assertEqual(3, len(set(ids)))
+        for container_id in ids:
+            lines = self._read_log(container_id)
+            self.assertEqual(10, len(lines))
+            self.assertEqual({'log', 'stream', 'time'}, set(lines[0]))
+            messages = [line['log'].rstrip('\n') for line in lines]
+            self.assertEqual(5, sum(message.startswith('{') for message in messages))
+            for message in messages:
+                self.assertAlmostEqual(300, len(message), delta=5)
+
+    def test_workload_containers_are_resolved_by_the_generator(self):
+        write_workload(self.containers_dir, containers=20)
+        with patch.dict(os.environ, {'DOCKER_CONTAINERS_DIR': self.containers_dir}):
+            containers = create_fluent_bit_config.discover_containers(create_fluent_bit_config.Config())
+        self.assertEqual(20, len(containers))
+        self.assertEqual('synthetic-0', containers[0]['name'])
+        self.assertEqual(16, len({container['id'][0] for container in containers}))
+
+    def test_writer_embeds_write_time(self):
+        ids = write_workload(self.containers_dir, containers=2)
+        writer = WorkloadWriter(self.containers_dir, ids, rate=400, duration=0.1, json_ratio=1.0)
+        writer.start()
+        writer.join()
+        lines = self._read_log(ids[0]) + self._read_log(ids[1])
+        self.assertEqual(writer.written, len(lines))
+        self.assertTrue(all(bench_pipeline.SENT_PATTERN.search(line['log']) for line in lines))
+        self.assertIsNotNone(bench_pipeline.SENT_PATTERN.search(synthetic_message(1, 100, False, 1.5)))
+        self.assertIsNone(bench_pipeline.SENT_PATTERN.search(synthetic_message(1, 100, True)))
+
+
+class TestBenchPipeline(unittest.TestCase):
+
+    def test_scenarios_render_valid_configs(self):
+        for name, scenario in bench_pipeline.SCENARIOS.items():
+            with self.subTest(scenario=name):
+                with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'bench_token', 'STORAGE_PATH': '/tmp/storage',
+                                             **scenario['env']}, clear=True), patch('builtins.print'):
+                    create_fluent_bit_config.create_fluent_bit_config(create_fluent_bit_config.Config())
+
+    def test_listener_records_arrival_of_each_record(self):
+        with LogzioListener() as listener:
+            payload = gzip.compress(b'{"message": "INFO seq=1 sent=100.5 x"}\n')
+            request = urllib.request.Request(listener.url, data=payload, method='POST')
+            urllib.request.urlopen(request, timeout=10).read()
+            arrived_at, record = listener.records[0]
+        self.assertGreater(arrived_at, 100.5)
+        self.assertEqual('100.5', bench_pipeline.SENT_PATTERN.search(json.dumps(record)).group(1))
+
+    def test_compare_with_baseline(self):
+        baseline = {'scenarios': {'default': {'events_per_sec': 1000, 'latency_p99_ms': 100, 'cpu_seconds': 10,
+                                              'peak_rss_mb': 50}}}
+        results = {'scenarios': {'default': {'events_per_sec': 800, 'latency_p99_ms': 105, 'cpu_seconds': 12,
+                                             'peak_rss_mb': None},
+                                 'new-scenario': {'events_per_sec': 1}}}
+        regressions = bench_pipeline.compare_with_baseline(results, baseline, tolerance=0.15)
+        self.assertEqual(['default: events_per_sec 1000 -> 800 (-20%)', 'default: cpu_seconds 10 -> 12 (+20%)'],
+                         regressions)
+
+    def test_percentile(self):
+        self.assertEqual(50, bench_pipeline.percentile(range(101), 0.5))
+        self.assertEqual(99, bench_pipeline.percentile(range(101), 0.99))
+        self.assertIsNone(bench_pipeline.percentile([], 0.99))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,26 @@
 import unittest
 from unittest.mock import patch, mock_open
+import contextlib
+import fnmatch
+import glob
+import gzip
+import http.server
+import json
 import os
+import re
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.request
 
 # Import the module to be tested
 import create_fluent_bit_config
+import fluent_bit_runner
+from logzio_listener import LogzioListener
+import synthetic_logs
+from synthetic_logs import append_log_lines, write_container, write_workload
 
 class TestCreateFluentBitConfig(unittest.TestCase):
 
@@ -117,8 +134,7 @@ class TestCreateFluentBitConfig(unittest.TestCase):
     def test_skip_container_names(self):
         config_obj = create_fluent_bit_config.Config()
         config = create_fluent_bit_config.create_fluent_bit_config(config_obj)
-        self.assertIn('Exclude docker_container_name db', config)
-        self.assertIn('Exclude docker_container_name cache', config)
+        self.assertIn('Exclude docker_container_name (?:db)|(?:cache)', config)
 
     @patch.dict(os.environ, {
         'LOGZIO_LOGS_TOKEN': 'test_token',
@@ -138,8 +154,7 @@ class TestCreateFluentBitConfig(unittest.TestCase):
     def test_skip_image_names(self):
         config_obj = create_fluent_bit_config.Config()
         config = create_fluent_bit_config.create_fluent_bit_config(config_obj)
-        self.assertIn('Exclude docker_container_image redis', config)
-        self.assertIn('Exclude docker_container_image postgres', config)
+        self.assertIn('Exclude docker_container_image (?:redis)|(?:postgres)', config)
 
     @patch.dict(os.environ, {
         'LOGZIO_LOGS_TOKEN': 'test_token',
@@ -159,7 +174,9 @@ class TestCreateFluentBitConfig(unittest.TestCase):
     def test_include_line(self):
         config_obj = create_fluent_bit_config.Config()
         config = create_fluent_bit_config.create_fluent_bit_config(config_obj)
-        self.assertIn('Regex message ERROR', config)
+        self.assertIn('Regex log ERROR', config)
+        # Message filters run before the Lua enrichment filter
+        self.assertLess(config.index('Regex log ERROR'), config.index('Name lua'))
 
     @patch.dict(os.environ, {
         'LOGZIO_LOGS_TOKEN': 'test_token',
@@ -168,8 +185,7 @@ class TestCreateFluentBitConfig(unittest.TestCase):
     def test_exclude_lines(self):
         config_obj = create_fluent_bit_config.Config()
         config = create_fluent_bit_config.create_fluent_bit_config(config_obj)
-        self.assertIn('Exclude message DEBUG', config)
-        self.assertIn('Exclude message TRACE', config)
+        self.assertIn('Exclude log (?:DEBUG)|(?:TRACE)', config)
 
     @patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token'})
     def test_save_config_file(self):
@@ -224,5 +240,1695 @@ class TestCreateFluentBitConfig(unittest.TestCase):
             # Since MULTILINE_START_STATE_RULE is not set, multiline config should not be created
             mock_create_multiline_config.assert_not_called()
 
+
+
+# Docker Engine API stand-in serving a fixed container list on a Unix socket
+class DockerSocketStandIn(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, containers):
+        self.containers = containers
+        super().__init__(socket_path, DockerSocketHandler)
+
+
+class DockerSocketHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if not self.path.startswith('/containers/json'):
+            self.send_error(404)
+            return
+        body = json.dumps([
+            {'Id': container_id, 'Names': [f'/{name}'], 'Image': image}
+            for container_id, name, image in self.server.containers
+        ]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestContainerPathFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.containers_dir = os.path.join(self.temp_dir.name, 'containers')
+        write_container(self.containers_dir, 'aaa111', 'web', 'nginx:1.25')
+        write_container(self.containers_dir, 'bbb222', 'db', 'postgres:16')
+        write_container(self.containers_dir, 'ccc333', 'cache', 'redis:7')
+        self.env = {
+            'LOGZIO_LOGS_TOKEN': 'test_token',
+            'CONTAINER_FILTER_MODE': 'path',
+            'DOCKER_CONTAINERS_DIR': self.containers_dir,
+            'LOGS_PATH': f'{self.containers_dir}/*/*.log',
+        }
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {**self.env, **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_match_container_name_tails_only_matching_containers(self):
+        config = self._create_config(MATCH_CONTAINER_NAME='^web$')
+        self.assertIn(f'Path         {self.containers_dir}/aaa111/*.log\n', config)
+        self.assertNotIn('Exclude_Path', config)
+        self.assertIn(f'DB           {create_fluent_bit_config.DEFAULT_TAIL_DB_PATH}', config)
+        # The grep filter stays in place for containers started between refreshes
+        self.assertIn('Regex docker_container_name ^web$', config)
+
+    def test_containers_added_on_refresh_are_read_from_their_start(self):
+        config = self._create_config(MATCH_CONTAINER_NAME='^web$')
+        self.assertIn('    read_from_head true\n', config)
+        config = self._create_config(MATCH_CONTAINER_NAME='^web$', READ_FROM_HEAD='false')
+        self.assertIn('    read_from_head false\n', config)
+
+    def test_match_image_name_combined_with_skip_container_names(self):
+        config = self._create_config(MATCH_IMAGE_NAME='^(nginx|redis)', SKIP_CONTAINER_NAMES='cache')
+        self.assertIn(f'Path         {self.containers_dir}/aaa111/*.log\n', config)
+
+    def test_skip_names_become_exclude_paths(self):
+        config = self._create_config(SKIP_CONTAINER_NAMES='db,cache')
+        self.assertIn(f'Path         {self.containers_dir}/*/*.log', config)
+        self.assertIn(f'Exclude_Path {self.containers_dir}/bbb222/*.log,{self.containers_dir}/ccc333/*.log', config)
+
+    def test_no_matching_container_falls_back_to_logs_path(self):
+        config = self._create_config(MATCH_CONTAINER_NAME='^missing$')
+        self.assertIn(f'Path         {self.containers_dir}/*/*.log', config)
+
+    def test_logs_path_file_pattern_is_kept(self):
+        config = self._create_config(MATCH_CONTAINER_NAME='^db$', LOGS_PATH=f'{self.containers_dir}/*/*-json.log')
+        self.assertIn(f'Path         {self.containers_dir}/bbb222/*-json.log\n', config)
+
+    def test_grep_mode_keeps_logs_path(self):
+        config = self._create_config(MATCH_CONTAINER_NAME='^web$', CONTAINER_FILTER_MODE='grep')
+        self.assertIn(f'Path         {self.containers_dir}/*/*.log', config)
+        self.assertNotIn('DB ', config)
+
+    def test_invalid_filter_mode(self):
+        with self.assertRaises(ValueError) as context:
+            self._create_config(CONTAINER_FILTER_MODE='fast')
+        self.assertIn('CONTAINER_FILTER_MODE must be one of', str(context.exception))
+
+    def test_socket_resolver(self):
+        socket_path = os.path.join(self.temp_dir.name, 'docker.sock')
+        server = DockerSocketStandIn(socket_path, [('ddd444', 'api', 'python:3.12'), ('eee555', 'worker', 'python:3.12')])
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            config = self._create_config(MATCH_CONTAINER_NAME='^api$', CONTAINER_RESOLVER='socket',
+                                         DOCKER_SOCKET=socket_path)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn(f'Path         {self.containers_dir}/ddd444/*.log\n', config)
+
+    def test_unreachable_socket_falls_back_to_logs_path(self):
+        config = self._create_config(MATCH_CONTAINER_NAME='^web$', CONTAINER_RESOLVER='socket',
+                                     DOCKER_SOCKET=os.path.join(self.temp_dir.name, 'missing.sock'))
+        self.assertIn(f'Path         {self.containers_dir}/*/*.log', config)
+
+
+class TestTailOffsetDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_no_database_by_default(self):
+        config = self._create_config()
+        self.assertNotIn('DB ', config)
+        # Without offsets, reading from the start would ship every file again on each restart
+        self.assertNotIn('read_from_head', config)
+
+    def test_database_settings(self):
+        config = self._create_config(TAIL_DB_PATH='/var/lib/logzio/tail.db', TAIL_DB_SYNC='Full',
+                                     TAIL_DB_LOCKING='true', TAIL_DB_JOURNAL_MODE='wal')
+        self.assertIn('DB           /var/lib/logzio/tail.db\n', config)
+        self.assertIn('DB.sync      full\n', config)
+        self.assertIn('DB.locking   true\n', config)
+        self.assertIn('DB.journal_mode WAL\n', config)
+
+    def test_database_defaults(self):
+        config = self._create_config(TAIL_DB_PATH='/var/lib/logzio/tail.db')
+        self.assertIn('DB.sync      normal\n', config)
+        self.assertIn('DB.locking   false\n', config)
+        self.assertIn('DB.journal_mode WAL\n', config)
+
+    def test_invalid_database_settings(self):
+        invalid_settings = [
+            ({'TAIL_DB_PATH': 'tail.db'}, 'TAIL_DB_PATH must be an absolute path'),
+            ({'TAIL_DB_SYNC': 'sometimes'}, 'TAIL_DB_SYNC must be one of'),
+            ({'TAIL_DB_LOCKING': 'yes'}, 'TAIL_DB_LOCKING must be true or false'),
+            ({'TAIL_DB_JOURNAL_MODE': 'fast'}, 'TAIL_DB_JOURNAL_MODE must be one of'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+    @patch('os.makedirs')
+    @patch('create_fluent_bit_config.save_config_file')
+    @patch('builtins.open', mock_open())
+    @patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', 'TAIL_DB_PATH': '/var/lib/logzio/tail.db'})
+    def test_main_creates_database_directory(self, mock_save_config_file, mock_makedirs):
+        create_fluent_bit_config.main()
+        mock_makedirs.assert_any_call('/var/lib/logzio', exist_ok=True)
+
+    @unittest.skipUnless(fluent_bit_runner.fluent_bit_available(), 'Fluent Bit binary not available')
+    def test_restart_resumes_from_stored_offsets(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            containers_dir = os.path.join(temp_dir, 'containers')
+            output_path = os.path.join(temp_dir, 'output', 'records.log')
+            os.makedirs(os.path.dirname(output_path))
+            write_container(containers_dir, 'abc123', 'web', 'nginx', [f'first run {i}' for i in range(5)])
+            env = {
+                'DOCKER_CONTAINERS_DIR': containers_dir,
+                'LOGS_PATH': f'{containers_dir}/*/*.log',
+                'TAIL_DB_PATH': os.path.join(temp_dir, 'db', 'tail.db'),
+            }
+            os.makedirs(os.path.join(temp_dir, 'db'))
+            config_text = fluent_bit_runner.render_config(env, fluent_bit_runner.file_output_config(output_path))
+
+            def shipped_messages():
+                return [record['message'].rstrip('\n') for record in fluent_bit_runner.read_json_lines(output_path)]
+
+            with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(temp_dir, 'run1'), env):
+                self.assertTrue(fluent_bit_runner.wait_for(lambda: len(shipped_messages()) >= 5))
+
+            append_log_lines(containers_dir, 'abc123', [f'second run {i}' for i in range(3)])
+            with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(temp_dir, 'run2'), env):
+                self.assertTrue(fluent_bit_runner.wait_for(lambda: len(shipped_messages()) >= 8))
+                time.sleep(2)
+
+            expected = [f'first run {i}' for i in range(5)] + [f'second run {i}' for i in range(3)]
+            self.assertEqual(expected, shipped_messages())
+
+
+class TestBuffering(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_memory_buffering_by_default(self):
+        config = self._create_config()
+        self.assertNotIn('storage.', config)
+        self.assertNotIn('Mem_Buf_Limit', config)
+
+    def test_memory_buffering_with_input_limit(self):
+        config = self._create_config(MEM_BUF_LIMIT='32M')
+        self.assertIn('    Mem_Buf_Limit 32M\n', config)
+        self.assertNotIn('storage.type', config)
+
+    def test_filesystem_buffering(self):
+        config = self._create_config(BUFFERING_MODE='filesystem', STORAGE_PATH='/var/lib/logzio/storage',
+                                     MEM_BUF_LIMIT='16M', STORAGE_TOTAL_LIMIT_SIZE='2G')
+        self.assertIn('    storage.path /var/lib/logzio/storage\n', config)
+        self.assertIn('    storage.sync normal\n', config)
+        self.assertIn('    storage.backlog.mem_limit 5M\n', config)
+        self.assertIn('    storage.max_chunks_up 64\n', config)
+        self.assertIn('    storage.type filesystem\n', config)
+        self.assertIn('    Mem_Buf_Limit 16M\n', config)
+        self.assertIn('    storage.total_limit_size 2G\n', config)
+
+    def test_invalid_buffering_settings(self):
+        invalid_settings = [
+            ({'BUFFERING_MODE': 'disk'}, 'BUFFERING_MODE must be one of'),
+            ({'MEM_BUF_LIMIT': 'lots'}, 'MEM_BUF_LIMIT must be a size'),
+            ({'BUFFERING_MODE': 'filesystem', 'STORAGE_PATH': 'storage'}, 'STORAGE_PATH must be an absolute path'),
+            ({'BUFFERING_MODE': 'filesystem', 'STORAGE_SYNC': 'extra'}, 'STORAGE_SYNC must be one of'),
+            ({'BUFFERING_MODE': 'filesystem', 'STORAGE_TOTAL_LIMIT_SIZE': '1T'}, 'STORAGE_TOTAL_LIMIT_SIZE must be a size'),
+            ({'BUFFERING_MODE': 'filesystem', 'STORAGE_MAX_CHUNKS_UP': '0'}, 'STORAGE_MAX_CHUNKS_UP must be a positive'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+    def test_parse_size(self):
+        self.assertEqual(512, create_fluent_bit_config.parse_size('512'))
+        self.assertEqual(32 * 1024, create_fluent_bit_config.parse_size('32k'))
+        self.assertEqual(5 * 1024 ** 2, create_fluent_bit_config.parse_size('5MB'))
+        self.assertEqual(1024 ** 3, create_fluent_bit_config.parse_size('1G'))
+        self.assertIsNone(create_fluent_bit_config.parse_size('1.5M'))
+
+    def test_listener_stand_in_holds_requests_while_stalled(self):
+        with LogzioListener() as listener:
+            listener.stall()
+            payload = gzip.compress(b'{"message": "one"}\n{"message": "two"}\n')
+            request = urllib.request.Request(listener.url + '/?token=test', data=payload, method='POST',
+                                             headers={'Content-Encoding': 'gzip'})
+            thread = threading.Thread(target=lambda: urllib.request.urlopen(request, timeout=10).read())
+            thread.start()
+            time.sleep(0.5)
+            self.assertEqual(0, listener.record_count())
+            listener.resume()
+            thread.join(timeout=10)
+            self.assertEqual(2, listener.record_count())
+            self.assertEqual((1, len(payload)), listener.request_stats())
+
+    @unittest.skipUnless(fluent_bit_runner.fluent_bit_available() and fluent_bit_runner.logzio_plugin_available(),
+                         'Fluent Bit binary or Logz.io plugin not available')
+    def test_memory_stays_bounded_while_listener_stalls(self):
+        line_count = 200000
+        rss_limit = 256 * 1024 ** 2
+        with tempfile.TemporaryDirectory() as temp_dir, LogzioListener() as listener:
+            containers_dir = os.path.join(temp_dir, 'containers')
+            write_container(containers_dir, 'abc123', 'chatty', 'busybox')
+            env = {
+                'LOGZIO_LOGS_TOKEN': 'test_token',
+                'LOGZIO_URL': listener.url,
+                'DOCKER_CONTAINERS_DIR': containers_dir,
+                'LOGS_PATH': f'{containers_dir}/*/*.log',
+                'READ_FROM_HEAD': 'true',
+                'BUFFERING_MODE': 'filesystem',
+                'STORAGE_PATH': os.path.join(temp_dir, 'storage'),
+                'STORAGE_MAX_CHUNKS_UP': '8',
+                'MEM_BUF_LIMIT': '8M',
+            }
+            config_text = fluent_bit_runner.render_config(env)
+            listener.stall()
+            with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(temp_dir, 'run'), env) as fluent_bit:
+                peak_rss = 0
+                for batch in range(20):
+                    append_log_lines(containers_dir, 'abc123',
+                                     [f'line {batch * 10000 + i} ' + 'x' * 150 for i in range(10000)])
+                    time.sleep(0.5)
+                    peak_rss = max(peak_rss, fluent_bit_runner.rss_bytes(fluent_bit.process.pid))
+                self.assertLess(peak_rss, rss_limit)
+
+                listener.resume()
+                self.assertTrue(fluent_bit_runner.wait_for(lambda: listener.record_count() >= line_count, timeout=300))
+
+
+class TestOutputSharding(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def _output_sections(self, config):
+        return config.split('[OUTPUT]')[1:]
+
+    def test_single_output_by_default(self):
+        outputs = self._output_sections(self._create_config())
+        self.assertEqual(1, len(outputs))
+        self.assertIn('    Match *\n', outputs[0])
+        self.assertIn('    id output_id\n', outputs[0])
+        self.assertNotIn('Workers', outputs[0])
+
+    def test_output_workers(self):
+        config = self._create_config(OUTPUT_WORKERS='4')
+        self.assertIn('    Workers 4\n', config)
+
+    def test_sharded_outputs_have_their_own_ids(self):
+        outputs = self._output_sections(self._create_config(OUTPUT_SHARDS='4', OUTPUT_ID='shipper', OUTPUT_WORKERS='2'))
+        self.assertEqual(4, len(outputs))
+        for index, output in enumerate(outputs):
+            self.assertIn(f'    id shipper-{index}\n', output)
+            self.assertIn('    Match_Regex ', output)
+            self.assertIn('    Workers 2\n', output)
+        self.assertIn('    Match_Regex \\.[0123][0-9a-f]*-json\\.log$\n', outputs[0])
+
+    def test_every_tag_is_shipped_by_exactly_one_shard(self):
+        tags = [f'docker.var.lib.docker.containers.{a}{b}99.{a}{b}99-json.log'
+                for a in '0123456789abcdef' for b in '0f']
+        tags += ['docker.var.log.app.log', 'docker.var.lib.docker.containers.abc.abc-json.log.1']
+        for shards in range(2, create_fluent_bit_config.MAX_OUTPUT_SHARDS + 1):
+            with self.subTest(shards=shards):
+                config = self._create_config(OUTPUT_SHARDS=str(shards))
+                patterns = [line.strip().split(' ', 1)[1] for line in config.splitlines() if 'Match_Regex' in line]
+                self.assertEqual(shards, len(patterns))
+                for tag in tags:
+                    self.assertEqual(1, sum(re.search(pattern, tag) is not None for pattern in patterns), tag)
+
+    def test_split_container_id_prefixes(self):
+        self.assertEqual(['0123456789abcdef'], create_fluent_bit_config.split_container_id_prefixes(1))
+        self.assertEqual(['012345', '6789a', 'bcdef'], create_fluent_bit_config.split_container_id_prefixes(3))
+        self.assertEqual(list('0123456789abcdef'), create_fluent_bit_config.split_container_id_prefixes(16))
+
+    def test_shards_split_the_storage_limit(self):
+        config = self._create_config(OUTPUT_SHARDS='4', BUFFERING_MODE='filesystem', STORAGE_TOTAL_LIMIT_SIZE='1G')
+        self.assertEqual(4, config.count(f'    storage.total_limit_size {1024 ** 3 // 4}\n'))
+
+    def test_invalid_output_settings(self):
+        for env, message in [({'OUTPUT_WORKERS': '0'}, 'OUTPUT_WORKERS must be a positive number'),
+                             ({'OUTPUT_SHARDS': '17'}, 'OUTPUT_SHARDS must be a number between 1 and 16'),
+                             ({'OUTPUT_SHARDS': 'many'}, 'OUTPUT_SHARDS must be a number between 1 and 16')]:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+
+class TestPerformanceProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_balanced_profile_by_default(self):
+        config = self._create_config()
+        self.assertIn('    Flush        1\n', config)
+        self.assertIn('    Buffer_Chunk_Size 32k\n', config)
+        self.assertIn('    Buffer_Max_Size 32k\n', config)
+        self.assertIn('    Refresh_Interval 60\n', config)
+        self.assertIn('    Rotate_Wait 5\n', config)
+        self.assertNotIn('Workers', config)
+
+    def test_profiles_expand_to_their_settings(self):
+        for profile, settings in create_fluent_bit_config.PERFORMANCE_PROFILES.items():
+            with self.subTest(profile=profile):
+                config = self._create_config(PERFORMANCE_PROFILE=profile)
+                self.assertIn(f"    Flush        {settings['flush_interval']}\n", config)
+                self.assertIn(f"    Buffer_Chunk_Size {settings['buffer_chunk_size']}\n", config)
+                self.assertIn(f"    Buffer_Max_Size {settings['buffer_max_size']}\n", config)
+                self.assertIn(f"    Refresh_Interval {settings['refresh_interval']}\n", config)
+                self.assertIn(f"    Rotate_Wait {settings['rotate_wait']}\n", config)
+                if settings['output_workers']:
+                    self.assertIn(f"    Workers {settings['output_workers']}\n", config)
+
+    def test_environment_overrides_profile(self):
+        config = self._create_config(PERFORMANCE_PROFILE='high-throughput', FLUSH_INTERVAL='2',
+                                     BUFFER_MAX_SIZE='4M', ROTATE_WAIT='30', OUTPUT_WORKERS='8')
+        self.assertIn('    Flush        2\n', config)
+        self.assertIn('    Buffer_Chunk_Size 256k\n', config)
+        self.assertIn('    Buffer_Max_Size 4M\n', config)
+        self.assertIn('    Rotate_Wait 30\n', config)
+        self.assertIn('    Workers 8\n', config)
+
+    def test_invalid_performance_settings(self):
+        invalid_settings = [
+            ({'PERFORMANCE_PROFILE': 'turbo'}, 'PERFORMANCE_PROFILE must be one of'),
+            ({'FLUSH_INTERVAL': '0'}, 'FLUSH_INTERVAL must be a positive number'),
+            ({'FLUSH_INTERVAL': 'soon'}, 'FLUSH_INTERVAL must be a positive number'),
+            ({'REFRESH_INTERVAL': '0'}, 'REFRESH_INTERVAL must be a positive number'),
+            ({'ROTATE_WAIT': '1.5'}, 'ROTATE_WAIT must be a positive number'),
+            ({'BUFFER_CHUNK_SIZE': 'big'}, 'BUFFER_CHUNK_SIZE must be a size'),
+            ({'BUFFER_CHUNK_SIZE': '64k'}, 'BUFFER_MAX_SIZE must be at least BUFFER_CHUNK_SIZE'),
+            ({'PERFORMANCE_PROFILE': 'low-latency', 'BUFFER_MAX_SIZE': '16k'},
+             'BUFFER_MAX_SIZE must be at least BUFFER_CHUNK_SIZE'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+
+class TestJsonDecodeModes(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.containers_dir = os.path.join(self.temp_dir.name, 'containers')
+        write_container(self.containers_dir, 'aaa111', 'api', 'node:20')
+        write_container(self.containers_dir, 'bbb222', 'web', 'nginx:1.25')
+        write_container(self.containers_dir, 'ccc333', 'worker', 'python:3.12')
+        self.env = {
+            'LOGZIO_LOGS_TOKEN': 'test_token',
+            'DOCKER_CONTAINERS_DIR': self.containers_dir,
+            'LOGS_PATH': f'{self.containers_dir}/*/*.log',
+        }
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {**self.env, **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_always_decodes_json_by_default(self):
+        config = self._create_config()
+        self.assertEqual(1, config.count('[INPUT]'))
+        self.assertIn('    Parser       docker\n', config)
+
+    def test_never_uses_plain_text_parser(self):
+        config = self._create_config(JSON_DECODE_MODE='never')
+        self.assertEqual(1, config.count('[INPUT]'))
+        self.assertIn('    Parser       docker_plain\n', config)
+
+    def test_selective_splits_inputs_by_container(self):
+        config = self._create_config(JSON_DECODE_MODE='selective', JSON_DECODE_CONTAINERS='^api$',
+                                     JSON_DECODE_IMAGES='^python')
+        json_input, plain_input = config.split('[INPUT]')[1:]
+        json_paths = f'{self.containers_dir}/aaa111/*.log,{self.containers_dir}/ccc333/*.log'
+        self.assertIn(f'    Path         {json_paths}\n', json_input)
+        self.assertIn('    Parser       docker\n', json_input)
+        self.assertIn(f'    Path         {self.containers_dir}/*/*.log\n', plain_input)
+        self.assertIn(f'    Exclude_Path {json_paths}\n', plain_input)
+        self.assertIn('    Parser       docker_plain\n', plain_input)
+
+    def test_selective_inputs_keep_their_offsets_across_restarts(self):
+        config = self._create_config(JSON_DECODE_MODE='selective', JSON_DECODE_IMAGES='^node')
+        inputs = config.split('[INPUT]')[1:]
+        self.assertEqual(2, len(inputs))
+        for input_config in inputs:
+            self.assertIn(f'    DB           {create_fluent_bit_config.DEFAULT_TAIL_DB_PATH}\n', input_config)
+            # A newly selected container moves to the JSON input only after a restart
+            self.assertIn('    read_from_head true\n', input_config)
+
+    def test_selective_respects_path_mode_selectors(self):
+        config = self._create_config(JSON_DECODE_MODE='selective', JSON_DECODE_IMAGES='node|python',
+                                     CONTAINER_FILTER_MODE='path', SKIP_CONTAINER_NAMES='worker')
+        json_input, plain_input = config.split('[INPUT]')[1:]
+        self.assertIn(f'    Path         {self.containers_dir}/aaa111/*.log\n', json_input)
+        self.assertIn(f'    Exclude_Path {self.containers_dir}/ccc333/*.log\n', json_input)
+        self.assertIn(f'    Exclude_Path {self.containers_dir}/ccc333/*.log,{self.containers_dir}/aaa111/*.log\n',
+                      plain_input)
+
+    def test_selective_without_matching_containers_uses_plain_text_parser(self):
+        config = self._create_config(JSON_DECODE_MODE='selective', JSON_DECODE_CONTAINERS='^billing$')
+        self.assertEqual(1, config.count('[INPUT]'))
+        self.assertIn('    Parser       docker_plain\n', config)
+
+    def test_selective_falls_back_to_json_decoding_on_resolver_error(self):
+        config = self._create_config(JSON_DECODE_MODE='selective', JSON_DECODE_CONTAINERS='(unclosed')
+        self.assertEqual(1, config.count('[INPUT]'))
+        self.assertIn('    Parser       docker\n', config)
+        self.assertIn('Could not resolve the per-container inputs', self.mock_print.call_args[0][0])
+
+    def test_invalid_json_decode_settings(self):
+        for env, message in [({'JSON_DECODE_MODE': 'auto'}, 'JSON_DECODE_MODE must be one of'),
+                             ({'JSON_DECODE_MODE': 'selective'}, 'requires JSON_DECODE_CONTAINERS or JSON_DECODE_IMAGES')]:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+    def test_plain_text_parser_is_defined(self):
+        with open(os.path.join(fluent_bit_runner.REPO_DIR, 'configs', 'parsers.conf')) as file:
+            parsers = file.read()
+        plain_parser = parsers.split('Name        docker_plain')[1]
+        self.assertNotIn('Decode_Field_As json', plain_parser)
+        self.assertIn('Decode_Field_As escaped log', plain_parser)
+
+    @unittest.skipUnless(fluent_bit_runner.fluent_bit_available(), 'Fluent Bit binary not available')
+    def test_selective_decodes_only_selected_containers(self):
+        append_log_lines(self.containers_dir, 'aaa111', ['{"level": "info", "msg": "json line"}'])
+        append_log_lines(self.containers_dir, 'bbb222', ['{"looks": "like json"} but is plain'])
+        output_path = os.path.join(self.temp_dir.name, 'out', 'records.json')
+        os.makedirs(os.path.dirname(output_path))
+        env = {**self.env, 'JSON_DECODE_MODE': 'selective', 'JSON_DECODE_CONTAINERS': '^api$',
+               'READ_FROM_HEAD': 'true'}
+        config_text = fluent_bit_runner.render_config(env, fluent_bit_runner.file_output_config(output_path))
+        with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(self.temp_dir.name, 'run'), env):
+            self.assertTrue(fluent_bit_runner.wait_for(lambda: len(fluent_bit_runner.read_json_lines(output_path)) >= 2))
+        records = {record['docker_container_name']: record for record in fluent_bit_runner.read_json_lines(output_path)}
+        self.assertEqual('info', records['api']['message']['level'])
+        self.assertIsInstance(records['web']['message'], str)
+
+
+class TestMultilineRules(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.containers_dir = os.path.join(self.temp_dir.name, 'containers')
+        write_container(self.containers_dir, 'aaa111', 'api', 'openjdk:21')
+        write_container(self.containers_dir, 'bbb222', 'web', 'nginx:1.25')
+        write_container(self.containers_dir, 'ccc333', 'worker', 'python:3.12')
+        self.rules = [
+            {'name': 'java', 'images': '^openjdk', 'start_state': r'^\d{4}-\d{2}-\d{2}', 'cont': [r'^\s+at '],
+             'flush_timeout': 500, 'buffer_limit': '5M'},
+            {'name': 'python', 'containers': '^worker$', 'start_state': '^Traceback'},
+        ]
+        self.env = {
+            'LOGZIO_LOGS_TOKEN': 'test_token',
+            'DOCKER_CONTAINERS_DIR': self.containers_dir,
+            'LOGS_PATH': f'{self.containers_dir}/*/*.log',
+            'MULTILINE_RULES': json.dumps(self.rules),
+        }
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _config_obj(self, **env):
+        with patch.dict(os.environ, {**self.env, **env}):
+            return create_fluent_bit_config.Config()
+
+    def _create_config(self, **env):
+        return create_fluent_bit_config.create_fluent_bit_config(self._config_obj(**env))
+
+    def test_rule_containers_get_their_own_inputs(self):
+        java_input, python_input, default_input = self._create_config().split('[INPUT]')[1:]
+        self.assertIn(f'    Path         {self.containers_dir}/aaa111/*.log\n', java_input)
+        self.assertIn('    multiline.parser multiline-java\n', java_input)
+        self.assertIn('    Mem_Buf_Limit 5M\n', java_input)
+        self.assertIn(f'    Path         {self.containers_dir}/ccc333/*.log\n', python_input)
+        self.assertIn('    multiline.parser multiline-python\n', python_input)
+        self.assertIn('    Mem_Buf_Limit 10M\n', python_input)
+
+        self.assertIn(f'    Path         {self.containers_dir}/*/*.log\n', default_input)
+        self.assertIn(f'    Exclude_Path {self.containers_dir}/aaa111/*.log,{self.containers_dir}/ccc333/*.log\n',
+                      default_input)
+        self.assertNotIn('multiline.parser', default_input)
+        self.assertNotIn('Mem_Buf_Limit', default_input)
+
+    def test_rule_inputs_keep_their_offsets_across_restarts(self):
+        # Rule inputs read from the head of new files, so without offsets every restart would
+        # ship the history of their containers again
+        for input_config in self._create_config().split('[INPUT]')[1:]:
+            self.assertIn(f'    DB           {create_fluent_bit_config.DEFAULT_TAIL_DB_PATH}\n', input_config)
+
+    def test_rules_render_their_own_parsers(self):
+        multiline_config = create_fluent_bit_config.create_multiline_parser_config(self._config_obj())
+        java_parser, python_parser = multiline_config.split('[MULTILINE_PARSER]')[1:]
+        self.assertIn('name          multiline-java', java_parser)
+        self.assertIn('flush_timeout 500', java_parser)
+        self.assertIn(r'rule      "start_state"   "/^\d{4}-\d{2}-\d{2}/"  "cont"', java_parser)
+        self.assertIn(r'rule      "cont"          "/^\s+at /"                     "cont"', java_parser)
+        self.assertIn('flush_timeout 1000', python_parser)
+        self.assertIn('rule      "start_state"   "/^Traceback/"\n', python_parser)
+        self.assertNotIn('multiline-regex', multiline_config)
+
+    def test_rules_combine_with_selective_json_decoding(self):
+        config = self._create_config(JSON_DECODE_MODE='selective', JSON_DECODE_IMAGES='^openjdk|^nginx')
+        inputs = config.split('[INPUT]')[1:]
+        self.assertEqual(4, len(inputs))
+        self.assertIn('    Parser       docker\n', inputs[0])
+        self.assertIn('multiline-java', inputs[0])
+        self.assertIn('    Parser       docker\n', inputs[1])
+        self.assertIn(f'    Path         {self.containers_dir}/bbb222/*.log\n', inputs[1])
+        self.assertNotIn('multiline.parser', inputs[1])
+        self.assertIn('    Parser       docker_plain\n', inputs[2])
+        self.assertIn('multiline-python', inputs[2])
+        self.assertIn('    Parser       docker_plain\n', inputs[3])
+
+    def test_main_saves_rule_parsers(self):
+        with patch.dict(os.environ, self.env), \
+                patch('builtins.open', mock_open(read_data='plugin')), \
+                patch('create_fluent_bit_config.save_config_file') as mock_save_config_file, \
+                patch('os.makedirs'):
+            create_fluent_bit_config.main()
+        saved_paths = [call.args[1] for call in mock_save_config_file.call_args_list]
+        self.assertIn(create_fluent_bit_config.PARSERS_MULTILINE_CONF_PATH, saved_paths)
+
+    def test_invalid_multiline_rules(self):
+        invalid_rules = [
+            ('not json', 'MULTILINE_RULES must be a JSON list of rules'),
+            ('{"name": "java"}', 'MULTILINE_RULES must be a JSON list of rules'),
+            ('[{"name": "java stack", "images": "x", "start_state": "x"}]', 'needs a name made of letters'),
+            ('[{"name": "java", "start_state": "x"}]', "Multiline rule 'java' needs containers or images"),
+            ('[{"name": "java", "images": "("}]', "Multiline rule 'java' has an invalid pattern"),
+            ('[{"name": "java", "images": "x"}]', "Multiline rule 'java' needs a start_state pattern"),
+            ('[{"name": "java", "images": "x", "start_state": "x", "flush_timeout": 0}]', 'flush_timeout must be'),
+            ('[{"name": "java", "images": "x", "start_state": "x", "buffer_limit": "lots"}]', 'buffer_limit must be'),
+            ('[{"name": "a", "images": "x", "start_state": "x"}, {"name": "a", "images": "y", "start_state": "y"}]',
+             "Multiline rule 'a' is defined more than once"),
+        ]
+        for rules, message in invalid_rules:
+            with self.subTest(rules=rules):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(MULTILINE_RULES=rules)
+                self.assertIn(message, str(context.exception))
+
+    def test_cannot_combine_rules_with_global_multiline(self):
+        with self.assertRaises(ValueError) as context:
+            self._create_config(MULTILINE_START_STATE_RULE='^ERROR')
+        self.assertIn('Cannot use both MULTILINE_RULES and MULTILINE_START_STATE_RULE', str(context.exception))
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_metrics_disabled_by_default(self):
+        config = self._create_config()
+        self.assertNotIn('HTTP_Server', config)
+        self.assertNotIn('Health_Check', config)
+
+    def test_metrics_enabled(self):
+        config = self._create_config(METRICS_ENABLED='true', METRICS_PORT='9102', HEALTH_CHECK_PERIOD='30')
+        service = config.split('[INPUT]')[0]
+        self.assertIn('    HTTP_Server  On\n', service)
+        self.assertIn('    HTTP_Listen  0.0.0.0\n', service)
+        self.assertIn('    HTTP_Port    9102\n', service)
+        self.assertIn('    Health_Check On\n', service)
+        self.assertIn('    HC_Errors_Count 5\n', service)
+        self.assertIn('    HC_Retry_Failure_Count 5\n', service)
+        self.assertIn('    HC_Period 30\n', service)
+        self.assertIn('    storage.metrics on\n', service)
+
+    def test_invalid_metrics_settings(self):
+        for env, message in [({'METRICS_ENABLED': 'yes'}, 'METRICS_ENABLED must be true or false'),
+                             ({'METRICS_ENABLED': 'true', 'METRICS_PORT': '70000'}, 'METRICS_PORT must be a port'),
+                             ({'METRICS_ENABLED': 'true', 'HEALTH_CHECK_PERIOD': '0'},
+                              'HEALTH_CHECK_PERIOD must be a positive number')]:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+    @unittest.skipUnless(fluent_bit_runner.fluent_bit_available(), 'Fluent Bit binary not available')
+    def test_metrics_endpoint_serves_pipeline_counters(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            containers_dir = os.path.join(temp_dir, 'containers')
+            write_container(containers_dir, 'abc123', 'web', 'nginx', [f'line {i}' for i in range(10)])
+            output_path = os.path.join(temp_dir, 'out', 'records.json')
+            os.makedirs(os.path.dirname(output_path))
+            env = {'LOGZIO_LOGS_TOKEN': 'test_token', 'LOGS_PATH': f'{containers_dir}/*/*.log',
+                   'DOCKER_CONTAINERS_DIR': containers_dir, 'METRICS_ENABLED': 'true', 'METRICS_LISTEN': '127.0.0.1',
+                   'METRICS_PORT': '22020', 'DOCKER_METADATA_METRICS_FILE': os.path.join(temp_dir, 'lua.prom'),
+                   'DOCKER_METADATA_METRICS_INTERVAL': '1'}
+            config_text = fluent_bit_runner.render_config(env, fluent_bit_runner.file_output_config(output_path))
+            with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(temp_dir, 'run'), env):
+                self.assertTrue(fluent_bit_runner.wait_for(
+                    lambda: len(fluent_bit_runner.read_json_lines(output_path)) >= 10))
+
+                def get(path):
+                    with urllib.request.urlopen(f'http://127.0.0.1:22020{path}', timeout=5) as response:
+                        return response.read().decode()
+
+                metrics = get('/api/v1/metrics/prometheus')
+                self.assertIn('fluentbit_input_records_total', metrics)
+                self.assertIn('fluentbit_output_proc_records_total', metrics)
+                self.assertIn('storage_layer', get('/api/v1/storage'))
+                self.assertIn('ok', get('/api/v1/health'))
+            with open(os.path.join(temp_dir, 'lua.prom')) as file:
+                self.assertIn('docker_metadata_records_enriched_total', file.read())
+
+
+class TestRateLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_no_rate_limit_by_default(self):
+        self.assertNotIn('rate_limit_records', self._create_config())
+
+    def test_rate_limit_runs_before_enrichment(self):
+        config = self._create_config(RATE_LIMIT='100:500:drop', EXCLUDE_LINES='DEBUG')
+        filters = config.split('[FILTER]')[1:]
+        self.assertIn('Exclude log DEBUG', filters[0])
+        self.assertIn('    Name lua\n    Match docker.*\n', filters[1])
+        self.assertIn('    call rate_limit_records\n', filters[1])
+        self.assertIn('    call enrich_with_docker_metadata\n', filters[2])
+
+    def test_rate_limit_rules_alone_enable_the_filter(self):
+        config = self._create_config(RATE_LIMIT_RULES='container:^api%-=10:20:tag; image:^nginx=5:5:sample:10')
+        self.assertIn('    call rate_limit_records\n', config)
+
+    def test_invalid_rate_limits(self):
+        invalid_settings = [
+            ({'RATE_LIMIT': '100'}, 'RATE_LIMIT must be rate:burst:action'),
+            ({'RATE_LIMIT': '100:500:block'}, 'RATE_LIMIT must be rate:burst:action'),
+            ({'RATE_LIMIT': '0:500:drop'}, 'RATE_LIMIT must be rate:burst:action'),
+            ({'RATE_LIMIT': '100:500:sample:0'}, 'RATE_LIMIT must be rate:burst:action'),
+            ({'RATE_LIMIT_RULES': 'pod:api=1:1:drop'}, 'RATE_LIMIT_RULES entries must be'),
+            ({'RATE_LIMIT_RULES': 'container:=1:1:drop'}, 'RATE_LIMIT_RULES entries must be'),
+            ({'RATE_LIMIT_RULES': 'container:api=1:1'}, 'RATE_LIMIT_RULES must be rate:burst:action'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+
+class TestOutputEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_plugin_engine_by_default(self):
+        config = self._create_config()
+        self.assertIn('    Name  logzio\n', config)
+        self.assertNotIn('Name  http', config)
+
+    def test_native_engine_renders_http_output(self):
+        config = self._create_config(OUTPUT_ENGINE='native', LOGZIO_URL='https://listener-eu.logz.io:8071',
+                                     LOGZIO_TYPE='my type', HEADERS='x-team:core')
+        self.assertNotIn('Name  logzio', config)
+        expected_lines = [
+            '    Name  http\n',
+            '    Match *\n',
+            '    Alias output_id\n',
+            '    Host  listener-eu.logz.io\n',
+            '    Port  8071\n',
+            '    URI   /?token=test_token&type=my%20type\n',
+            '    Format json_lines\n',
+            '    json_date_key    @timestamp\n',
+            '    tls        On\n',
+            '    compress gzip\n',
+            '    Header User-Agent logzio-docker-collector-logs\n',
+            '    Header x-team core\n',
+        ]
+        for line in expected_lines:
+            self.assertIn(line, config)
+
+    def test_native_engine_options(self):
+        config = self._create_config(OUTPUT_ENGINE='native', LOGZIO_URL='http://127.0.0.1:9000/bulk',
+                                     OUTPUT_COMPRESS='none', OUTPUT_RETRY_LIMIT='no_limits', OUTPUT_SHARDS='2')
+        self.assertIn('    Port  9000\n', config)
+        self.assertIn('    URI   /bulk/?token=test_token&type=logzio-docker-logs\n', config)
+        self.assertNotIn('tls', config)
+        self.assertNotIn('compress', config)
+        self.assertEqual(2, config.count('    Retry_Limit no_limits\n'))
+        self.assertIn('    Alias output_id-1\n', config)
+
+    def test_invalid_output_engine_settings(self):
+        invalid_settings = [
+            ({'OUTPUT_ENGINE': 'go'}, 'OUTPUT_ENGINE must be one of'),
+            ({'OUTPUT_COMPRESS': 'zstd'}, 'OUTPUT_COMPRESS must be one of'),
+            ({'OUTPUT_RETRY_LIMIT': '0'}, 'OUTPUT_RETRY_LIMIT must be a positive number or no_limits'),
+            ({'OUTPUT_ENGINE': 'native', 'LOGZIO_URL': 'listener.logz.io:8071'}, 'LOGZIO_URL must be an http'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+    @unittest.skipUnless(fluent_bit_runner.fluent_bit_available(), 'Fluent Bit binary not available')
+    def test_native_engine_ships_to_listener(self):
+        with tempfile.TemporaryDirectory() as temp_dir, LogzioListener() as listener:
+            containers_dir = os.path.join(temp_dir, 'containers')
+            write_container(containers_dir, 'abc123', 'web', 'nginx', [f'line {i}' for i in range(10)])
+            env = {
+                'LOGZIO_LOGS_TOKEN': 'test_token',
+                'LOGZIO_URL': listener.url,
+                'OUTPUT_ENGINE': 'native',
+                'DOCKER_CONTAINERS_DIR': containers_dir,
+                'LOGS_PATH': f'{containers_dir}/*/*.log',
+                'READ_FROM_HEAD': 'true',
+            }
+            config_text = fluent_bit_runner.render_config(env)
+            with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(temp_dir, 'run'), env):
+                self.assertTrue(fluent_bit_runner.wait_for(lambda: listener.record_count() >= 10))
+            with listener.lock:
+                request = listener.requests[0]
+                record = listener.records[0][1]
+        self.assertEqual('/?token=test_token&type=logzio-docker-logs', request['path'])
+        self.assertEqual('line 0', record['message'].rstrip('\n'))
+        self.assertEqual('web', record['docker_container_name'])
+        self.assertIn('@timestamp', record)
+
+
+class TestScalingMode(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.containers_dir = os.path.join(self.temp_dir.name, 'containers')
+        self.env = {'DOCKER_CONTAINERS_DIR': self.containers_dir, 'LOGS_PATH': f'{self.containers_dir}/*/*.log',
+                    'SCALING_MODE': 'auto'}
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _create_config(self, max_watches=524288, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **self.env, **env}), \
+                patch.object(create_fluent_bit_config, '_read_inotify_max_watches', return_value=max_watches):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def _tail_paths(self, config):
+        return [line.split(None, 1)[1] for line in config.splitlines() if line.strip().startswith('Path ')]
+
+    def test_small_hosts_keep_one_input_and_the_profile(self):
+        write_workload(self.containers_dir, containers=20)
+        config = self._create_config()
+        self.assertEqual([f'{self.containers_dir}/*/*.log'], self._tail_paths(config))
+        self.assertIn('    Refresh_Interval 60\n', config)
+        self.assertNotIn('Inotify_Watcher', config)
+
+    def test_scaling_is_off_by_default(self):
+        write_workload(self.containers_dir, containers=240)
+        config = self._create_config(SCALING_MODE='off')
+        self.assertEqual(1, config.count('[INPUT]'))
+        self.assertIn('    Refresh_Interval 60\n', config)
+
+    def test_large_hosts_split_the_glob_by_container_id(self):
+        ids = write_workload(self.containers_dir, containers=240)
+        config = self._create_config(PERFORMANCE_PROFILE='low-latency', SCALING_FILES_PER_INPUT='60')
+        paths = self._tail_paths(config)
+        self.assertEqual(4, len(paths))
+        self.assertEqual(f'{self.containers_dir}/[0123]*/*.log', paths[0])
+        # Every log file is tailed by exactly one input
+        tailed = [file for path in paths for file in glob.glob(path)]
+        self.assertEqual(len(ids), len(tailed))
+        self.assertEqual(len(ids), len(set(tailed)))
+        # The low-latency profile rescans every 5 seconds; 240 files raise it to 10
+        self.assertEqual(4, config.count('    Refresh_Interval 10\n'))
+
+    def test_tiers_by_number_of_files(self):
+        with patch.object(create_fluent_bit_config, 'count_log_files', return_value=6000):
+            config = self._create_config(PERFORMANCE_PROFILE='high-throughput')
+        self.assertEqual(6, config.count('[INPUT]'))
+        self.assertEqual(6, config.count('    Refresh_Interval 60\n'))
+        # high-throughput keeps rotated files open for 15 seconds
+        self.assertEqual(6, config.count('    Rotate_Wait 5\n'))
+
+    def test_environment_settings_are_kept(self):
+        write_workload(self.containers_dir, containers=240)
+        config = self._create_config(REFRESH_INTERVAL='7', ROTATE_WAIT='20')
+        self.assertIn('    Refresh_Interval 7\n', config)
+        self.assertIn('    Rotate_Wait 20\n', config)
+
+    def test_stat_watcher_when_inotify_watches_run_short(self):
+        write_workload(self.containers_dir, containers=300)
+        self.assertIn('    Inotify_Watcher false\n', self._create_config(max_watches=512))
+        self.assertNotIn('Inotify_Watcher', self._create_config(max_watches=8192))
+
+    def test_warns_about_the_open_file_limit(self):
+        write_workload(self.containers_dir, containers=300)
+        with patch('resource.getrlimit', return_value=(256, 4096)):
+            self._create_config()
+        self.mock_print.assert_any_call("Warning: Found 300 log files but the open file limit is 256. "
+                                        "Raise it, for example with docker run --ulimit nofile=856.")
+
+    def test_other_paths_are_not_split(self):
+        write_workload(self.containers_dir, containers=240)
+        config = self._create_config(LOGS_PATH=f'{self.containers_dir}/*/*-json.log,/var/log/app/*.log',
+                                     SCALING_FILES_PER_INPUT='100')
+        self.assertEqual(1, config.count('[INPUT]'))
+
+    def test_per_container_inputs_are_kept(self):
+        ids = write_workload(self.containers_dir, containers=240)
+        config = self._create_config(SCALING_FILES_PER_INPUT='120', JSON_DECODE_MODE='selective',
+                                     JSON_DECODE_CONTAINERS='^synthetic-7$')
+        paths = self._tail_paths(config)
+        self.assertEqual(3, len(paths))
+        self.assertEqual(f'{self.containers_dir}/{ids[7]}/*.log', paths[0])
+        self.assertEqual(2, config.count(f'Exclude_Path {paths[0]}'))
+
+    def test_invalid_scaling_settings(self):
+        invalid_settings = [
+            ({'SCALING_MODE': 'on'}, 'SCALING_MODE must be one of'),
+            ({'SCALING_FILES_PER_INPUT': '0'}, 'SCALING_FILES_PER_INPUT must be a positive number'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+
+class TestProcessShards(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.containers_dir = os.path.join(self.temp_dir.name, 'containers')
+        self.env = {'LOGZIO_LOGS_TOKEN': 'test_token', 'DOCKER_CONTAINERS_DIR': self.containers_dir,
+                    'LOGS_PATH': f'{self.containers_dir}/*/*.log', 'SHARDS': '4'}
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _shard_configs(self, **env):
+        with patch.dict(os.environ, {**self.env, **env}):
+            config_obj = create_fluent_bit_config.Config()
+            create_fluent_bit_config.create_fluent_bit_config(config_obj)
+            return [create_fluent_bit_config.create_fluent_bit_config(
+                create_fluent_bit_config.shard_config(config_obj, index)) for index in range(int(config_obj.shards))]
+
+    def _value(self, config, key):
+        return [line.split(None, 1)[1] for line in config.splitlines() if line.strip().startswith(key + ' ')]
+
+    def test_shards_tail_disjoint_containers(self):
+        ids = write_workload(self.containers_dir, containers=64)
+        configs = self._shard_configs()
+        paths = [self._value(config, 'Path')[0] for config in configs]
+        self.assertEqual(f'{self.containers_dir}/[0123]*/*.log', paths[0])
+        tailed = [file for path in paths for file in glob.glob(path)]
+        self.assertEqual(len(ids), len(tailed))
+        self.assertEqual(len(ids), len(set(tailed)))
+
+    def test_shards_have_their_own_state(self):
+        configs = self._shard_configs(TAIL_DB_PATH='/fluent-bit/db/tail.db', BUFFERING_MODE='filesystem',
+                                      STORAGE_PATH='/fluent-bit/storage', STORAGE_TOTAL_LIMIT_SIZE='1G',
+                                      METRICS_ENABLED='true', OUTPUT_SHARDS='2')
+        self.assertEqual(['/fluent-bit/db/tail-shard-1.db'], self._value(configs[1], 'DB'))
+        self.assertEqual(['/fluent-bit/storage/shard-1'], self._value(configs[1], 'storage.path'))
+        self.assertEqual(['2021'], self._value(configs[1], 'HTTP_Port'))
+        self.assertEqual(['output_id-shard-1-0', 'output_id-shard-1-1'], self._value(configs[1], 'id'))
+        self.assertEqual([str(1024 ** 3 // 8)] * 2, self._value(configs[1], 'storage.total_limit_size'))
+
+    def test_per_container_inputs_only_list_the_shard_containers(self):
+        ids = write_workload(self.containers_dir, containers=32)
+        configs = self._shard_configs(MULTILINE_RULES='[{"name": "all", "images": "synthetic", "start_state": "^x"}]')
+        for index, config in enumerate(configs):
+            listed = self._value(config, 'Path')[0].split(',')
+            digits = create_fluent_bit_config.split_container_id_prefixes(4)[index]
+            self.assertEqual(sorted(f'{self.containers_dir}/{container_id}/*.log'
+                                    for container_id in ids if container_id[0] in digits), sorted(listed))
+
+    def test_shards_write_their_own_metrics_files(self):
+        with patch.dict(os.environ, {**self.env, 'DOCKER_METADATA_METRICS_FILE': '/metrics/docker-metadata.prom',
+                                     'RATE_LIMIT_METRICS_FILE': '/metrics/rate-limits.prom'}):
+            config_obj = create_fluent_bit_config.Config()
+        self.assertEqual({'DOCKER_METADATA_METRICS_FILE': '/metrics/docker-metadata-shard-2.prom',
+                          'RATE_LIMIT_METRICS_FILE': '/metrics/rate-limits-shard-2.prom'},
+                         create_fluent_bit_config.get_lua_env(create_fluent_bit_config.shard_config(config_obj, 2)))
+        with patch.dict(os.environ, self.env):
+            config_obj = create_fluent_bit_config.Config()
+        self.assertEqual({'DOCKER_METADATA_METRICS_FILE': '', 'RATE_LIMIT_METRICS_FILE': ''},
+                         create_fluent_bit_config.get_lua_env(create_fluent_bit_config.shard_config(config_obj, 2)))
+
+    def test_shard_config_paths(self):
+        self.assertEqual('/fluent-bit/etc/fluent-bit-shard-3.conf', create_fluent_bit_config.shard_config_path(3))
+
+    def test_invalid_shard_settings(self):
+        invalid_settings = [
+            ({'SHARDS': '0'}, 'SHARDS must be a number between 1 and 16'),
+            ({'SHARDS': '17'}, 'SHARDS must be a number between 1 and 16'),
+            ({'LOGS_PATH': '/var/log/*.log'}, 'SHARDS requires LOGS_PATH to be a single path'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    with patch.dict(os.environ, {**self.env, **env}):
+                        create_fluent_bit_config.create_fluent_bit_config(create_fluent_bit_config.Config())
+                self.assertIn(message, str(context.exception))
+
+
+class TestLogDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_no_dedup_by_default(self):
+        self.assertNotIn('deduplicate_records', self._create_config())
+
+    def test_dedup_runs_after_the_rename(self):
+        config = self._create_config(LOG_DEDUP='true', RATE_LIMIT='100:500:drop')
+        filters = config.split('[FILTER]')[1:]
+        self.assertIn('    Name modify\n', filters[-2])
+        self.assertIn('    Rename log message\n', filters[-2])
+        self.assertIn('    Name lua\n    Match docker.*\n', filters[-1])
+        self.assertIn('    call deduplicate_records\n', filters[-1])
+
+    def test_invalid_dedup_settings(self):
+        invalid_settings = [
+            ({'LOG_DEDUP': 'yes'}, 'LOG_DEDUP must be true or false'),
+            ({'LOG_DEDUP': 'true', 'LOG_DEDUP_WINDOW_SEC': '0'}, 'LOG_DEDUP_WINDOW_SEC must be a positive number'),
+            ({'LOG_DEDUP': 'true', 'LOG_DEDUP_MAX_CONTAINERS': 'many'},
+             'LOG_DEDUP_MAX_CONTAINERS must be a positive number'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+
+class TestFieldProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_no_projection_by_default(self):
+        config = self._create_config()
+        self.assertNotIn('Remove', config)
+
+    def test_projection_runs_after_dedup(self):
+        config = self._create_config(LOG_DEDUP='true', FIELD_PROJECTION='drop:time,stream')
+        filters = config.split('[FILTER]')[1:]
+        self.assertIn('    call deduplicate_records\n', filters[-2])
+        self.assertIn('    Name modify\n    Match *\n    Remove time\n    Remove stream\n', filters[-1])
+
+    def test_invalid_projections(self):
+        invalid_settings = [
+            ('hide:time', 'FIELD_PROJECTION entries must be'),
+            ('drop:', 'FIELD_PROJECTION entries must be'),
+            ('rename:stream', 'FIELD_PROJECTION renames must be'),
+            ('rename:stream=', 'FIELD_PROJECTION renames must be'),
+            ('keep:message,log stream', 'FIELD_PROJECTION field names cannot contain spaces'),
+        ]
+        for projection, message in invalid_settings:
+            with self.subTest(projection=projection):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(FIELD_PROJECTION=projection)
+                self.assertIn(message, str(context.exception))
+
+
+class TestPriorityRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_no_priority_routing_by_default(self):
+        config = self._create_config()
+        self.assertNotIn('rewrite_tag', config)
+        self.assertNotIn('priority', config)
+
+    def test_priority_rules_retag_last(self):
+        config = self._create_config(PRIORITY_PATTERNS='ERROR, FATAL', PRIORITY_CONTAINERS='^payments$',
+                                     FIELD_PROJECTION='drop:stream')
+        filters = config.split('[FILTER]')[1:]
+        self.assertIn('    Remove stream\n', filters[-2])
+        self.assertIn('    Name rewrite_tag\n    Match docker.*\n'
+                      '    Rule $message (?:ERROR)|(?:FATAL) priority.$TAG false\n'
+                      '    Rule $docker_container_name ^payments$ priority.$TAG false\n'
+                      '    Emitter_Name priority_emitter\n'
+                      '    Emitter_Mem_Buf_Limit 10M\n', filters[-1])
+
+    def test_retagged_records_skip_the_other_filters(self):
+        config = self._create_config(PRIORITY_CONTAINERS='payments', EXCLUDE_LINES='DEBUG', SKIP_CONTAINER_NAMES='db')
+        for section in config.split('[FILTER]')[1:]:
+            self.assertIn('    Match docker.*\n', section)
+
+    def test_priority_output(self):
+        config = self._create_config(PRIORITY_PATTERNS='ERROR', OUTPUT_ID='shipper', OUTPUT_RETRY_LIMIT='no_limits',
+                                     OUTPUT_WORKERS='4')
+        outputs = config.split('[OUTPUT]')[1:]
+        self.assertEqual(2, len(outputs))
+        self.assertIn('    Match_Regex ^docker\\.\n', outputs[0])
+        self.assertIn('    Retry_Limit no_limits\n    Workers 4\n', outputs[0])
+        self.assertIn('    Match priority.*\n', outputs[1])
+        self.assertIn('    id shipper-priority\n', outputs[1])
+        self.assertIn('    Retry_Limit 2\n', outputs[1])
+        self.assertNotIn('Workers', outputs[1])
+
+    def test_native_priority_output(self):
+        config = self._create_config(PRIORITY_PATTERNS='ERROR', OUTPUT_ENGINE='native', PRIORITY_RETRY_LIMIT='5')
+        priority_output = config.split('[OUTPUT]')[-1]
+        self.assertIn('    Name  http\n    Match priority.*\n    Alias output_id-priority\n', priority_output)
+        self.assertIn('    Retry_Limit 5\n', priority_output)
+
+    def test_each_tag_is_shipped_by_exactly_one_output(self):
+        tags = [f'docker.var.lib.docker.containers.{a}99.{a}99-json.log' for a in '0123456789abcdef']
+        tags += ['docker.var.log.app.log']
+        tags += ['priority.' + tag for tag in tags]
+        for shards in (1, 2, 5, 16):
+            with self.subTest(shards=shards):
+                config = self._create_config(PRIORITY_PATTERNS='ERROR', OUTPUT_SHARDS=str(shards))
+                outputs = config.split('[OUTPUT]')[1:]
+                matches = [line.strip().split(' ', 1) for output in outputs for line in output.splitlines()
+                           if line.startswith('    Match')]
+                self.assertEqual(shards + 1, len(matches))
+                for tag in tags:
+                    matched = [value for key, value in matches
+                               if (re.search(value, tag) if key == 'Match_Regex' else fnmatch.fnmatchcase(tag, value))]
+                    self.assertEqual(1, len(matched), tag)
+                    self.assertEqual(tag.startswith('priority.'), matched[0] == 'priority.*', tag)
+
+    def test_filesystem_buffering(self):
+        config = self._create_config(PRIORITY_PATTERNS='ERROR', BUFFERING_MODE='filesystem',
+                                     STORAGE_TOTAL_LIMIT_SIZE='1G', PRIORITY_MEM_BUF_LIMIT='2M')
+        self.assertIn('    Emitter_Mem_Buf_Limit 2M\n    Emitter_Storage.type filesystem\n', config)
+        self.assertEqual(2, config.count(f'    storage.total_limit_size {1024 ** 3 // 2}\n'))
+
+    def test_invalid_priority_settings(self):
+        invalid_settings = [
+            ({'PRIORITY_PATTERNS': 'connection refused'}, 'PRIORITY_PATTERNS cannot contain spaces'),
+            ({'PRIORITY_CONTAINERS': 'web api'}, 'PRIORITY_CONTAINERS cannot contain spaces'),
+            ({'PRIORITY_PATTERNS': 'ERROR', 'PRIORITY_RETRY_LIMIT': '0'},
+             'PRIORITY_RETRY_LIMIT must be a positive number or no_limits'),
+            ({'PRIORITY_PATTERNS': 'ERROR', 'PRIORITY_MEM_BUF_LIMIT': 'lots'},
+             'PRIORITY_MEM_BUF_LIMIT must be a size'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+
+class TestBackfillMode(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.containers_dir = os.path.join(self.temp_dir.name, 'containers')
+        write_container(self.containers_dir, 'abc123', 'web', 'nginx', ['history'])
+        self.env = {'DOCKER_CONTAINERS_DIR': self.containers_dir, 'LOGS_PATH': f'{self.containers_dir}/*/*.log',
+                    'TAIL_DB_PATH': os.path.join(self.temp_dir.name, 'db', 'tail.db'),
+                    'BACKFILL_SNAPSHOT_FILE': os.path.join(self.temp_dir.name, 'db', 'backfill.snapshot'),
+                    'BACKFILL_MODE': 'on'}
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **self.env, **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_backfill_is_off_by_default(self):
+        config = self._create_config(BACKFILL_MODE='off')
+        self.assertEqual(1, config.count('[INPUT]'))
+        self.assertNotIn('backfill', config)
+
+    def test_backfill_db_is_never_a_relative_path(self):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', 'BACKFILL_MODE': 'off'}):
+            os.environ.pop('TAIL_DB_PATH', None)
+            config_obj = create_fluent_bit_config.Config()
+        self.assertEqual('', create_fluent_bit_config.get_tail_db_path(config_obj))
+        self.assertEqual('/fluent-bit/db/tail-backfill.db', create_fluent_bit_config.get_backfill_db_path(config_obj))
+
+    def test_backfill_input_is_capped(self):
+        config = self._create_config(BACKFILL_RATE='2M', FLUSH_INTERVAL='3', BUFFERING_MODE='filesystem',
+                                     STORAGE_PATH=os.path.join(self.temp_dir.name, 'storage'))
+        live_input, backfill_input = config.split('[INPUT]')[1:]
+        self.assertIn('    Tag          docker.*\n    read_from_head true\n', live_input)
+        self.assertIn('    storage.type filesystem\n', live_input)
+        self.assertIn(f"    DB           {self.env['TAIL_DB_PATH']}\n", live_input)
+        self.assertIn('    Tag          docker.backfill.*\n    read_from_head true\n'
+                      '    Path_Key     backfill_path\n    Offset_Key   backfill_offset\n', backfill_input)
+        self.assertIn(f"    DB           {self.temp_dir.name}/db/tail-backfill.db\n", backfill_input)
+        self.assertIn(f'    Mem_Buf_Limit {2 * 1024 ** 2 * 3}\n', backfill_input)
+        self.assertNotIn('storage.type', backfill_input)
+
+    def test_backfill_records_have_their_own_route(self):
+        config = self._create_config(PRIORITY_PATTERNS='ERROR', OUTPUT_SHARDS='2')
+        filters = config.split('[FILTER]')[1:]
+        self.assertIn('    Name lua\n    Match docker.backfill.*\n', filters[0])
+        self.assertIn('    call backfill_cutoff\n', filters[0])
+        self.assertIn('    Name rewrite_tag\n    Match_Regex ^docker\\.(?!backfill\\.)\n', filters[-1])
+
+        outputs = [line.strip().split(' ', 1) for output in config.split('[OUTPUT]')[1:]
+                   for line in output.splitlines() if line.startswith('    Match')]
+        self.assertEqual(['Match', 'docker.backfill.*'], outputs[-1])
+        # Two live output shards, then the priority and backfill outputs
+        for tag, expected in [('docker.var.lib.docker.containers.abc.abc-json.log', [1]),
+                              ('docker.var.lib.docker.containers.123.123-json.log', [0]),
+                              ('priority.docker.var.lib.docker.containers.abc.abc-json.log', [2]),
+                              ('docker.backfill.var.lib.docker.containers.abc.abc-json.log', [3])]:
+            matched = [index for index, (key, value) in enumerate(outputs)
+                       if (re.search(value, tag) if key == 'Match_Regex' else fnmatch.fnmatchcase(tag, value))]
+            self.assertEqual(expected, matched, tag)
+
+    def test_invalid_backfill_settings(self):
+        invalid_settings = [
+            ({'BACKFILL_MODE': 'yes'}, 'BACKFILL_MODE must be one of: off, on'),
+            ({'BACKFILL_RATE': 'fast'}, 'BACKFILL_RATE must be a size per second'),
+            ({'BACKFILL_IGNORE_OLDER': 'a week'}, 'BACKFILL_IGNORE_OLDER must be a duration'),
+            ({'BACKFILL_SNAPSHOT_FILE': 'backfill.snapshot'}, 'BACKFILL_SNAPSHOT_FILE must be an absolute path'),
+            ({'SHARDS': '2'}, 'BACKFILL_MODE cannot be used with SHARDS'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+
+class TestPartialLines(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def test_no_reassembly_by_default(self):
+        config = self._create_config()
+        self.assertNotIn('reassemble_partial_lines', config)
+        self.assertIn('    Buffer_Max_Size 32k\n', config)
+
+    def test_reassembly_runs_before_the_message_filters(self):
+        config = self._create_config(REASSEMBLE_PARTIAL_LINES='true', EXCLUDE_LINES='DEBUG')
+        filters = config.split('[FILTER]')[1:]
+        self.assertIn('    Name lua\n    Match *\n', filters[0])
+        self.assertIn('    call reassemble_partial_lines\n', filters[0])
+        self.assertIn('    Exclude log DEBUG\n', filters[2])
+
+    def test_heartbeat_ships_timed_out_partial_lines_under_their_own_tag(self):
+        config = self._create_config(REASSEMBLE_PARTIAL_LINES='true')
+        heartbeat = f'    Name  dummy\n    Tag   {create_fluent_bit_config.PARTIAL_LINE_HEARTBEAT_TAG}\n'
+        self.assertIn(heartbeat, config)
+        self.assertIn('    Rate  1\n', config)
+        retag = config.split('[FILTER]')[2]
+        self.assertIn(f'    Name rewrite_tag\n    Match {create_fluent_bit_config.PARTIAL_LINE_HEARTBEAT_TAG}\n',
+                      retag)
+        self.assertIn('    Rule $partial_tag ^(.+)$ $1 false\n', retag)
+        self.assertNotIn('Name  dummy', self._create_config())
+
+    def test_tail_buffer_holds_a_whole_fragment(self):
+        self.assertIn('    Buffer_Max_Size 64k\n', self._create_config(REASSEMBLE_PARTIAL_LINES='true'))
+        self.assertIn('    Buffer_Max_Size 1M\n', self._create_config(REASSEMBLE_PARTIAL_LINES='true',
+                                                                        PERFORMANCE_PROFILE='high-throughput'))
+
+    def test_partial_lines_fragments(self):
+        message = 'x' * 40000
+        lines = [json.loads(line) for line in synthetic_logs.docker_partial_lines(message).splitlines()]
+        self.assertEqual([16384, 16384, 7233], [len(line['log']) for line in lines])
+        self.assertEqual(message + '\n', ''.join(line['log'] for line in lines))
+
+    def test_invalid_partial_lines_settings(self):
+        invalid_settings = [
+            ({'REASSEMBLE_PARTIAL_LINES': 'yes'}, 'REASSEMBLE_PARTIAL_LINES must be true or false'),
+            ({'REASSEMBLE_PARTIAL_LINES': 'true', 'MAX_EVENT_SIZE': 'big'}, 'MAX_EVENT_SIZE must be a size'),
+            ({'REASSEMBLE_PARTIAL_LINES': 'true', 'MAX_EVENT_SIZE': '0'}, 'MAX_EVENT_SIZE must be a size'),
+            ({'REASSEMBLE_PARTIAL_LINES': 'true', 'PARTIAL_LINE_TIMEOUT_SEC': '0'},
+             'PARTIAL_LINE_TIMEOUT_SEC must be a positive number'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+    @unittest.skipUnless(fluent_bit_runner.fluent_bit_available(), 'Fluent Bit binary not available')
+    def test_fluent_bit_ships_reassembled_and_truncated_lines(self):
+        containers_dir = os.path.join(self.temp_dir.name, 'containers')
+        output_path = os.path.join(self.temp_dir.name, 'output', 'records.log')
+        os.makedirs(os.path.dirname(output_path))
+        payload = json.dumps({'items': ['x' * 100] * 400})
+        write_container(containers_dir, 'a' * 12, 'app', 'app:latest')
+        with open(synthetic_logs.container_log_path(containers_dir, 'a' * 12), 'w') as file:
+            file.write(synthetic_logs.docker_log_line('before'))
+            file.write(synthetic_logs.docker_partial_lines(payload))
+            file.write(synthetic_logs.docker_partial_lines('y' * 100000, stream='stderr'))
+            file.write(synthetic_logs.docker_log_line('after'))
+        env = {'LOGZIO_LOGS_TOKEN': 'test_token', 'LOGS_PATH': f'{containers_dir}/*/*.log',
+               'DOCKER_CONTAINERS_DIR': containers_dir, 'READ_FROM_HEAD': 'true',
+               'REASSEMBLE_PARTIAL_LINES': 'true', 'MAX_EVENT_SIZE': '64k'}
+        config_text = fluent_bit_runner.render_config(env, fluent_bit_runner.file_output_config(output_path))
+
+        with fluent_bit_runner.FluentBitProcess(config_text, os.path.join(self.temp_dir.name, 'run'), env):
+            self.assertTrue(fluent_bit_runner.wait_for(
+                lambda: len(fluent_bit_runner.read_json_lines(output_path)) >= 4, timeout=30))
+
+        records = fluent_bit_runner.read_json_lines(output_path)
+        self.assertEqual(['before\n', payload + '\n', 'y' * 65536, 'after\n'],
+                         [record['message'] for record in records])
+        self.assertEqual([False, False, True, False], [record.get('truncated', False) for record in records])
+
+
+class TestRegexCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+        create_fluent_bit_config._regex_cost_cache.clear()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def _printed(self):
+        return [call[0][0] for call in self.mock_print.call_args_list]
+
+    def test_filter_patterns_are_collected_as_fluent_bit_runs_them(self):
+        env = {'LOGZIO_LOGS_TOKEN': 'test_token', 'EXCLUDE_LINES': 'DEBUG,TRACE', 'MATCH_IMAGE_NAME': '^nginx',
+               'PRIORITY_CONTAINERS': '^payments$', 'MULTILINE_START_STATE_RULE': r'^\d{4}',
+               'MULTILINE_CUSTOM_RULES': r'/^\s+at/; ^Caused'}
+        with patch.dict(os.environ, env):
+            filters = create_fluent_bit_config.get_filter_patterns(create_fluent_bit_config.Config())
+        self.assertEqual([
+            [('EXCLUDE_LINES', '(?:DEBUG)|(?:TRACE)')],
+            [('MATCH_IMAGE_NAME', '^nginx')],
+            [('PRIORITY_CONTAINERS', '^payments$')],
+            [('MULTILINE_START_STATE_RULE', r'^\d{4}'), ('MULTILINE_CUSTOM_RULES', r'^\s+at'),
+             ('MULTILINE_CUSTOM_RULES', '^Caused')],
+        ], [patterns for _, patterns in filters])
+        self.assertEqual('multiline parser multiline-regex', filters[-1][0])
+
+    def test_multiline_rule_patterns_are_collected(self):
+        rules = json.dumps([{'name': 'java', 'images': '^openjdk', 'start_state': r'^\d{4}-', 'cont': [r'^\s+at ']}])
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', 'MULTILINE_RULES': rules}):
+            filters = create_fluent_bit_config.get_filter_patterns(create_fluent_bit_config.Config())
+        self.assertEqual([('multiline parser multiline-java', [("MULTILINE_RULES rule 'java'", r'^\d{4}-'),
+                                                               ("MULTILINE_RULES rule 'java'", r'^\s+at ')])], filters)
+
+    def test_cost_is_reported_for_every_filter(self):
+        self._create_config(INCLUDE_LINE='ERROR', SKIP_CONTAINER_NAMES='db', MULTILINE_START_STATE_RULE=r'^\d{4}')
+        reports = [line for line in self._printed() if line.startswith('Regex cost')]
+        self.assertEqual(3, len(reports))
+        self.assertRegex(reports[0], r'^Regex cost of the grep filter to keep lines matching INCLUDE_LINE, '
+                                     r'before enrichment: about \d+\.\d ms per 10000 lines$')
+        self.assertIn('multiline parser multiline-regex', reports[2])
+
+    def test_patterns_are_analyzed_once(self):
+        with patch('regex_cost.analyze_patterns', wraps=create_fluent_bit_config.regex_cost.analyze_patterns) as analyze:
+            self._create_config(EXCLUDE_LINES='DEBUG')
+            self._create_config(EXCLUDE_LINES='DEBUG')
+            self._create_config(EXCLUDE_LINES='DEBUG', PRIORITY_PATTERNS='DEBUG')
+        self.assertEqual(1, analyze.call_count)
+        self.assertEqual(1, len([line for line in self._printed() if line.startswith('Regex cost')]))
+
+    def test_exponential_pattern_is_rejected(self):
+        with self.assertRaises(ValueError) as context:
+            # A small budget, so the timing gives up quickly
+            self._create_config(INCLUDE_LINE=r'^(\w+\s?)+$', REGEX_LINE_BUDGET_MS='1')
+        self.assertIn("INCLUDE_LINE pattern '^(\\w+\\s?)+$'", str(context.exception))
+        self.assertIn('REGEX_LINE_BUDGET_MS', str(context.exception))
+        self.assertTrue(any(line.startswith("Warning: INCLUDE_LINE pattern '^(\\w+\\s?)+$' nests a repeat")
+                            for line in self._printed()))
+
+    def test_flagged_pattern_within_the_budget_is_accepted(self):
+        # Stack trace continuation lines: a nested repeat that stays cheap on every line
+        config = self._create_config(INCLUDE_LINE=r'^(\s+at\s.*)+$')
+        self.assertIn('    Regex log ^(\\s+at\\s.*)+$\n', config)
+        self.assertTrue(any(line.startswith("Warning: INCLUDE_LINE pattern '^(\\s+at\\s.*)+$'")
+                            for line in self._printed()))
+
+    def test_pattern_over_the_line_budget_is_rejected(self):
+        with self.assertRaises(ValueError) as context:
+            self._create_config(EXCLUDE_LINES=r'^(a|aa)+$')
+        self.assertIn('over the 50 ms REGEX_LINE_BUDGET_MS', str(context.exception))
+
+    def test_warn_mode_keeps_the_pattern(self):
+        config = self._create_config(MATCH_CONTAINER_NAME=r'^(a+)+$', REGEX_CHECK='warn', REGEX_LINE_BUDGET_MS='5')
+        self.assertIn('    Regex docker_container_name ^(a+)+$\n', config)
+        printed = self._printed()
+        self.assertTrue(any(line.startswith("Warning: MATCH_CONTAINER_NAME pattern '^(a+)+$' nests a repeat")
+                            for line in printed))
+        self.assertTrue(any('over the 5 ms REGEX_LINE_BUDGET_MS' in line for line in printed))
+        self.assertIn('Regex cost of the grep filter to apply container and image selectors: unknown per 10000 lines',
+                      printed)
+
+    def test_polynomial_pattern_is_a_warning(self):
+        config = self._create_config(INCLUDE_LINE=r'\w+\w+$')
+        self.assertIn('    Regex log \\w+\\w+$\n', config)
+        self.assertTrue(any('backtracks polynomially' in line for line in self._printed()))
+
+    def test_patterns_python_cannot_parse_are_skipped(self):
+        config = self._create_config(INCLUDE_LINE='(?<level>ERROR)')
+        self.assertIn('    Regex log (?<level>ERROR)\n', config)
+        self.assertTrue(any(line.startswith("Warning: Could not analyze the INCLUDE_LINE pattern '(?<level>ERROR)'")
+                            for line in self._printed()))
+
+    def test_off_mode_skips_the_check(self):
+        with patch('regex_cost.analyze_patterns') as analyze:
+            config = self._create_config(INCLUDE_LINE=r'(a+)+$', REGEX_CHECK='off')
+        analyze.assert_not_called()
+        self.assertIn('    Regex log (a+)+$\n', config)
+
+    def test_invalid_regex_check_settings(self):
+        for env, message in [({'REGEX_CHECK': 'loud'}, 'REGEX_CHECK must be one of: strict, warn, off'),
+                             ({'REGEX_LINE_BUDGET_MS': '0'}, 'REGEX_LINE_BUDGET_MS must be a positive number')]:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestRoles(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _create_config(self, **env):
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            config_obj = create_fluent_bit_config.Config()
+            return create_fluent_bit_config.create_fluent_bit_config(config_obj)
+
+    def _output_sections(self, config):
+        return config.split('[OUTPUT]')[1:]
+
+    def test_standalone_by_default(self):
+        config = self._create_config()
+        self.assertIn('    Name         tail\n', config)
+        self.assertNotIn('forward', config)
+        self.assertIn('    Name  logzio\n', config)
+
+    def test_agent_forwards_to_the_aggregator(self):
+        config = self._create_config(ROLE='agent', AGGREGATOR_HOSTS='aggregator', PRIORITY_CONTAINERS='^payments$')
+        self.assertIn('    Name         tail\n', config)
+        self.assertIn('[FILTER]', config)
+        self.assertNotIn('logzio', config.split('[OUTPUT]', 1)[1])
+        outputs = self._output_sections(config)
+        self.assertEqual(2, len(outputs))
+        self.assertIn('    Match_Regex ^docker\\.\n', outputs[0])
+        self.assertIn('    Host  aggregator\n    Port  24224\n', outputs[0])
+        self.assertIn('    Tag   forward.live\n', outputs[0])
+        self.assertIn('    Require_ack_response true\n', outputs[0])
+        self.assertIn('    Alias output_id-priority\n', outputs[1])
+        self.assertIn('    Tag   forward.priority\n', outputs[1])
+
+    def test_agent_load_balances_over_several_aggregators(self):
+        env = {'ROLE': 'agent', 'AGGREGATOR_HOSTS': 'aggregator-a:24000, aggregator-b'}
+        config = self._create_config(**env)
+        self.assertIn(f'    Upstream {create_fluent_bit_config.UPSTREAM_CONF_PATH}\n', config)
+        self.assertNotIn('    Host ', config)
+        with patch.dict(os.environ, {'LOGZIO_LOGS_TOKEN': 'test_token', **env}):
+            upstream_config = create_fluent_bit_config.create_upstream_config(create_fluent_bit_config.Config())
+        self.assertIn('[UPSTREAM]\n    name aggregators\n', upstream_config)
+        self.assertIn('    host aggregator-a\n    port 24000\n', upstream_config)
+        self.assertIn('    host aggregator-b\n    port 24224\n', upstream_config)
+
+    def test_only_standalone_and_aggregator_need_the_plugin(self):
+        for env, expected in [({}, True), ({'OUTPUT_ENGINE': 'native'}, False),
+                              ({'ROLE': 'agent', 'AGGREGATOR_HOSTS': 'aggregator'}, False),
+                              ({'ROLE': 'aggregator'}, True)]:
+            with self.subTest(env=env):
+                with patch.dict(os.environ, env):
+                    config_obj = create_fluent_bit_config.Config()
+                self.assertEqual(expected, create_fluent_bit_config.uses_logzio_plugin(config_obj))
+
+    def test_aggregator_receives_forwarded_records(self):
+        config = self._create_config(ROLE='aggregator', FORWARD_PORT='24300', STORAGE_TOTAL_LIMIT_SIZE='3G')
+        self.assertIn('    Name   forward\n    Listen 0.0.0.0\n    Port   24300\n', config)
+        self.assertIn('    storage.type filesystem\n', config)
+        self.assertNotIn('tail', config)
+        self.assertNotIn('[FILTER]', config)
+        # Large batches over several connections, in case the profile is not set
+        self.assertIn('    Flush        5\n', config)
+        outputs = self._output_sections(config)
+        self.assertEqual(3, len(outputs))
+        self.assertIn('    Workers 2\n', outputs[0])
+        self.assertIn('    Match forward.priority\n', outputs[1])
+        self.assertIn('    Match forward.backfill\n', outputs[2])
+        self.assertIn('    Retry_Limit no_limits\n', outputs[2])
+        self.assertEqual(3, config.count(f'    storage.total_limit_size {1024 ** 3}\n'))
+
+    def test_each_forwarded_record_is_shipped_by_exactly_one_output(self):
+        config = self._create_config(ROLE='aggregator')
+        pattern = [line.strip().split(' ', 1)[1] for line in config.splitlines() if 'Match_Regex' in line][0]
+        for tag, live in [('forward.live', True), ('forward.priority', False), ('forward.backfill', False),
+                          ('forward.priority.other', True), ('app', True)]:
+            with self.subTest(tag=tag):
+                self.assertEqual(live, re.search(pattern, tag) is not None)
+
+    def test_forward_connections_use_the_shared_key_and_tls(self):
+        security = {'FORWARD_SHARED_KEY': 'secret', 'FORWARD_SELF_HOSTNAME': 'host-a', 'FORWARD_TLS': 'on'}
+        config = self._create_config(ROLE='aggregator', FORWARD_TLS_CRT_FILE='/certs/aggregator.crt',
+                                     FORWARD_TLS_KEY_FILE='/certs/aggregator.key', **security)
+        forward_input = config.split('[INPUT]')[1].split('[OUTPUT]')[0]
+        self.assertIn('    Shared_Key secret\n    Self_Hostname host-a\n', forward_input)
+        self.assertIn('    tls on\n    tls.crt_file /certs/aggregator.crt\n    tls.key_file /certs/aggregator.key\n',
+                      forward_input)
+        self.mock_print.assert_not_called()
+
+        config = self._create_config(ROLE='agent', AGGREGATOR_HOSTS='aggregator', FORWARD_TLS_CA_FILE='/certs/ca.crt',
+                                     PRIORITY_CONTAINERS='^payments$', **security)
+        for output in self._output_sections(config):
+            self.assertIn('    Shared_Key secret\n    Self_Hostname host-a\n', output)
+            self.assertIn('    tls on\n    tls.verify on\n    tls.ca_file /certs/ca.crt\n', output)
+
+    def test_upstream_nodes_use_the_shared_key_and_tls(self):
+        env = {'ROLE': 'agent', 'AGGREGATOR_HOSTS': 'aggregator-a,aggregator-b', 'FORWARD_SHARED_KEY': 'secret',
+               'FORWARD_SELF_HOSTNAME': 'host-a', 'FORWARD_TLS': 'on'}
+        with patch.dict(os.environ, env):
+            upstream_config = create_fluent_bit_config.create_upstream_config(create_fluent_bit_config.Config())
+        self.assertEqual(2, upstream_config.count('    Shared_Key secret\n    Self_Hostname host-a\n'))
+        self.assertEqual(2, upstream_config.count('    tls on\n    tls.verify on\n'))
+
+    def test_no_shared_key_or_tls_by_default(self):
+        config = self._create_config(ROLE='agent', AGGREGATOR_HOSTS='aggregator')
+        self.assertNotIn('Shared_Key', config)
+        self.assertNotIn('tls', config)
+
+    def test_warns_when_the_aggregator_listens_beyond_loopback_without_a_key(self):
+        self._create_config(ROLE='aggregator')
+        self.assertIn('Set FORWARD_SHARED_KEY', str(self.mock_print.call_args_list))
+        for listen in ['127.0.0.1', 'localhost', '::1']:
+            with self.subTest(listen=listen):
+                self.mock_print.reset_mock()
+                self._create_config(ROLE='aggregator', FORWARD_LISTEN=listen)
+                self.assertNotIn('FORWARD_SHARED_KEY', str(self.mock_print.call_args_list))
+
+    def test_aggregator_keeps_explicit_settings(self):
+        config = self._create_config(ROLE='aggregator', BUFFERING_MODE='memory', PERFORMANCE_PROFILE='low-latency')
+        self.assertNotIn('storage.type filesystem', config)
+        self.assertNotIn('    Flush        5\n', config)
+
+    def test_invalid_role_settings(self):
+        invalid_settings = [
+            ({'ROLE': 'relay'}, 'ROLE must be one of: standalone, agent, aggregator'),
+            ({'ROLE': 'agent'}, 'ROLE agent requires AGGREGATOR_HOSTS'),
+            ({'ROLE': 'agent', 'AGGREGATOR_HOSTS': 'a:port'}, 'AGGREGATOR_HOSTS must be host or host:port'),
+            ({'ROLE': 'agent', 'AGGREGATOR_HOSTS': ':24224'}, 'AGGREGATOR_HOSTS must be host or host:port'),
+            ({'FORWARD_PORT': '70000'}, 'FORWARD_PORT must be a port number'),
+            ({'ROLE': 'aggregator', 'OUTPUT_SHARDS': '2'}, 'use OUTPUT_WORKERS instead'),
+            ({'ROLE': 'aggregator', 'SHARDS': '2'}, 'ROLE aggregator cannot be used with SHARDS'),
+            ({'FORWARD_TLS': 'true'}, 'FORWARD_TLS must be one of: off, on'),
+            ({'ROLE': 'aggregator', 'FORWARD_TLS': 'on'}, 'requires FORWARD_TLS_CRT_FILE and FORWARD_TLS_KEY_FILE'),
+        ]
+        for env, message in invalid_settings:
+            with self.subTest(env=env):
+                with self.assertRaises(ValueError) as context:
+                    self._create_config(**env)
+                self.assertIn(message, str(context.exception))
+
+    @unittest.skipUnless(fluent_bit_runner.fluent_bit_available(), 'Fluent Bit binary not available')
+    def test_aggregator_ships_fewer_requests_than_direct_agents(self):
+        agents = 3
+        lines = 200
+        expected_records = agents * 4 * lines
+        for index in range(agents):
+            write_workload(os.path.join(self.temp_dir.name, f'host-{index}'), containers=4, backlog_lines=lines)
+
+        def agent_env(index, **env):
+            containers_dir = os.path.join(self.temp_dir.name, f'host-{index}')
+            return {'LOGZIO_LOGS_TOKEN': 'test_token', 'OUTPUT_ENGINE': 'native', 'READ_FROM_HEAD': 'true',
+                    'LOGS_PATH': f'{containers_dir}/*/*.log', 'DOCKER_CONTAINERS_DIR': containers_dir, **env}
+
+        def ship(name, envs):
+            # Runs a collector for each env until the listener received every record
+            with LogzioListener() as listener, contextlib.ExitStack() as processes:
+                for index, env in enumerate(envs):
+                    env = {'LOGZIO_URL': listener.url, **env}
+                    processes.enter_context(fluent_bit_runner.FluentBitProcess(
+                        fluent_bit_runner.render_config(env), os.path.join(self.temp_dir.name, name, str(index)), env))
+                self.assertTrue(fluent_bit_runner.wait_for(
+                    lambda: listener.record_count() >= expected_records, timeout=60), name)
+                time.sleep(2)
+                self.assertEqual(expected_records, listener.record_count(), name)
+                return listener.request_stats()
+
+        direct_requests, direct_bytes = ship('direct', [agent_env(index) for index in range(agents)])
+
+        port = free_port()
+        aggregator_env = {'LOGZIO_LOGS_TOKEN': 'test_token', 'OUTPUT_ENGINE': 'native', 'ROLE': 'aggregator',
+                          'FORWARD_LISTEN': '127.0.0.1', 'FORWARD_PORT': str(port),
+                          'STORAGE_PATH': os.path.join(self.temp_dir.name, 'storage')}
+        forwarded_envs = [aggregator_env] + [
+            agent_env(index, ROLE='agent', AGGREGATOR_HOSTS=f'127.0.0.1:{port}',
+                      TAIL_DB_PATH=os.path.join(self.temp_dir.name, f'agent-{index}.db')) for index in range(agents)]
+        forwarded_requests, forwarded_bytes = ship('forwarded', forwarded_envs)
+
+        # Records of every container and agent are batched together, and larger batches compress better
+        self.assertLess(forwarded_requests, direct_requests)
+        self.assertLessEqual(forwarded_bytes, direct_bytes)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,31 @@ package.path = "../?.lua;" .. package.path
 local docker_metadata = require("docker-metadata")  -- Adjust the path if necessary
 local busted = require("busted")
 
+-- Function to build a mock file handle that serves content through read(n)
+local function mock_file(content)
+    local position = 1
+    return {
+        read = function(_, size)
+            if position > #content then
+                return nil
+            end
+            local chunk = content:sub(position, position + size - 1)
+            position = position + size
+            return chunk
+        end,
+        seek = function(_, whence)
+            if whence == "end" then
+                position = #content + 1
+                return #content
+            end
+            position = 1
+            return 0
+        end,
+        lines = function() return content:gmatch("[^\r\n]+") end,
+        close = function() end
+    }
+end
+
 describe("Docker Metadata Enrichment", function()
 
     local original_getenv
@@ -24,7 +49,10 @@ describe("Docker Metadata Enrichment", function()
         end
 
         -- Clear cache before each test
-        docker_metadata.cache = {}
+        docker_metadata.reset_cache()
+
+        -- Add the source field so tests can tell where metadata came from
+        docker_metadata.DIAGNOSTIC_FIELDS = true
     end)
 
     after_each(function()
@@ -33,6 +61,16 @@ describe("Docker Metadata Enrichment", function()
 
         -- Restore the original os.getenv function after each test
         os.getenv = original_getenv
+
+        -- Restore the default metadata extractors and read limits
+        docker_metadata.configure_metadata_fields(nil, {}, {})
+        docker_metadata.CONFIG_READ_CHUNK_BYTES = 65536
+        docker_metadata.CONFIG_MAX_READ_BYTES = 8388608
+        docker_metadata.METRICS_FILE = ''
+        docker_metadata.RATE_LIMIT_METRICS_FILE = ''
+        docker_metadata.METADATA_INDEX_FILE = ''
+        docker_metadata.DIAGNOSTIC_FIELDS = false
+        docker_metadata.configure_rate_limits('', '')
     end)
 
     it("extracts container ID from log tag", function()
@@ -53,12 +91,7 @@ describe("Docker Metadata Enrichment", function()
             {"Name":"/my-container","Image":"my-image","StartedAt":"2021-10-15T12:34:56"}
         ]]
         -- Mock the io.open function to return our test data
-        stub(io, "open", function()
-            return {
-                lines = function() return mock_file_content:gmatch("[^\r\n]+") end,
-                close = function() end
-            }
-        end)
+        stub(io, "open", function() return mock_file(mock_file_content) end)
 
         local container_id = "abcdef12345"
         local metadata = docker_metadata.get_container_metadata_from_disk(container_id)
@@ -77,11 +110,15 @@ describe("Docker Metadata Enrichment", function()
         local timestamp = os.time()
 
         -- Set up the cache with fresh metadata
-        docker_metadata.cache[container_id] = {
-            time = os.time(),
-            docker_container_name = "cached-container",
-            docker_container_image = "cached-image"
-        }
+        docker_metadata.cache:set(container_id, {
+            data = {
+                time = os.time(),
+                docker_container_name = "cached-container",
+                docker_container_image = "cached-image"
+            },
+            signature = "signature",
+            checked_at = os.time()
+        })
 
         -- Mock the function that reads from disk to ensure it doesn't get called
         stub(docker_metadata, "get_container_metadata_from_disk")
@@ -101,20 +138,25 @@ describe("Docker Metadata Enrichment", function()
         docker_metadata.get_container_metadata_from_disk:revert()
     end)
 
-    -- Additional Test 1: Updates cache when cached data is stale
-    it("updates cache when cached data is stale", function()
+    -- Additional Test 1: Updates cache when the config file changed
+    it("updates cache when the config file changed", function()
         local container_id = "abcdef12345"
         local tag = "containers." .. container_id
         local record = { log = "some log message" }
-        local stale_time = os.time() - (docker_metadata.CACHE_TTL_SEC + 1)
+        local checked_time = os.time() - docker_metadata.CACHE_REVALIDATE_SEC
         local timestamp = os.time()
 
-        -- Set up the cache with stale metadata
-        docker_metadata.cache[container_id] = {
-            time = stale_time,
-            docker_container_name = "stale-container",
-            docker_container_image = "stale-image"
-        }
+        -- Set up the cache with metadata from an older version of the config file
+        docker_metadata.cache:set(container_id, {
+            data = {
+                time = checked_time,
+                docker_container_name = "stale-container",
+                docker_container_image = "stale-image"
+            },
+            signature = "old-signature",
+            checked_at = checked_time
+        })
+        stub(docker_metadata, "get_config_signature", function() return "new-signature" end)
 
         -- Mock the function that reads from disk to return fresh data
         local fresh_metadata = {
@@ -134,10 +176,12 @@ describe("Docker Metadata Enrichment", function()
         assert.spy(docker_metadata.get_container_metadata_from_disk).was_called()
 
         -- Ensure that the cache was updated with fresh data
-        assert.are.equal(fresh_metadata, docker_metadata.cache[container_id])
+        assert.are.equal(fresh_metadata, docker_metadata.cache:get(container_id).data)
+        assert.are.equal(1, docker_metadata.get_cache_stats().invalidations)
 
-        -- Restore the original function
+        -- Restore the original functions
         docker_metadata.get_container_metadata_from_disk:revert()
+        docker_metadata.get_config_signature:revert()
     end)
 
     -- Additional Test 2: Handles missing Docker config file gracefully
@@ -156,7 +200,12 @@ describe("Docker Metadata Enrichment", function()
         -- Check that the metadata fields are not added
         assert.is_nil(enriched_record.docker_container_name)
         assert.is_nil(enriched_record.docker_container_image)
-        assert.are.equal('disk', enriched_record.source)
+        assert.are.equal('unknown', enriched_record.source)
+
+        -- The missing file is remembered, so the next record does not touch the disk
+        docker_metadata.enrich_with_docker_metadata(tag, timestamp, { log = "log message" })
+        assert.spy(io.open).was_called(1)
+        assert.are.equal(1, docker_metadata.get_cache_stats().negative_hits)
 
         io.open:revert()
     end)
@@ -172,12 +221,7 @@ describe("Docker Metadata Enrichment", function()
         local mock_file_content = [[
             this is not valid json
         ]]
-        stub(io, "open", function()
-            return {
-                lines = function() return mock_file_content:gmatch("[^\r\n]+") end,
-                close = function() end
-            }
-        end)
+        stub(io, "open", function() return mock_file(mock_file_content) end)
 
         -- Call the function that enriches the log record with metadata
         local status, enriched_timestamp, enriched_record = docker_metadata.enrich_with_docker_metadata(tag, timestamp, record)
@@ -213,7 +257,7 @@ describe("Docker Metadata Enrichment", function()
         local timestamp = os.time()
 
         -- Ensure cache is empty
-        docker_metadata.cache = {}
+        docker_metadata.reset_cache()
 
         -- Mock the function that reads from disk to return data
         local metadata_from_disk = {
@@ -233,7 +277,7 @@ describe("Docker Metadata Enrichment", function()
         assert.spy(docker_metadata.get_container_metadata_from_disk).was_called()
 
         -- Ensure that the cache was updated with the data from disk
-        assert.are.equal(metadata_from_disk, docker_metadata.cache[container_id])
+        assert.are.equal(metadata_from_disk, docker_metadata.cache:get(container_id).data)
 
         -- Restore the original function
         docker_metadata.get_container_metadata_from_disk:revert()
@@ -281,16 +325,22 @@ describe("Docker Metadata Enrichment", function()
         local timestamp = os.time()
 
         -- Set up the cache with metadata for two containers
-        docker_metadata.cache[container_id1] = {
-            time = os.time(),
-            docker_container_name = "container-one",
-            docker_container_image = "image-one"
-        }
-        docker_metadata.cache[container_id2] = {
-            time = os.time(),
-            docker_container_name = "container-two",
-            docker_container_image = "image-two"
-        }
+        docker_metadata.cache:set(container_id1, {
+            data = {
+                time = os.time(),
+                docker_container_name = "container-one",
+                docker_container_image = "image-one"
+            },
+            checked_at = os.time()
+        })
+        docker_metadata.cache:set(container_id2, {
+            data = {
+                time = os.time(),
+                docker_container_name = "container-two",
+                docker_container_image = "image-two"
+            },
+            checked_at = os.time()
+        })
 
         -- Mock the function that reads from disk to ensure it doesn't get called
         stub(docker_metadata, "get_container_metadata_from_disk")
@@ -314,4 +364,413 @@ describe("Docker Metadata Enrichment", function()
         docker_metadata.get_container_metadata_from_disk:revert()
     end)
 
+    it("stops reading the config file once all fields are found", function()
+        local mock_file_content = '{"State":{"StartedAt":"2021-10-15T12:34:56"},"Config":{"Image":"my-image"},'
+            .. '"Name":"/my-container",' .. string.rep('"Padding":"xxxxxxxxxx",', 1000) .. '}'
+        local handle = mock_file(mock_file_content)
+        spy.on(handle, "read")
+        docker_metadata.CONFIG_READ_CHUNK_BYTES = 128
+
+        local metadata = docker_metadata.extract_metadata(handle, docker_metadata.metadata_extractors)
+
+        assert.are.equal("my-container", metadata['docker_container_name'])
+        assert.are.equal("my-image", metadata['docker_container_image'])
+        assert.are.equal("2021-10-15T12:34:56", metadata['docker_container_started'])
+        assert.spy(handle.read).was_called(1)
+    end)
+
+    it("finds values split across read chunks", function()
+        local mock_file_content = string.rep(" ", 60) .. '{"Name":"/my-container","Image":"my-image"}'
+        docker_metadata.CONFIG_READ_CHUNK_BYTES = 64
+
+        local metadata = docker_metadata.extract_metadata(mock_file(mock_file_content), docker_metadata.metadata_extractors)
+
+        assert.are.equal("my-container", metadata['docker_container_name'])
+        assert.are.equal("my-image", metadata['docker_container_image'])
+    end)
+
+    it("does not read past the configured byte limit", function()
+        local mock_file_content = string.rep(" ", 256) .. '{"Name":"/my-container"}'
+        docker_metadata.CONFIG_READ_CHUNK_BYTES = 64
+        docker_metadata.CONFIG_MAX_READ_BYTES = 128
+
+        local metadata = docker_metadata.extract_metadata(mock_file(mock_file_content), docker_metadata.metadata_extractors)
+
+        assert.is_nil(metadata['docker_container_name'])
+    end)
+
+    it("extracts only allowlisted fields, labels and environment variables", function()
+        local mock_file_content = '{"State":{"StartedAt":"2021-10-15T12:34:56"},"Config":{'
+            .. '"Env":["PATH=/usr/bin","SERVICE_NAME=billing"],"Image":"my-image",'
+            .. '"Labels":{"com.example.team":"payments","other":"ignored"}},"Name":"/my-container"}'
+        local extractors = docker_metadata.configure_metadata_fields(
+            { 'docker_container_name' }, { 'com.example.team' }, { 'SERVICE_NAME' })
+
+        local metadata = docker_metadata.extract_metadata(mock_file(mock_file_content), extractors)
+
+        assert.are.equal("my-container", metadata['docker_container_name'])
+        assert.are.equal("payments", metadata['docker_container_label_com_example_team'])
+        assert.are.equal("billing", metadata['docker_container_env_SERVICE_NAME'])
+        assert.is_nil(metadata['docker_container_image'])
+        assert.is_nil(metadata['docker_container_started'])
+    end)
+
+    it("keeps escaped quotes inside extracted values", function()
+        local mock_file_content = '{"Config":{"Env":["GREETING=say \\"hi\\""]}}'
+        local extractors = docker_metadata.configure_metadata_fields({}, {}, { 'GREETING' })
+
+        local metadata = docker_metadata.extract_metadata(mock_file(mock_file_content), extractors)
+
+        assert.are.equal('say \\"hi\\"', metadata['docker_container_env_GREETING'])
+    end)
+
+    it("keeps cached metadata when the config file is unchanged", function()
+        local container_id = "abcdef12345"
+        local tag = "containers." .. container_id
+        local checked_time = os.time() - docker_metadata.CACHE_REVALIDATE_SEC
+
+        docker_metadata.cache:set(container_id, {
+            data = { time = checked_time, docker_container_name = "cached-container" },
+            signature = "signature",
+            checked_at = checked_time
+        })
+        stub(docker_metadata, "get_config_signature", function() return "signature" end)
+        stub(docker_metadata, "get_container_metadata_from_disk")
+
+        local _, _, enriched_record = docker_metadata.enrich_with_docker_metadata(tag, os.time(), { log = "log" })
+
+        assert.are.equal("cached-container", enriched_record.docker_container_name)
+        assert.are.equal('cache', enriched_record.source)
+        assert.spy(docker_metadata.get_container_metadata_from_disk).was_not_called()
+        assert.are.equal(os.time(), docker_metadata.cache:get(container_id).checked_at)
+
+        docker_metadata.get_config_signature:revert()
+        docker_metadata.get_container_metadata_from_disk:revert()
+    end)
+
+    it("looks up missing containers again once the negative entry expires", function()
+        local container_id = "abc123def456"
+        stub(docker_metadata, "get_container_metadata_from_disk", function() return nil end)
+
+        docker_metadata.lookup_container_metadata(container_id, os.time())
+        docker_metadata.lookup_container_metadata(container_id, os.time() + docker_metadata.NEGATIVE_CACHE_TTL_SEC - 1)
+        assert.spy(docker_metadata.get_container_metadata_from_disk).was_called(1)
+
+        docker_metadata.lookup_container_metadata(container_id, os.time() + docker_metadata.NEGATIVE_CACHE_TTL_SEC)
+        assert.spy(docker_metadata.get_container_metadata_from_disk).was_called(2)
+
+        docker_metadata.get_container_metadata_from_disk:revert()
+    end)
+
+    it("evicts the least recently used container when the cache is full", function()
+        docker_metadata.reset_cache(2)
+        stub(docker_metadata, "get_container_metadata_from_disk", function(container_id)
+            return { time = os.time(), docker_container_name = container_id }, "signature"
+        end)
+
+        docker_metadata.lookup_container_metadata("aaa", os.time())
+        docker_metadata.lookup_container_metadata("bbb", os.time())
+        docker_metadata.lookup_container_metadata("aaa", os.time())
+        docker_metadata.lookup_container_metadata("ccc", os.time())
+
+        assert.is_not_nil(docker_metadata.cache:get("aaa"))
+        assert.is_nil(docker_metadata.cache:get("bbb"))
+        assert.is_not_nil(docker_metadata.cache:get("ccc"))
+
+        local stats = docker_metadata.get_cache_stats()
+        assert.are.equal(1, stats.hits)
+        assert.are.equal(3, stats.misses)
+        assert.are.equal(1, stats.evictions)
+        assert.are.equal(2, stats.size)
+
+        docker_metadata.get_container_metadata_from_disk:revert()
+    end)
+
+    it("counts disk reads, enriched records and read latency", function()
+        stub(io, "open", function() return mock_file('{"Name":"/my-container","Image":"my-image"}') end)
+
+        local tag = "containers.abcdef12345"
+        docker_metadata.enrich_with_docker_metadata(tag, 1, { log = "one" })
+        docker_metadata.enrich_with_docker_metadata(tag, 2, { log = "two" })
+
+        local stats = docker_metadata.get_cache_stats()
+        assert.are.equal(1, stats.disk_reads)
+        assert.are.equal(2, stats.records_enriched)
+        assert.are.equal(1, docker_metadata.read_latency.count)
+
+        io.open:revert()
+    end)
+
+    it("renders metrics in Prometheus text format", function()
+        docker_metadata.cache_stats.hits = 7
+        docker_metadata.cache_stats.records_enriched = 10
+        docker_metadata.observe_read_latency(0.002)
+        docker_metadata.render_metrics(os.time())
+        docker_metadata.cache_stats.records_enriched = 30
+
+        local metrics = docker_metadata.render_metrics(os.time() + 10)
+        assert.is_truthy(metrics:find("# TYPE docker_metadata_cache_hits_total counter\ndocker_metadata_cache_hits_total 7\n", 1, true))
+        assert.is_truthy(metrics:find("docker_metadata_records_enriched_total 30\n", 1, true))
+        assert.is_truthy(metrics:find("docker_metadata_records_enriched_per_second 2.000\n", 1, true))
+        assert.is_truthy(metrics:find('docker_metadata_disk_read_seconds_bucket{le="0.001"} 0\n', 1, true))
+        assert.is_truthy(metrics:find('docker_metadata_disk_read_seconds_bucket{le="0.005"} 1\n', 1, true))
+        assert.is_truthy(metrics:find('docker_metadata_disk_read_seconds_bucket{le="+Inf"} 1\n', 1, true))
+        assert.is_truthy(metrics:find("docker_metadata_disk_read_seconds_count 1\n", 1, true))
+    end)
+
+    it("writes the metrics file once per interval", function()
+        local metrics_file = os.tmpname()
+        docker_metadata.METRICS_FILE = metrics_file
+        local function read_metrics()
+            local fl = io.open(metrics_file, "r")
+            local content = fl:read("*a")
+            fl:close()
+            return content
+        end
+
+        docker_metadata.enrich_with_docker_metadata("containers.abc123", 1, { log = "one" })
+        docker_metadata.enrich_with_docker_metadata("containers.abc123", 2, { log = "two" })
+        assert.is_truthy(read_metrics():find("docker_metadata_cache_negative_hits_total 0\n", 1, true))
+
+        local now = os.time()
+        os.time = function() return now + docker_metadata.METRICS_INTERVAL_SEC end
+        docker_metadata.enrich_with_docker_metadata("containers.abc123", 3, { log = "three" })
+        assert.is_truthy(read_metrics():find("docker_metadata_cache_negative_hits_total 1\n", 1, true))
+
+        os.remove(metrics_file)
+    end)
+
+    it("parses rate limits", function()
+        assert.are.same({ rate = 10, burst = 20, action = "drop" }, docker_metadata.parse_rate_limit("10:20:drop"))
+        assert.are.same({ rate = 0.5, burst = 1, action = "tag" }, docker_metadata.parse_rate_limit("0.5:1:tag"))
+        assert.are.same({ rate = 10, burst = 20, action = "sample", sample_every = 5 },
+            docker_metadata.parse_rate_limit("10:20:sample:5"))
+        assert.is_nil(docker_metadata.parse_rate_limit("10:20:block"))
+        assert.is_nil(docker_metadata.parse_rate_limit("0:20:drop"))
+        assert.is_nil(docker_metadata.parse_rate_limit("10:0:drop"))
+    end)
+
+    it("drops records over the rate limit and refills the bucket over time", function()
+        docker_metadata.configure_rate_limits("2:3:drop", "")
+        local tag = "containers.abc123"
+        local codes = {}
+        for i = 1, 5 do
+            codes[i] = docker_metadata.rate_limit_records(tag, 100.0, { log = "line" })
+        end
+        assert.are.same({ 0, 0, 0, -1, -1 }, codes)
+
+        -- One second at 2 records per second refills two tokens
+        assert.are.equal(0, docker_metadata.rate_limit_records(tag, 101.0, { log = "line" }))
+        assert.are.equal(0, docker_metadata.rate_limit_records(tag, 101.0, { log = "line" }))
+        assert.are.equal(-1, docker_metadata.rate_limit_records(tag, 101.0, { log = "line" }))
+        assert.are.equal(3, docker_metadata.rate_limit_totals.dropped)
+
+        -- Other containers have their own bucket
+        assert.are.equal(0, docker_metadata.rate_limit_records("containers.def456", 101.0, { log = "line" }))
+    end)
+
+    it("tags or samples records over the rate limit", function()
+        docker_metadata.configure_rate_limits("1:1:tag", "")
+        docker_metadata.rate_limit_records("containers.abc123", 100.0, { log = "line" })
+        local code, _, record = docker_metadata.rate_limit_records("containers.abc123", 100.0, { log = "line" })
+        assert.are.equal(1, code)
+        assert.is_true(record.throttled)
+        assert.are.equal(1, docker_metadata.rate_limit_totals.tagged)
+
+        docker_metadata.configure_rate_limits("1:1:sample:3", "")
+        local codes = {}
+        for i = 1, 7 do
+            codes[i] = docker_metadata.rate_limit_records("containers.abc123", 100.0, { log = "line" })
+        end
+        assert.are.same({ 0, 0, -1, -1, 0, -1, -1 }, codes)
+    end)
+
+    it("applies the first matching container or image rule", function()
+        local metadata = {
+            aaa111 = { docker_container_name = "api-1", docker_container_image = "node:20" },
+            bbb222 = { docker_container_name = "worker", docker_container_image = "python:3.12" },
+            ccc333 = { docker_container_name = "db", docker_container_image = "postgres:16" },
+        }
+        stub(docker_metadata, "lookup_container_metadata", function(container_id) return metadata[container_id], "cache" end)
+        docker_metadata.configure_rate_limits("100:100:drop", "container:^api%-=1:1:drop;image:^python=2:2:tag")
+
+        assert.are.equal(1, docker_metadata.resolve_rate_limit("aaa111").burst)
+        assert.are.equal("tag", docker_metadata.resolve_rate_limit("bbb222").action)
+        assert.are.equal(100, docker_metadata.resolve_rate_limit("ccc333").burst)
+
+        docker_metadata.rate_limit_records("containers.aaa111", 100.0, { log = "line" })
+        assert.are.equal(-1, docker_metadata.rate_limit_records("containers.aaa111", 100.0, { log = "line" }))
+
+        docker_metadata.lookup_container_metadata:revert()
+    end)
+
+    it("applies a per-container rate limit once the container's metadata is found", function()
+        local original_os_time = os.time
+        local now = 1600000000
+        os.time = function() return now end
+        local metadata = {}
+        stub(docker_metadata, "lookup_container_metadata", function(container_id) return metadata[container_id], "cache" end)
+        docker_metadata.configure_rate_limits("100:100:drop", "container:^api=1:1:drop")
+
+        -- Seen before its config file was written, it gets the default limit
+        local tag = "containers.aaa111"
+        for _ = 1, 3 do
+            assert.are.equal(0, docker_metadata.rate_limit_records(tag, 100.0, { log = "line" }))
+        end
+        metadata.aaa111 = { docker_container_name = "api" }
+        now = now + docker_metadata.NEGATIVE_CACHE_TTL_SEC
+        assert.are.equal(0, docker_metadata.rate_limit_records(tag, 100.0, { log = "line" }))
+        assert.are.equal(-1, docker_metadata.rate_limit_records(tag, 100.0, { log = "line" }))
+        assert.are.equal("api", docker_metadata.rate_limit_buckets:get("aaa111").name)
+
+        -- Renamed out of the rule, it gets the default limit back on the next revalidation
+        metadata.aaa111 = { docker_container_name = "web" }
+        now = now + docker_metadata.CACHE_REVALIDATE_SEC - 1
+        assert.are.equal(-1, docker_metadata.rate_limit_records(tag, 100.0, { log = "line" }))
+        now = now + 1
+        for _ = 1, 5 do
+            assert.are.equal(0, docker_metadata.rate_limit_records(tag, 100.5, { log = "line" }))
+        end
+
+        docker_metadata.lookup_container_metadata:revert()
+        os.time = original_os_time
+    end)
+
+    it("passes every record through without rate limits", function()
+        assert.are.equal(0, docker_metadata.rate_limit_records("containers.abc123", 100.0, { log = "line" }))
+        assert.are.equal(0, docker_metadata.rate_limit_records("no-container", 100.0, { log = "line" }))
+    end)
+
+    it("reports suppressed records per container", function()
+        local metrics_file = os.tmpname()
+        docker_metadata.RATE_LIMIT_METRICS_FILE = metrics_file
+        docker_metadata.configure_rate_limits("1:1:drop", "")
+        for i = 1, 4 do
+            docker_metadata.rate_limit_records("containers.abc123", 100.0, { log = "line" })
+        end
+        docker_metadata.rate_limit_reported_at = nil
+        docker_metadata.rate_limit_records("containers.abc123", 100.0, { log = "line" })
+
+        local fl = io.open(metrics_file, "r")
+        local metrics = fl:read("*a")
+        fl:close()
+        os.remove(metrics_file)
+        assert.is_truthy(metrics:find('docker_rate_limited_records_total{container_id="abc123",container_name="",action="drop"} 4', 1, true))
+    end)
+
+    -- Function to write a metadata index file as metadata_index.py does
+    local function write_index(path, generation, lines, heartbeat)
+        local fl = io.open(path, "w")
+        fl:write("# generation " .. generation .. "\n# heartbeat " .. (heartbeat or generation) .. "\n"
+                 .. table.concat(lines, "\n") .. "\n")
+        fl:close()
+    end
+
+    it("parses metadata index lines", function()
+        local entries = docker_metadata.parse_metadata_index(table.concat({
+            "abc123\tdocker_container_name\tweb\tdocker_container_label_note\ttab\\there\\nnew\\\\line",
+            "",
+            "def456\tdocker_container_name\tdb",
+        }, "\n"):gmatch("[^\n]*"))
+        assert.are.same({ docker_container_name = "web", docker_container_label_note = "tab\there\nnew\\line" },
+            entries["abc123"])
+        assert.are.same({ docker_container_name = "db" }, entries["def456"])
+    end)
+
+    it("answers lookups from the metadata index without reading config files", function()
+        local index_file = os.tmpname()
+        write_index(index_file, 1, { "abc123\tdocker_container_name\tindexed-web\tdocker_container_image\tnginx" })
+        docker_metadata.METADATA_INDEX_FILE = index_file
+        stub(docker_metadata, "get_container_metadata_from_disk")
+
+        local _, _, record = docker_metadata.enrich_with_docker_metadata("containers.abc123", 100, { log = "line" })
+        assert.are.equal("indexed-web", record.docker_container_name)
+        assert.are.equal("nginx", record.docker_container_image)
+        assert.are.equal("index", record.source)
+        assert.spy(docker_metadata.get_container_metadata_from_disk).was_not_called()
+        assert.are.equal(1, docker_metadata.get_cache_stats().index_hits)
+
+        -- Containers missing from the index are still looked up on disk
+        docker_metadata.lookup_container_metadata("def456", 1600000000)
+        assert.spy(docker_metadata.get_container_metadata_from_disk).was_called(1)
+
+        docker_metadata.get_container_metadata_from_disk:revert()
+        os.remove(index_file)
+    end)
+
+    it("reloads the metadata index only when its generation changed", function()
+        local index_file = os.tmpname()
+        write_index(index_file, 1, { "abc123\tdocker_container_name\tweb" })
+        docker_metadata.METADATA_INDEX_FILE = index_file
+
+        docker_metadata.lookup_container_metadata("abc123", 100)
+        docker_metadata.lookup_container_metadata("abc123", 102)
+        assert.are.equal(1, docker_metadata.get_cache_stats().index_loads)
+
+        write_index(index_file, 2, { "abc123\tdocker_container_name\trenamed" })
+        -- Not checked again within INDEX_CHECK_INTERVAL_SEC
+        local data = docker_metadata.lookup_container_metadata("abc123", 102)
+        assert.are.equal("web", data.docker_container_name)
+        data = docker_metadata.lookup_container_metadata("abc123", 104)
+        assert.are.equal("renamed", data.docker_container_name)
+        assert.are.equal(2, docker_metadata.get_cache_stats().index_loads)
+
+        os.remove(index_file)
+        docker_metadata.lookup_container_metadata("abc123", 106)
+        assert.are.same({}, docker_metadata.metadata_index.entries)
+    end)
+
+    it("ignores a metadata index that stopped changing", function()
+        local index_file = os.tmpname()
+        write_index(index_file, 1, { "abc123\tdocker_container_name\tstale-name" })
+        docker_metadata.METADATA_INDEX_FILE = index_file
+        docker_metadata.INDEX_STALE_SEC = 90
+        stub(docker_metadata, "get_container_metadata_from_disk",
+             function() return { docker_container_name = "disk-name" }, "sig" end)
+
+        local data, source = docker_metadata.lookup_container_metadata("abc123", 1000)
+        assert.are.same({ "stale-name", "index" }, { data.docker_container_name, source })
+        data, source = docker_metadata.lookup_container_metadata("abc123", 1089)
+        assert.are.equal("index", source)
+
+        -- The indexer stopped: the cache and config files are used instead
+        data, source = docker_metadata.lookup_container_metadata("abc123", 1090)
+        assert.are.same({ "disk-name", "disk" }, { data.docker_container_name, source })
+
+        -- The indexer is back
+        write_index(index_file, 2, { "abc123\tdocker_container_name\tnew-name" })
+        data, source = docker_metadata.lookup_container_metadata("abc123", 1095)
+        assert.are.same({ "new-name", "index" }, { data.docker_container_name, source })
+
+        docker_metadata.get_container_metadata_from_disk:revert()
+        os.remove(index_file)
+    end)
+
+    it("keeps a metadata index current from its heartbeat without reloading it", function()
+        local index_file = os.tmpname()
+        local lines = { "abc123\tdocker_container_name\tweb" }
+        write_index(index_file, 1, lines, 1)
+        docker_metadata.METADATA_INDEX_FILE = index_file
+        docker_metadata.INDEX_STALE_SEC = 90
+
+        docker_metadata.lookup_container_metadata("abc123", 1000)
+        for heartbeat = 2, 5 do
+            write_index(index_file, 1, lines, heartbeat)
+            local _, source = docker_metadata.lookup_container_metadata("abc123", 1000 + heartbeat * 60)
+            assert.are.equal("index", source)
+        end
+        assert.are.equal(1, docker_metadata.get_cache_stats().index_loads)
+
+        os.remove(index_file)
+    end)
+
+    it("adds the source field only when diagnostic fields are enabled", function()
+        docker_metadata.DIAGNOSTIC_FIELDS = false
+        docker_metadata.cache:set("abc123", { data = { docker_container_name = "web" }, signature = "signature",
+                                              checked_at = 1600000000 })
+        local _, _, record = docker_metadata.enrich_with_docker_metadata("containers.abc123", 100, { log = "line" })
+        assert.are.equal("web", record.docker_container_name)
+        assert.is_nil(record.source)
+    end)
+
 end)
@@ -0,0 +1,235 @@
+import unittest
+from unittest.mock import patch
+import fnmatch
+import os
+import re
+
+# Import the module to be tested
+import create_fluent_bit_config
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+
+# Environment of each golden scenario. The golden directory holds the filters rendered by
+# the generator (<scenario>.conf) and by the pre-plan generator (<scenario>.legacy.conf).
+SCENARIOS = {
+    'default': {},
+    'match_container_name': {'MATCH_CONTAINER_NAME': '^web-'},
+    'skip_container_names': {'SKIP_CONTAINER_NAMES': 'db,cache'},
+    'match_image_name': {'MATCH_IMAGE_NAME': 'nginx'},
+    'skip_image_names': {'SKIP_IMAGE_NAMES': 'redis,postgres'},
+    'container_and_image_selectors': {'MATCH_CONTAINER_NAME': '^web-', 'SKIP_IMAGE_NAMES': 'redis, postgres:16'},
+    'container_and_image_matches': {'MATCH_CONTAINER_NAME': '^web-', 'MATCH_IMAGE_NAME': 'nginx'},
+    'include_line': {'INCLUDE_LINE': 'ERROR'},
+    'exclude_lines': {'EXCLUDE_LINES': 'DEBUG,TRACE'},
+    'all_filters': {'SKIP_CONTAINER_NAMES': 'db,cache', 'MATCH_IMAGE_NAME': 'nginx', 'EXCLUDE_LINES': 'DEBUG, health check',
+                    'ADDITIONAL_FIELDS': 'env:production', 'SET_FIELDS': 'team:web'},
+}
+
+# Metadata the simulated Lua filter adds for each container ID
+CONTAINERS = {
+    'aaa111': {'docker_container_name': 'web-frontend', 'docker_container_image': 'nginx:1.25'},
+    'bbb222': {'docker_container_name': 'db', 'docker_container_image': 'postgres:16'},
+    'ccc333': {'docker_container_name': 'cache', 'docker_container_image': 'redis:7'},
+    'ddd444': {'docker_container_name': 'web-api', 'docker_container_image': 'python:3.12'},
+    'eee555': {'docker_container_name': 'worker', 'docker_container_image': 'nginxinc/nginx-unprivileged'},
+    'fff666': {'docker_container_name': 'web-cache', 'docker_container_image': 'redis:7'},
+}
+
+LOG_LINES = [
+    'ERROR could not connect',
+    'DEBUG retrying',
+    'TRACE entering handler',
+    'GET /health check ok',
+    'INFO started',
+    {'level': 'error', 'msg': 'decoded JSON log'},
+]
+
+
+def build_corpus():
+    records = []
+    for container_id in CONTAINERS:
+        tag = f'docker.var.lib.docker.containers.{container_id}.{container_id}-json.log'
+        for line in LOG_LINES:
+            records.append((tag, {'log': line, 'stream': 'stdout', 'time': '2024-05-01T10:00:00.000000000Z'}))
+    return records
+
+
+def parse_filters(config_text):
+    # Parse [FILTER] sections into (name, match, [(key, value)]) tuples
+    filters = []
+    for section in config_text.split('[FILTER]')[1:]:
+        properties = []
+        for line in section.strip().splitlines():
+            key, _, value = line.strip().partition(' ')
+            properties.append((key, value.strip()))
+        name = next(value for key, value in properties if key == 'Name')
+        match = next(value for key, value in properties if key == 'Match')
+        filters.append((name, match, [(k, v) for k, v in properties if k not in ('Name', 'Match')]))
+    return filters
+
+
+def simulate(filters, tag, record):
+    # Apply the subset of Fluent Bit 1.9 filter semantics used by the generator; None means dropped
+    record = dict(record)
+    for name, match, properties in filters:
+        if not fnmatch.fnmatchcase(tag, match):
+            continue
+        if name == 'lua':
+            container_id = re.search(r'containers\.([a-f0-9]+)', tag).group(1)
+            record['docker_container_id'] = container_id
+            record['source'] = 'cache'
+            record.update(CONTAINERS[container_id])
+        elif name == 'grep':
+            # Rules are checked in order up to the first match: a matching Regex keeps the
+            # record without checking the rules after it
+            for rule, value in properties:
+                key, pattern = value.split(' ', 1)
+                field = record.get(key)
+                matched = isinstance(field, str) and re.search(pattern, field) is not None
+                if (rule == 'Regex' and not matched) or (rule == 'Exclude' and matched):
+                    return None
+                if rule == 'Regex':
+                    break
+        elif name == 'nest':
+            nested_under = dict(properties)['Nested_under']
+            if isinstance(record.get(nested_under), dict):
+                record.update(record.pop(nested_under))
+        elif name == 'modify':
+            for rule, value in properties:
+                key, _, new_value = value.partition(' ')
+                if rule == 'Remove':
+                    record.pop(key, None)
+                elif rule == 'Remove_wildcard':
+                    record = {k: v for k, v in record.items() if not k.startswith(key)}
+                elif rule == 'Remove_regex':
+                    record = {k: v for k, v in record.items() if not re.search(key, k)}
+                elif rule == 'Rename' and key in record and new_value not in record:
+                    record[new_value] = record.pop(key)
+                elif rule == 'Add' and key not in record:
+                    record[key] = new_value
+                elif rule == 'Set':
+                    record[key] = new_value
+        else:
+            raise ValueError(f'Unsupported filter {name}')
+    return record
+
+
+def simulate_all(config_text, corpus):
+    filters = parse_filters(config_text)
+    return [simulate(filters, tag, record) for tag, record in corpus]
+
+
+def read_golden(name):
+    with open(os.path.join(GOLDEN_DIR, name)) as file:
+        return file.read()
+
+
+def render_filters(env):
+    with patch.dict(os.environ, env, clear=True):
+        config_obj = create_fluent_bit_config.Config()
+        return create_fluent_bit_config.generate_filters(config_obj)
+
+
+class TestFilterPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+        self.corpus = build_corpus()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+
+    def test_rendered_filters_match_golden_files(self):
+        for scenario, env in SCENARIOS.items():
+            with self.subTest(scenario=scenario):
+                self.assertEqual(read_golden(f'{scenario}.conf'), render_filters(env))
+
+    def test_selectors_filter_the_same_records_as_legacy_chain(self):
+        for scenario, env in SCENARIOS.items():
+            if 'INCLUDE_LINE' in env or 'EXCLUDE_LINES' in env:
+                continue
+            with self.subTest(scenario=scenario):
+                legacy = simulate_all(read_golden(f'{scenario}.legacy.conf'), self.corpus)
+                optimized = simulate_all(render_filters(env), self.corpus)
+                self.assertEqual(legacy, optimized)
+
+    def test_message_filters_apply_to_the_log_line(self):
+        # The legacy chain evaluated message filters before 'log' was renamed to 'message',
+        # so it is compared with the legacy chain minus those filters, filtered by message text
+        for scenario, env in SCENARIOS.items():
+            if 'INCLUDE_LINE' not in env and 'EXCLUDE_LINES' not in env:
+                continue
+            with self.subTest(scenario=scenario):
+                legacy_filters = [f for f in parse_filters(read_golden(f'{scenario}.legacy.conf'))
+                                  if not any(value.startswith('message ') for _, value in f[2])]
+                expected = []
+                for tag, record in self.corpus:
+                    result = simulate(legacy_filters, tag, record)
+                    message = result.get('message') if result else None
+                    matches = [isinstance(message, str) and re.search(pattern.strip(), message) is not None
+                               for pattern in env.get('EXCLUDE_LINES', env.get('INCLUDE_LINE')).split(',')]
+                    if result is None or ('INCLUDE_LINE' in env and not matches[0]) or \
+                            ('EXCLUDE_LINES' in env and any(matches)):
+                        expected.append(None)
+                    else:
+                        expected.append(result)
+                self.assertEqual(expected, simulate_all(render_filters(env), self.corpus))
+                self.assertTrue(any(result is not None for result in expected))
+
+    def test_message_filters_changed_from_the_legacy_chain(self):
+        # The legacy chain matched message filters against 'message' before the rename created
+        # it: INCLUDE_LINE dropped every record and EXCLUDE_LINES dropped none. They now match
+        # the raw 'log' line, and a log decoded as JSON is not a line, so it never matches.
+        legacy_include = simulate_all(read_golden('include_line.legacy.conf'), self.corpus)
+        self.assertTrue(all(record is None for record in legacy_include))
+        legacy_exclude = simulate_all(read_golden('exclude_lines.legacy.conf'), self.corpus)
+        self.assertTrue(all(record is not None for record in legacy_exclude))
+
+        included = {record['message'] for record in simulate_all(render_filters(SCENARIOS['include_line']), self.corpus)
+                    if record}
+        self.assertEqual({'ERROR could not connect'}, included)
+        excluded = [record['message'] for record in simulate_all(render_filters(SCENARIOS['exclude_lines']), self.corpus)
+                    if record]
+        self.assertNotIn('DEBUG retrying', excluded)
+        self.assertNotIn('TRACE entering handler', excluded)
+        self.assertIn({'level': 'error', 'msg': 'decoded JSON log'}, excluded)
+
+    def test_selectors_of_different_kinds_all_apply(self):
+        # A web-* container running a skipped image, and one running another image, are dropped
+        for scenario in ['container_and_image_selectors', 'container_and_image_matches']:
+            with self.subTest(scenario=scenario):
+                shipped = {record['docker_container_name']
+                           for record in simulate_all(render_filters(SCENARIOS[scenario]), self.corpus) if record}
+                self.assertEqual({'web-frontend', 'web-api'} if scenario == 'container_and_image_selectors'
+                                 else {'web-frontend'}, shipped)
+
+    def test_redundant_nest_lift_is_dropped(self):
+        self.assertNotIn('Name nest', render_filters(SCENARIOS['all_filters']))
+
+    def test_patterns_with_backreferences_are_not_merged(self):
+        filters = render_filters({'SKIP_CONTAINER_NAMES': r'(a)\1,db'})
+        self.assertIn('Exclude docker_container_name (a)\\1\n', filters)
+        self.assertIn('Exclude docker_container_name db\n', filters)
+
+    def test_field_projection_is_applied_last(self):
+        env = {'FIELD_PROJECTION': 'drop:time,docker_container_*;rename:stream=log_stream;keep:message,log_stream',
+               'ADDITIONAL_FIELDS': 'env:production'}
+        filters = parse_filters(render_filters(env))
+        self.assertEqual([('Remove', 'time'), ('Remove_wildcard', 'docker_container_'),
+                          ('Rename', 'stream log_stream'), ('Remove_regex', '^(?!(message|log_stream)$)')],
+                         filters[-1][2])
+        tag, record = self.corpus[0]
+        self.assertEqual({'message': 'ERROR could not connect', 'log_stream': 'stdout'},
+                         simulate(filters, tag, record))
+
+    def test_debug_mode_prints_the_plan(self):
+        render_filters({'EXCLUDE_LINES': 'DEBUG', 'FILTER_PLAN_DEBUG': 'true'})
+        printed = self.mock_print.call_args[0][0]
+        self.assertIn('Filter plan:', printed)
+        self.assertIn('1. grep (match *): drop lines matching EXCLUDE_LINES, before enrichment', printed)
+        self.assertIn('2. lua (match docker.*): enrich records with container metadata', printed)
+
+
+if __name__ == '__main__':
+    unittest.main()
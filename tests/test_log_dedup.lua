@@ -0,0 +1,165 @@
+package.path = "../?.lua;" .. package.path
+local docker_metadata = require("docker-metadata")
+local busted = require("busted")
+
+-- Function to run records through the dedup filter the way Fluent Bit does, collecting
+-- the records it emits in order
+local function run_records(records)
+    local emitted = {}
+    for _, entry in ipairs(records) do
+        local code, _, result = docker_metadata.deduplicate_records(entry.tag, entry.time, { message = entry.message })
+        if code == 0 then
+            table.insert(emitted, { tag = entry.tag, message = entry.message })
+        elseif code == 1 then
+            local results = result[1] and result or { result }
+            for _, record in ipairs(results) do
+                table.insert(emitted, { tag = entry.tag, message = record.message, repeat_count = record.repeat_count,
+                                        first_timestamp = record.first_timestamp, last_timestamp = record.last_timestamp })
+            end
+        end
+    end
+    return emitted
+end
+
+local function entry(tag, time, message)
+    return { tag = tag, time = time, message = message }
+end
+
+describe("Log deduplication", function()
+    local original_os_time
+    local now
+
+    before_each(function()
+        original_os_time = os.time
+        now = 1600000000
+        os.time = function() return now end
+        docker_metadata.reset_dedup()
+        docker_metadata.DEDUP_WINDOW_SEC = 10
+    end)
+
+    after_each(function()
+        os.time = original_os_time
+    end)
+
+    it("ships distinct messages unchanged", function()
+        local emitted = run_records({ entry("a", 1, "one"), entry("a", 2, "two"), entry("a", 3, "one") })
+        assert.are.same({ { tag = "a", message = "one" }, { tag = "a", message = "two" }, { tag = "a", message = "one" } },
+            emitted)
+    end)
+
+    it("collapses repeats into a summary before the next message", function()
+        local emitted = run_records({
+            entry("a", 100.25, "retrying"), entry("a", 101, "retrying"), entry("a", 102, "retrying"),
+            entry("a", 103.5, "retrying"), entry("a", 104, "connected")
+        })
+        assert.are.equal(3, #emitted)
+        assert.are.same({ tag = "a", message = "retrying" }, emitted[1])
+        assert.are.equal("retrying", emitted[2].message)
+        assert.are.equal(3, emitted[2].repeat_count)
+        assert.are.equal("1970-01-01T00:01:40.250000Z", emitted[2].first_timestamp)
+        assert.are.equal("1970-01-01T00:01:43.500000Z", emitted[2].last_timestamp)
+        assert.are.same({ tag = "a", message = "connected" }, emitted[3])
+    end)
+
+    it("starts a new run once the window passed", function()
+        local emitted = run_records({
+            entry("a", 0, "retrying"), entry("a", 5, "retrying"), entry("a", 10, "retrying"), entry("a", 11, "retrying"),
+            entry("a", 12, "done")
+        })
+        assert.are.same({ "retrying", "retrying", "retrying", "retrying", "done" },
+            { emitted[1].message, emitted[2].message, emitted[3].message, emitted[4].message, emitted[5].message })
+        assert.is_nil(emitted[1].repeat_count)
+        assert.are.equal(1, emitted[2].repeat_count)
+        assert.is_nil(emitted[3].repeat_count)
+        assert.are.equal(1, emitted[4].repeat_count)
+    end)
+
+    it("keeps the order of each container when their records interleave", function()
+        local emitted = run_records({
+            entry("a", 1, "loop"), entry("b", 1, "loop"), entry("a", 2, "loop"), entry("b", 2, "other"),
+            entry("a", 3, "loop"), entry("a", 4, "end")
+        })
+        local by_tag = { a = {}, b = {} }
+        for _, record in ipairs(emitted) do
+            table.insert(by_tag[record.tag], record.repeat_count and (record.message .. " x" .. record.repeat_count) or record.message)
+        end
+        assert.are.same({ "loop", "loop x2", "end" }, by_tag.a)
+        assert.are.same({ "loop", "other" }, by_tag.b)
+    end)
+
+    it("does not compare structured messages", function()
+        local structured = { level = "error" }
+        local code = docker_metadata.deduplicate_records("a", 1, { message = structured })
+        assert.are.equal(0, code)
+        code = docker_metadata.deduplicate_records("a", 2, { message = structured })
+        assert.are.equal(0, code)
+
+        docker_metadata.deduplicate_records("a", 3, { message = "loop" })
+        docker_metadata.deduplicate_records("a", 4, { message = "loop" })
+        local _, _, records = docker_metadata.deduplicate_records("a", 5, { message = structured })
+        assert.are.equal(1, records[1].repeat_count)
+        assert.are.equal(structured, records[2].message)
+    end)
+
+    it("keeps state for a bounded number of containers", function()
+        docker_metadata.reset_dedup(2)
+        run_records({ entry("a", 1, "loop"), entry("b", 1, "loop"), entry("c", 1, "loop") })
+        assert.are.equal(2, docker_metadata.dedup_runs.size)
+        assert.is_nil(docker_metadata.dedup_runs:get("a"))
+
+        -- A container whose state was evicted starts a new run
+        local emitted = run_records({ entry("a", 2, "loop") })
+        assert.are.same({ { tag = "a", message = "loop" } }, emitted)
+    end)
+
+    it("ships the repeats of a container that went quiet once the window passed", function()
+        local emitted = run_records({ entry("a", 1, "retrying"), entry("a", 2, "retrying"), entry("a", 3, "retrying") })
+        assert.are.same({ { tag = "a", message = "retrying" } }, emitted)
+
+        now = now + 9
+        assert.are.same({ { tag = "b", message = "other" } }, run_records({ entry("b", 10, "other") }))
+
+        now = now + 1
+        emitted = run_records({ entry("b", 11, "still here") })
+        assert.are.equal(2, #emitted)
+        assert.are.equal("retrying", emitted[1].message)
+        assert.are.equal(2, emitted[1].repeat_count)
+        assert.are.equal("1970-01-01T00:00:03.000000Z", emitted[1].last_timestamp)
+        assert.are.same({ tag = "b", message = "still here" }, emitted[2])
+        assert.is_nil(docker_metadata.dedup_runs:get("a"))
+    end)
+
+    it("ships the repeats of a run ended while its container repeats another message", function()
+        run_records({ entry("a", 1, "loop"), entry("b", 1, "tick"), entry("b", 2, "tick") })
+        now = now + 10
+        local emitted = run_records({ entry("a", 12, "loop") })
+        -- The repeat of b is shipped with a's record; a's own run expired, so a starts a new one
+        assert.are.same({ "tick", "loop" }, { emitted[1].message, emitted[2].message })
+        assert.are.equal(1, emitted[1].repeat_count)
+        assert.is_nil(emitted[2].repeat_count)
+    end)
+
+    it("ships the repeats of an evicted run", function()
+        docker_metadata.reset_dedup(2)
+        run_records({ entry("a", 1, "loop"), entry("a", 2, "loop"), entry("a", 3, "loop"), entry("b", 3, "other") })
+        local emitted = run_records({ entry("c", 4, "new") })
+        assert.are.equal(2, #emitted)
+        assert.are.equal("loop", emitted[1].message)
+        assert.are.equal(2, emitted[1].repeat_count)
+        assert.are.same({ tag = "c", message = "new" }, emitted[2])
+    end)
+
+    it("ships ended runs while holding a repeat", function()
+        run_records({ entry("a", 1, "loop"), entry("a", 2, "loop") })
+        now = now + 5
+        run_records({ entry("b", 6, "tick") })
+        now = now + 5
+        -- The run of a expired; b's repeat is held and a's summary is shipped alone
+        local code, _, records = docker_metadata.deduplicate_records("b", 11, { message = "tick" })
+        assert.are.equal(1, code)
+        assert.are.equal(1, #records)
+        assert.are.equal("loop", records[1].message)
+        assert.are.equal(1, records[1].repeat_count)
+    end)
+
+end)
@@ -0,0 +1,223 @@
+import unittest
+from unittest.mock import patch
+import http.server
+import json
+import os
+import queue
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# Import the module to be tested
+import docker_api
+import metadata_index
+
+
+# Unix-socket stand-in for the Docker Engine API. Serves the containers it holds, and streams
+# the events put on its queue from /events until None is put on it or the until time passed.
+class DockerAPIStandIn(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, DockerAPIStandInHandler)
+        self.containers = {}
+        self.events = queue.Queue()
+        self.event_requests = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class DockerAPIStandInHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/containers/json':
+            self._send_json([{'Id': container_id, 'Names': [container['Name']], 'Image': container['Config']['Image']}
+                             for container_id, container in self.server.containers.items()])
+        elif url.path.startswith('/containers/') and url.path.endswith('/json'):
+            container = self.server.containers.get(url.path.split('/')[2])
+            if container is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self._send_json(container)
+        elif url.path == '/events':
+            query = urllib.parse.parse_qs(url.query)
+            self.server.event_requests.append(query)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            until = float(query['until'][0]) if 'until' in query else time.time() + 10
+            while True:
+                try:
+                    event = self.server.events.get(timeout=max(until - time.time(), 0))
+                except queue.Empty:
+                    return
+                if event is None:
+                    return
+                self.wfile.write(json.dumps(event).encode() + b'\n')
+                self.wfile.flush()
+
+    def _send_json(self, value):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return 'docker.sock'
+
+    def log_message(self, format, *args):
+        pass
+
+
+def container(name, image='nginx:latest', labels=None, env=None, started='2024-05-01T10:00:00Z'):
+    return {'Name': f'/{name}', 'Config': {'Image': image, 'Labels': labels or {}, 'Env': env or []},
+            'State': {'StartedAt': started}}
+
+
+def event(action, container_id):
+    return {'Type': 'container', 'Action': action, 'Actor': {'ID': container_id, 'Attributes': {}}}
+
+
+class TestMetadataIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.temp_dir.name, 'docker.sock')
+        self.index_path = os.path.join(self.temp_dir.name, 'metadata-index.tsv')
+        self.docker = DockerAPIStandIn(self.socket_path)
+        self.docker.containers['a' * 64] = container('web', labels={'team': 'core'}, env=['STAGE=prod', 'X=1'])
+        self.docker.containers['b' * 64] = container('db', image='postgres:16')
+
+    def tearDown(self):
+        self.docker.events.put(None)
+        self.docker.stop()
+        self.temp_dir.cleanup()
+
+    def _indexer(self, **kwargs):
+        return metadata_index.MetadataIndexer(self.socket_path, self.index_path, **kwargs)
+
+    def _read_index(self):
+        with open(self.index_path) as file:
+            lines = file.read().splitlines()
+        entries = {}
+        for line in lines[2:]:
+            columns = line.split('\t')
+            entries[columns[0]] = dict(zip(columns[1::2], columns[2::2]))
+        return lines[0], entries
+
+    def _read_heartbeat(self):
+        with open(self.index_path) as file:
+            return file.read().splitlines()[1]
+
+    def test_sync_indexes_every_container(self):
+        self._indexer(labels=['team'], env_keys=['STAGE']).sync()
+        generation, entries = self._read_index()
+        self.assertTrue(generation.startswith('# generation '))
+        self.assertTrue(self._read_heartbeat().startswith('# heartbeat '))
+        self.assertEqual({
+            'docker_container_name': 'web',
+            'docker_container_image': 'nginx:latest',
+            'docker_container_started': '2024-05-01T10:00:00Z',
+            'docker_container_label_team': 'core',
+            'docker_container_env_STAGE': 'prod',
+        }, entries['a' * 64])
+        self.assertEqual('postgres:16', entries['b' * 64]['docker_container_image'])
+        self.assertNotIn('docker_container_label_team', entries['b' * 64])
+        self.assertFalse(os.path.exists(self.index_path + '.tmp'))
+
+    def test_events_update_the_index(self):
+        indexer = self._indexer()
+        since = indexer.sync()
+
+        self.docker.containers['a' * 64] = container('web-renamed')
+        self.docker.containers['c' * 64] = container('new', image='redis:7')
+        del self.docker.containers['b' * 64]
+        for item in (event('rename', 'a' * 64), event('create', 'c' * 64), event('destroy', 'b' * 64), None):
+            self.docker.events.put(item)
+        indexer.follow_events(since)
+
+        _, entries = self._read_index()
+        self.assertEqual(['a' * 64, 'c' * 64], sorted(entries))
+        self.assertEqual('web-renamed', entries['a' * 64]['docker_container_name'])
+        self.assertEqual('redis:7', entries['c' * 64]['docker_container_image'])
+        request = self.docker.event_requests[0]
+        self.assertEqual([str(since)], request['since'])
+        self.assertEqual({'type': ['container']}, json.loads(request['filters'][0]))
+
+    def test_unchanged_containers_do_not_rewrite_the_index(self):
+        indexer = self._indexer()
+        since = indexer.sync()
+        generation, _ = self._read_index()
+        for item in (event('start', 'a' * 64), event('die', 'b' * 64), None):
+            self.docker.events.put(item)
+        indexer.follow_events(since)
+        self.assertEqual(generation, self._read_index()[0])
+
+    def test_index_is_written_while_no_container_changes(self):
+        indexer = self._indexer()
+        since = indexer.sync()
+        generation, entries = self._read_index()
+        heartbeat = self._read_heartbeat()
+        with patch.object(metadata_index, 'HEARTBEAT_INTERVAL_SEC', 1):
+            thread = threading.Thread(target=indexer.follow_events, args=(since,))
+            thread.start()
+            time.sleep(2.5)
+            self.docker.events.put(None)
+            thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+        # Only the heartbeat changed, so the Lua filter does not reload the entries
+        self.assertEqual(generation, self._read_index()[0])
+        self.assertNotEqual(heartbeat, self._read_heartbeat())
+        self.assertEqual(entries, self._read_index()[1])
+        # Each window follows the events from the end of the previous one
+        self.assertGreaterEqual(len(self.docker.event_requests), 2)
+        self.assertEqual(self.docker.event_requests[0]['until'], self.docker.event_requests[1]['since'])
+
+    def test_values_are_escaped(self):
+        self.docker.containers['a' * 64] = container('web', labels={'note': 'tab\there\nnew\\line'})
+        self._indexer(labels=['note']).sync()
+        _, entries = self._read_index()
+        self.assertEqual('tab\\there\\nnew\\\\line', entries['a' * 64]['docker_container_label_note'])
+
+    def test_selected_fields_only(self):
+        self._indexer(fields=['docker_container_name']).sync()
+        _, entries = self._read_index()
+        self.assertEqual({'docker_container_name': 'web'}, entries['a' * 64])
+
+    def test_missing_socket_raises_docker_api_error(self):
+        indexer = metadata_index.MetadataIndexer(os.path.join(self.temp_dir.name, 'missing.sock'), self.index_path)
+        with self.assertRaises(docker_api.DockerAPIError):
+            indexer.sync()
+
+    def test_run_retries_after_errors(self):
+        indexer = self._indexer()
+        with patch.object(indexer, 'sync', side_effect=docker_api.DockerAPIError('boom')), \
+                patch('time.sleep', side_effect=[None, KeyboardInterrupt]), patch('builtins.print') as mock_print:
+            with self.assertRaises(KeyboardInterrupt):
+                indexer.run()
+        mock_print.assert_any_call("Warning: Could not update the container metadata index: boom")
+
+    def test_run_keeps_indexing_after_unexpected_errors(self):
+        indexer = self._indexer()
+        with patch.object(indexer, 'sync', side_effect=[KeyError('Id'), 0]) as mock_sync, \
+                patch.object(indexer, 'follow_events', side_effect=KeyboardInterrupt), \
+                patch('time.sleep'), patch('builtins.print') as mock_print:
+            with self.assertRaises(KeyboardInterrupt):
+                indexer.run()
+        self.assertEqual(2, mock_sync.call_count)
+        mock_print.assert_any_call("Warning: Unexpected error updating the container metadata index: KeyError('Id')")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+package.path = "../?.lua;" .. package.path
+local docker_metadata = require("docker-metadata")
+local busted = require("busted")
+
+local WEB_TAG = "docker.var.lib.docker.containers.aaa111.aaa111-json.log"
+local DB_TAG = "docker.var.lib.docker.containers.bbb222.bbb222-json.log"
+local HEARTBEAT_TAG = docker_metadata.PARTIAL_LINE_HEARTBEAT_TAG
+
+-- Function to run records through the reassembly filter the way Fluent Bit does, collecting
+-- the records it emits in order with the tag and timestamp of the chunk they are emitted in
+local function run_records(records)
+    local emitted = {}
+    for _, entry in ipairs(records) do
+        local record = entry.tag == HEARTBEAT_TAG and { heartbeat = true }
+            or { log = entry.log, stream = entry.stream or "stdout" }
+        local code, timestamp, result = docker_metadata.reassemble_partial_lines(entry.tag, entry.time or 1, record)
+        if code == 0 then
+            table.insert(emitted, { tag = entry.tag, time = entry.time or 1, record = record })
+        elseif code == 1 then
+            local results = result[1] and result or { result }
+            for _, emitted_record in ipairs(results) do
+                table.insert(emitted, { tag = entry.tag, time = timestamp, record = emitted_record })
+            end
+        end
+    end
+    return emitted
+end
+
+local function entry(tag, log, stream, time)
+    return { tag = tag, log = log, stream = stream, time = time }
+end
+
+local function logs(emitted)
+    local result = {}
+    for _, item in ipairs(emitted) do
+        table.insert(result, item.record.log)
+    end
+    return result
+end
+
+describe("Partial line reassembly", function()
+    local original_os_time
+    local now
+
+    before_each(function()
+        original_os_time = os.time
+        now = 1600000000
+        os.time = function() return now end
+        docker_metadata.MAX_EVENT_SIZE = 1048576
+        docker_metadata.PARTIAL_LINE_TIMEOUT_SEC = 5
+        docker_metadata.reset_partial_lines()
+    end)
+
+    after_each(function()
+        os.time = original_os_time
+    end)
+
+    it("passes complete lines through", function()
+        local emitted = run_records({ entry(WEB_TAG, "one\n"), entry(WEB_TAG, "two\n") })
+        assert.are.same({ "one\n", "two\n" }, logs(emitted))
+        assert.is_nil(emitted[1].record.truncated)
+    end)
+
+    it("reassembles the fragments of a line in order", function()
+        local emitted = run_records({
+            entry(WEB_TAG, "first ", "stdout", 10),
+            entry(WEB_TAG, "second ", "stdout", 11),
+            entry(WEB_TAG, "last\n", "stdout", 12),
+            entry(WEB_TAG, "next\n", "stdout", 13),
+        })
+        assert.are.same({ "first second last\n", "next\n" }, logs(emitted))
+        -- The event keeps the timestamp of its first fragment
+        assert.are.equal(10, emitted[1].time)
+    end)
+
+    it("keeps the fragments of each container and stream apart", function()
+        local emitted = run_records({
+            entry(WEB_TAG, "{\"out\":", "stdout"),
+            entry(WEB_TAG, "{\"err\":", "stderr"),
+            entry(DB_TAG, "db ", "stdout"),
+            entry(WEB_TAG, "1}\n", "stderr"),
+            entry(DB_TAG, "line\n", "stdout"),
+            entry(WEB_TAG, "2}\n", "stdout"),
+        })
+        assert.are.same({ "{\"err\":1}\n", "db line\n", "{\"out\":2}\n" }, logs(emitted))
+        assert.are.same({ "stderr", "stdout", "stdout" },
+                        { emitted[1].record.stream, emitted[2].record.stream, emitted[3].record.stream })
+        assert.are.same({ WEB_TAG, DB_TAG, WEB_TAG }, { emitted[1].tag, emitted[2].tag, emitted[3].tag })
+    end)
+
+    it("truncates an event over the maximum size and drops its later fragments", function()
+        docker_metadata.MAX_EVENT_SIZE = 10
+        local emitted = run_records({
+            entry(WEB_TAG, "0123456"),
+            entry(WEB_TAG, "789abcdef"),
+            entry(WEB_TAG, "ghijklmn"),
+            entry(WEB_TAG, "end\n"),
+            entry(WEB_TAG, "short\n"),
+        })
+        assert.are.same({ "0123456789", "short\n" }, logs(emitted))
+        assert.is_true(emitted[1].record.truncated)
+        assert.is_nil(emitted[2].record.truncated)
+    end)
+
+    it("holds at most the maximum size of a runaway event", function()
+        docker_metadata.MAX_EVENT_SIZE = 100
+        local fragments = {}
+        for _ = 1, 1000 do
+            table.insert(fragments, entry(WEB_TAG, string.rep("x", 64)))
+        end
+        assert.are.same({}, run_records(fragments))
+        local held = 0
+        for _, event in pairs(docker_metadata.partial_lines) do
+            held = held + event.size
+        end
+        assert.are.equal(100, held)
+    end)
+
+    it("truncates complete lines over the maximum size, such as joined multiline events", function()
+        docker_metadata.MAX_EVENT_SIZE = 16
+        local emitted = run_records({ entry(WEB_TAG, "Exception\n\tat one\n\tat two\n") })
+        assert.are.same({ "Exception\n\tat on" }, logs(emitted))
+        assert.is_true(emitted[1].record.truncated)
+    end)
+
+    it("ships a partial line whose next fragment never came on the heartbeat after the timeout", function()
+        local emitted = run_records({ entry(WEB_TAG, "last words of a crashed container") })
+        assert.are.same({}, emitted)
+        now = now + 4
+        assert.are.same({}, run_records({ entry(HEARTBEAT_TAG) }))
+
+        -- No other record is read, the heartbeat alone ships it
+        now = now + 1
+        emitted = run_records({ entry(HEARTBEAT_TAG) })
+        assert.are.same({ "last words of a crashed container" }, logs(emitted))
+        -- Emitted under the heartbeat's tag, it carries its own tag to be retagged to
+        assert.are.equal(WEB_TAG, emitted[1].record.partial_tag)
+        assert.are.same({}, docker_metadata.partial_lines)
+    end)
+
+    it("keeps holding a partial line when other containers' records are read", function()
+        run_records({ entry(WEB_TAG, "still writing ") })
+        now = now + 5
+        assert.are.same({ "db line\n" }, logs(run_records({ entry(DB_TAG, "db line\n") })))
+        assert.is_not_nil(next(docker_metadata.partial_lines))
+    end)
+
+    it("passes a timed out partial line retagged to its own container through", function()
+        local record = { log = "orphan", stream = "stdout", partial_tag = WEB_TAG }
+        assert.are.equal(0, docker_metadata.reassemble_partial_lines(WEB_TAG, 1, record))
+        assert.are.same({}, docker_metadata.partial_lines)
+        -- A backfilled one was already cut before it was held
+        docker_metadata.backfill_files = {}
+        assert.are.equal(0, docker_metadata.backfill_cutoff("docker.backfill.var.lib.docker.containers.aaa111", 1,
+                                                            record))
+        docker_metadata.backfill_files = nil
+    end)
+
+    it("starts a new event when a fragment comes after the timeout", function()
+        run_records({ entry(WEB_TAG, "orphan ") })
+        now = now + 5
+        local emitted = run_records({ entry(WEB_TAG, "late\n") })
+        assert.are.same({ "orphan ", "late\n" }, logs(emitted))
+        assert.is_nil(emitted[1].record.partial_tag)
+    end)
+
+    it("passes records without a string log through", function()
+        local record = { log = { level = "info" }, stream = "stdout" }
+        local code = docker_metadata.reassemble_partial_lines(WEB_TAG, 1, record)
+        assert.are.equal(0, code)
+    end)
+
+    it("enriches a timed out partial line with the metadata of its own container", function()
+        local record = { log = "orphan", partial_tag = WEB_TAG }
+        local code, _, result = docker_metadata.enrich_with_docker_metadata(DB_TAG, 1, record)
+        assert.are.equal(1, code)
+        assert.are.equal("aaa111", result.docker_container_id)
+        assert.is_nil(result.partial_tag)
+    end)
+end)
@@ -0,0 +1,82 @@
+import unittest
+import time
+
+# Import the module to be tested
+import regex_cost
+
+
+def severities(pattern):
+    return [severity for severity, _ in regex_cost.find_super_linear_constructs(pattern)]
+
+
+class TestSuperLinearConstructs(unittest.TestCase):
+
+    def test_nested_repeats_are_exponential(self):
+        for pattern in [r'(a+)+$', r'(\w+\s?)+$', r'(x*)*y', r'^(.*,)*x', r'(?:\d+)*!']:
+            with self.subTest(pattern=pattern):
+                self.assertEqual([regex_cost.EXPONENTIAL], severities(pattern))
+
+    def test_repeated_overlapping_alternatives_are_exponential(self):
+        self.assertEqual([regex_cost.EXPONENTIAL], severities(r'(a\w|\wa)+x'))
+        self.assertEqual([], severities(r'(foo|bar)+'))
+
+    def test_nested_repeats_separated_by_another_character_are_not_exponential(self):
+        for pattern in [r'(?:[^,]+,)*x', r'(\d+\.)+\d', r'^(\w+-)+\w+$']:
+            with self.subTest(pattern=pattern):
+                self.assertNotIn(regex_cost.EXPONENTIAL, severities(pattern))
+
+    def test_overlapping_repeats_in_a_row_are_polynomial(self):
+        for pattern in [r'\w+\s*\w+x', r'.*a.*b.*c', r'\d+\d+x']:
+            with self.subTest(pattern=pattern):
+                self.assertEqual([regex_cost.POLYNOMIAL], severities(pattern))
+
+    def test_repeats_the_next_one_cannot_start_in_are_not_polynomial(self):
+        for pattern in [r'^[a-z]+(-[a-z]+)*$', r'^\d+(\.\d+)*$', r'\w+(,\s*\w+)*;']:
+            with self.subTest(pattern=pattern):
+                self.assertEqual([], severities(pattern))
+        self.assertIn(regex_cost.POLYNOMIAL, severities(r'[a-z]+(-?[a-z]+)*;'))
+
+    def test_backreferences_are_polynomial(self):
+        self.assertEqual([regex_cost.POLYNOMIAL], severities(r'(\w)x\1'))
+
+    def test_common_patterns_are_linear(self):
+        for pattern in ['ERROR', r'^\d{4}-\d{2}-\d{2}', r'^\s+at ', r'.*health.*', r'.*foo.*bar', r'\d+-\d+',
+                        r'(?i)exception|error', r'^[ERROR]', r'^(web|api)-\d+$']:
+            with self.subTest(pattern=pattern):
+                self.assertEqual([], severities(pattern))
+
+
+class TestPatternTiming(unittest.TestCase):
+
+    def test_pathological_lines(self):
+        lines = regex_cost.pathological_lines()
+        self.assertEqual(2 * len(regex_cost.PATHOLOGICAL_UNITS), len(lines))
+        self.assertTrue(all(len(line) <= regex_cost.PATHOLOGICAL_LINE_LENGTH for line in lines))
+        self.assertIn('a' * regex_cost.NEAR_MISS_REPEATS + '!', lines)
+
+    def test_patterns_are_timed_on_every_line(self):
+        results = regex_cost.time_patterns(['ERROR', '^ok$'], ['ok', 'ERROR here', 'a' * 100], timeout=5)
+        self.assertEqual(['ERROR', '^ok$'], list(results))
+        self.assertTrue(all(len(times) == 3 for times in results.values()))
+
+    def test_a_pattern_past_the_timeout_is_stopped(self):
+        start = time.monotonic()
+        results = regex_cost.time_patterns(['ERROR', r'(a+)+$', 'ok'], ['a' * 40 + '!'], timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIsNone(results[r'(a+)+$'])
+        self.assertEqual(1, len(results['ERROR']))
+        self.assertEqual(1, len(results['ok']))
+
+    def test_analysis(self):
+        results = regex_cost.analyze_patterns(['ERROR', r'^(a|aa)+$', '(?<name>x)'], line_budget_ms=50)
+        self.assertIsNone(results['ERROR']['error'])
+        self.assertLess(results['ERROR']['worst_ms'], 50)
+        self.assertGreater(results['ERROR']['cost_ms'], 0)
+        # The exponential pattern goes past the budget on the lines that almost match
+        self.assertTrue(results[r'^(a|aa)+$']['worst_ms'] is None or results[r'^(a|aa)+$']['worst_ms'] > 50)
+        # Onigmo syntax Python cannot parse
+        self.assertIn('unknown extension', results['(?<name>x)']['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
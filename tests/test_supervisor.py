@@ -0,0 +1,137 @@
+import unittest
+from unittest.mock import patch
+import os
+import signal
+import sys
+import tempfile
+
+# Import the module to be tested
+import create_fluent_bit_config
+import supervisor
+
+# Command standing in for Fluent Bit, running until it is terminated
+SLEEP_COMMAND = [sys.executable, '-c', 'import time; time.sleep(60)']
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.temp_dir.name, 'fluent-bit.conf')
+        with open(self.config_path, 'w') as file:
+            file.write('current config')
+        self.rendered_config = 'current config'
+
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _supervisor(self, command=SLEEP_COMMAND):
+        return supervisor.Supervisor(command, self.config_path, lambda: self.rendered_config, refresh_interval=1)
+
+    def test_refresh_keeps_process_when_config_is_unchanged(self):
+        sup = self._supervisor()
+        sup.start()
+        try:
+            pid = sup.process.pid
+            self.assertFalse(sup.refresh())
+            self.assertEqual(pid, sup.process.pid)
+        finally:
+            sup.stop()
+
+    def test_refresh_restarts_process_when_config_changes(self):
+        sup = self._supervisor()
+        sup.start()
+        old_process = sup.process
+        try:
+            self.rendered_config = 'new config'
+            self.assertTrue(sup.refresh())
+            self.assertIsNotNone(old_process.poll())
+            self.assertIsNone(sup.process.poll())
+            with open(self.config_path) as file:
+                self.assertEqual('new config', file.read())
+        finally:
+            sup.stop()
+
+    def test_process_gets_its_own_environment(self):
+        output_path = os.path.join(self.temp_dir.name, 'env')
+        command = [sys.executable, '-c', f'import os; open({output_path!r}, "w").write(os.environ["SHARD_VALUE"])']
+        sup = supervisor.Supervisor(command, self.config_path, lambda: self.rendered_config, refresh_interval=1,
+                                    env={'SHARD_VALUE': 'shard-1'})
+        sup.start()
+        sup.process.wait(timeout=30)
+        with open(output_path) as file:
+            self.assertEqual('shard-1', file.read())
+
+    def test_run_returns_fluent_bit_exit_code(self):
+        sup = self._supervisor([sys.executable, '-c', 'import sys; sys.exit(3)'])
+        with patch('signal.signal'):
+            self.assertEqual(3, sup.run())
+
+    def test_fluent_bit_command(self):
+        command = supervisor.fluent_bit_command('/fluent-bit/etc/fluent-bit.conf')
+        self.assertEqual(supervisor.FLUENT_BIT_BIN, command[0])
+        self.assertIn('/fluent-bit/etc/fluent-bit.conf', command)
+        self.assertIn(create_fluent_bit_config.PLUGIN_PATH, command)
+
+    def test_fluent_bit_command_without_plugin(self):
+        command = supervisor.fluent_bit_command('/fluent-bit/etc/fluent-bit.conf', load_plugin=False)
+        self.assertEqual([supervisor.FLUENT_BIT_BIN, '-c', '/fluent-bit/etc/fluent-bit.conf'], command)
+
+
+
+class TestShardSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.print_patcher = patch('builtins.print')
+        self.mock_print = self.print_patcher.start()
+
+    def tearDown(self):
+        self.print_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _shard(self, index, command=SLEEP_COMMAND):
+        config_path = os.path.join(self.temp_dir.name, f'fluent-bit-shard-{index}.conf')
+        with open(config_path, 'w') as file:
+            file.write(f'shard {index}')
+        return supervisor.Supervisor(command, config_path, lambda: f'shard {index}', refresh_interval=60)
+
+    def test_exited_shards_are_restarted(self):
+        shards = [self._shard(0), self._shard(1, [sys.executable, '-c', 'import sys; sys.exit(1)'])]
+        sup = supervisor.ShardSupervisor(shards, refresh_interval=60)
+        for shard in shards:
+            shard.start()
+        try:
+            first_pid = shards[0].process.pid
+            shards[1].process.wait()
+            with patch.object(supervisor, 'RESTART_DELAY_SEC', 0):
+                sup.restart_exited()
+                exited_process = shards[1].process
+                sup.restart_exited()
+            self.assertIsNot(exited_process, shards[1].process)
+            self.assertEqual(first_pid, shards[0].process.pid)
+            self.mock_print.assert_any_call("Fluent Bit shard 1 exited with code 1, restarting it in 0 seconds.")
+        finally:
+            for shard in shards:
+                shard.stop()
+
+    def test_signals_stop_every_shard(self):
+        shards = [self._shard(0), self._shard(1)]
+        sup = supervisor.ShardSupervisor(shards, refresh_interval=60)
+
+        def stop_shards(seconds):
+            if not sup.stopping:
+                sup._forward_signal(signal.SIGTERM, None)
+
+        with patch('signal.signal'), patch('time.sleep', side_effect=stop_shards):
+            returncode = sup.run()
+        self.assertEqual(-signal.SIGTERM, returncode)
+        self.assertTrue(all(shard.process.poll() is not None for shard in shards))
+
+
+if __name__ == '__main__':
+    unittest.main()